@@ -0,0 +1,125 @@
+'''
+
+abstract : element adjacency tables of the cubed-sphere grid
+
+The elements are numbered along the Fortran order of cube_rank(ne,ne,6),
+  gid = (panel-1)*ne*ne + (ej-1)*ne + (ei-1)
+so that cube_rank.ravel(order='F')[gid] is the rank of the element.
+
+'''
+
+from __future__ import print_function, division
+import logging
+import numpy as np
+
+from cube_neighbor import CubeNeighbor
+
+
+
+
+# relative locations of the neighbors
+# the same sequence as global_communication_ratio() in cube_partition_stripe.f90
+EDGE_DIRS = [(-1,0), (1,0), (0,-1), (0,1)]        # W, E, S, N
+CORNER_DIRS = [(-1,-1), (1,-1), (-1,1), (1,1)]    # SW, SE, NW, NE
+
+
+_adjacency_cache = dict()
+
+
+
+
+def get_cube_adjacency(ne):
+    '''
+    return the CubeAdjacency of the given ne, memoized per process
+    '''
+    if ne not in _adjacency_cache:
+        _adjacency_cache[ne] = CubeAdjacency(ne)
+
+    return _adjacency_cache[ne]
+
+
+
+
+class CubeAdjacency(object):
+    '''
+    edge and corner neighbors of every element on the cubed-sphere
+
+    edge_nbrs  : (6*ne*ne,4) neighbor gids in (W, E, S, N)
+    corner_nbrs: (6*ne*ne,4) neighbor gids in (SW, SE, NW, NE),
+                 -1 at the cube corners where only 3 elements meet
+    xadj, adjncy : CSR view of the edge and corner neighbors
+    '''
+
+    def __init__(self, ne):
+        self.ne = ne
+        self.nelem = 6*ne*ne
+
+        self.edge_nbrs = self.make_nbr_table(EDGE_DIRS)
+        self.corner_nbrs = self.make_nbr_table(CORNER_DIRS)
+
+        nbrs = np.hstack([self.edge_nbrs, self.corner_nbrs])
+        valid = nbrs >= 0
+        self.xadj = np.zeros(self.nelem+1, 'i4')
+        np.cumsum(valid.sum(axis=1), out=self.xadj[1:])
+        self.adjncy = np.ascontiguousarray(nbrs[valid], 'i4')
+
+
+    def elem_coords(self):
+        '''
+        return (ei, ej, panel) of all elements along the gid
+        '''
+        ne = self.ne
+        ei, ej, panel = np.meshgrid(np.arange(1,ne+1), np.arange(1,ne+1),
+                np.arange(1,7), indexing='ij')
+
+        return [x.ravel(order='F').astype('i4') for x in (ei, ej, panel)]
+
+
+    def make_nbr_table(self, dirs):
+        '''
+        return (6*ne*ne,len(dirs)) gids of the neighbors in the directions
+        '''
+        ne = self.ne
+        ei, ej, panel = self.elem_coords()
+
+        a = np.array([d[0] for d in dirs], 'i4')
+        b = np.array([d[1] for d in dirs], 'i4')
+        ret = CubeNeighbor().convert_nbr_eij_array(ne,
+                ei[:,None] + a, ej[:,None] + b, panel[:,None])
+
+        nbrs = (ret[:,2]-1)*ne*ne + (ret[:,1]-1)*ne + (ret[:,0]-1)
+        nbrs[ret[:,2] == -1] = -1
+
+        return np.ascontiguousarray(nbrs.reshape(self.nelem, len(dirs)), 'i4')
+
+
+    def dual_graph(self, corners=False, ngq=None, vweights=None):
+        '''
+        dual graph of the elements in CSR format for graph partitioners (pymetis)
+
+        corners : include the corner neighbors
+        ngq     : edge weights, ngq for the edge and 1 for the corner neighbors
+        vweights: (ne,ne,6) vertex weights of the elements
+
+        return xadj, adjncy, eweights, vweights
+          eweights, vweights are None if not requested
+        '''
+        if corners:
+            xadj, adjncy = self.xadj, self.adjncy
+        else:
+            xadj = np.arange(0, 4*self.nelem+1, 4, dtype='i4')
+            adjncy = self.edge_nbrs.reshape(-1)
+
+        eweights = None
+        if ngq != None:
+            if corners:
+                is_edge = np.arange(adjncy.size) - np.repeat(xadj[:-1], np.diff(xadj)) < 4
+                eweights = np.where(is_edge, ngq, 1).astype('i4')
+            else:
+                eweights = np.full(adjncy.size, ngq, 'i4')
+
+        if vweights is not None:
+            vweights = np.ascontiguousarray(
+                    np.asarray(vweights).ravel(order='F'), 'i4')
+
+        return xadj, adjncy, eweights, vweights
@@ -0,0 +1,84 @@
+'''
+
+abstract : predicted step time of the ranks of a partition
+           and the partitions of the flat times
+
+The time of a rank is its computation plus its halo exchange,
+  time = elem_cost*nelems/capacity + point_cost*comm_pts + msg_cost*num_msgs
+comm_pts: communication points of global_communication_ratio()
+num_msgs: neighbor ranks of global_neighbor_count()
+capacity: relative speed of the rank (1: the same speeds)
+
+The slowest rank sets the step time, so the partitions are measured by
+the max/mean ratio of the times.
+
+'''
+
+from __future__ import print_function, division
+import logging
+import numpy as np
+
+from cube_adjacency import get_cube_adjacency
+from cube_partition_pool import make_cube_rank
+from cube_partition_stripe import CubePartitionStripe
+
+
+
+
+def rank_times(ne, nproc, cube_rank, costs, ngq=4, capacity=None):
+    '''
+    return (nproc,) predicted time of every rank
+    costs: (elem_cost, point_cost, msg_cost)
+    '''
+    obj = CubePartitionStripe(ne, nproc)
+    adj = get_cube_adjacency(ne)
+
+    elem_cost, point_cost, msg_cost = costs
+    comm_ratio, num_pts = obj.global_communication_ratio(ngq, cube_rank, adj)
+    mean_nbrs, num_msgs = obj.global_neighbor_count(cube_rank)
+    nelems = np.bincount(cube_rank.ravel(), minlength=nproc)
+    if capacity is None: capacity = np.ones(nproc)
+
+    return elem_cost*nelems/capacity + point_cost*num_pts[1] + msg_cost*num_msgs
+
+
+
+
+def time_ratio(times):
+    '''
+    max/mean ratio of the rank times, 1 for the flat times
+    '''
+    return times.max()/times.mean()
+
+
+
+
+def balance_rank_times(method, ne, nproc, costs, ngq=4, capacity=None,
+                       **kwargs):
+    '''
+    partition by the method ('sfc' or 'stripe') and move the elements of
+    the slow ranks to their neighbor ranks toward the flat times,
+    see CubePartitionStripe.refine_rank_times()
+
+    return (nelems, cube_rank, cube_lid), (ratio0, ratio)
+      ratio0: max/mean ratio of the times of the partition of the method
+      ratio : max/mean ratio of the times after the moves
+    costs   : (elem_cost, point_cost, msg_cost), see rank_times()
+    capacity: (nproc,) relative speeds of the ranks, also given to the
+              partitioner for the nelems in proportion
+    kwargs  : options of the partitioner, see cube_partition_pool.make_cube_rank()
+    '''
+    obj = CubePartitionStripe(ne, nproc)
+    if capacity is not None:
+        capacity = obj.check_capacity(capacity)
+        kwargs['capacity'] = capacity
+
+    ret = make_cube_rank(method, ne, nproc, **kwargs)
+    times0 = rank_times(ne, nproc, ret[1], costs, ngq, capacity)
+    nelems, cube_rank, cube_lid, times = obj.refine_rank_times(
+            ret[1], costs, ngq, capacity)
+
+    ratio0, ratio = time_ratio(times0), time_ratio(times)
+    logging.info('balance_rank_times: {} ne={} nproc={} max/mean {} -> {}'.format(method, ne, nproc, ratio0, ratio))
+
+    return (nelems, cube_rank, cube_lid), (ratio0, ratio)
@@ -0,0 +1,222 @@
+'''
+
+abstract : global numbering of the Gauss-Lobatto-Legendre (GLL) points
+           on the cubed-sphere and the exact shared-point communication
+
+The local points are numbered along the Fortran order of (ngq,ngq,ne,ne,6),
+  lp = (gi-1) + ngq*(gj-1) + ngq*ngq*gid
+where gid is the element number of cube_adjacency.py.
+The points on the element boundaries are duplicated in the neighbor elements,
+they get the same global number.
+
+'''
+
+from __future__ import print_function, division
+import logging
+import numpy as np
+
+from cube_neighbor import CubeNeighbor
+
+
+
+
+_gll_cache = dict()
+
+
+
+
+def get_cube_gll(ne, ngq):
+    '''
+    return the CubeGLL of the given (ne, ngq), memoized per process
+    '''
+    if (ne, ngq) not in _gll_cache:
+        _gll_cache[(ne, ngq)] = CubeGLL(ne, ngq)
+
+    return _gll_cache[(ne, ngq)]
+
+
+
+
+class CubeGLL(object):
+    '''
+    unique global ids of the GLL points on the cubed-sphere
+
+    gids : (ngq*ngq*6*ne*ne,) global point id of every local point,
+           numbered along the first appearance of the local points
+    size : number of the unique points, 6*ne*ne*(ngq-1)**2 + 2
+    '''
+
+    def __init__(self, ne, ngq):
+        self.ne = ne
+        self.ngq = ngq
+        self.nelem = 6*ne*ne
+        self.npt = ngq*ngq*self.nelem  # number of local points
+
+        src, dst = self.make_point_links()
+
+        #
+        # propagate the minimum local point number over the linked points
+        #
+        label = np.arange(self.npt, dtype='i8')
+        while True:
+            new_label = label.copy()
+            np.minimum.at(new_label, src, label[dst])
+            if np.array_equal(new_label, label): break
+            label = new_label
+
+        _, gids = np.unique(label, return_inverse=True)
+        self.gids = gids.astype('i4')
+        self.size = int(self.gids.max()) + 1
+
+
+    def point_coords(self):
+        '''
+        return (gi, gj, ei, ej, panel) of all local points
+        '''
+        ne, ngq = self.ne, self.ngq
+        coords = np.meshgrid(np.arange(1,ngq+1), np.arange(1,ngq+1),
+                np.arange(1,ne+1), np.arange(1,ne+1), np.arange(1,7),
+                indexing='ij')
+
+        return [x.ravel(order='F').astype('i4') for x in coords]
+
+
+    def make_point_links(self):
+        '''
+        return (src, dst) local points which are the same physical point
+        the links are symmetric, (dst, src) is also included
+        '''
+        ne, ngq = self.ne, self.ngq
+        gi, gj, ei, ej, panel = self.point_coords()
+
+        srcs, nbr_gis, nbr_gjs = [], [], []
+        for mask, a, b in [(gi == 1, -1, 0), (gi == ngq, 1, 0),
+                           (gj == 1, 0, -1), (gj == ngq, 0, 1)]:
+            src = np.nonzero(mask)[0]
+            srcs.append(src)
+            nbr_gis.append(gi[src] + a)
+            nbr_gjs.append(gj[src] + b)
+        src = np.concatenate(srcs)
+
+        ret = CubeNeighbor().convert_nbr_gij_array(ne, ngq,
+                np.concatenate(nbr_gis), np.concatenate(nbr_gjs),
+                ei[src], ej[src], panel[src])
+
+        #
+        # gi=0 is the point gi=ngq of the west neighbor element,
+        # the same physical point as gi=1 of the element
+        #
+        ngi, ngj = ret[:,0], ret[:,1]
+        egid = (ret[:,4]-1)*ne*ne + (ret[:,3]-1)*ne + (ret[:,2]-1)
+        dst = (ngi-1) + ngq*(ngj-1) + ngq*ngq*egid.astype('i8')
+
+        return src, dst
+
+
+    def elem_gids(self):
+        '''
+        return (6*ne*ne,ngq*ngq) global point ids of every element
+        '''
+        return self.gids.reshape(self.nelem, self.ngq*self.ngq)
+
+
+    def elem_multiplicity(self):
+        '''
+        return (size,) number of elements sharing every global point
+        '''
+        return np.bincount(self.gids, minlength=self.size).astype('i4')
+
+
+    def dss_weights(self):
+        '''
+        return (ngq*ngq*6*ne*ne,) inverse multiplicity of every local point
+        to average the direct stiffness summation
+        '''
+        return 1/self.elem_multiplicity()[self.gids]
+
+
+    def rank_points(self, cube_rank, nproc=None):
+        '''
+        return the unique (global point id, rank) pairs sorted by the id
+        '''
+        if nproc == None: nproc = int(cube_rank.max()) + 1
+        ranks = np.repeat(cube_rank.ravel(order='F'), self.ngq*self.ngq)
+
+        keys = np.unique(self.gids.astype('i8')*nproc + ranks)
+
+        return (keys//nproc).astype('i4'), (keys%nproc).astype('i4')
+
+
+    def communication_volume(self, cube_rank, nproc=None):
+        '''
+        exact number of the unique shared points
+        a point shared by several ranks is counted once per rank
+
+        return comm_ratio, num_pts, pair_pts
+          num_pts  : (2,nproc) (comp points, unique shared points)
+          pair_pts : (3,npair) (rank_a, rank_b, unique shared points), a<b
+        '''
+        if nproc == None: nproc = int(cube_rank.max()) + 1
+
+        pt_gids, pt_ranks = self.rank_points(cube_rank, nproc)
+        nranks = np.bincount(pt_gids, minlength=self.size)
+        shared = nranks[pt_gids] > 1
+
+        num_pts = np.zeros((2,nproc), 'i4', order='F')
+        num_pts[0,:] = np.bincount(cube_rank.ravel(), minlength=nproc)*self.ngq*self.ngq
+        num_pts[1,:] = np.bincount(pt_ranks[shared], minlength=nproc)
+
+        #
+        # every pair of ranks sharing a point
+        # the (id, rank) are sorted, so the ranks in a group are ascending
+        #
+        ra, rb = [], []
+        for d in range(1, nranks.max()):
+            same = pt_gids[:-d] == pt_gids[d:]
+            ra.append(pt_ranks[:-d][same])
+            rb.append(pt_ranks[d:][same])
+        keys = np.concatenate(ra + [np.zeros(0,'i4')]).astype('i8')*nproc \
+             + np.concatenate(rb + [np.zeros(0,'i4')])
+        keys, counts = np.unique(keys, return_counts=True)
+        pair_pts = np.array([keys//nproc, keys%nproc, counts], 'i4').reshape(3,-1)
+
+        comm_ratio = np.mean(num_pts[1,:]/num_pts[0,:])
+
+        return comm_ratio, num_pts, pair_pts
+
+
+    def shared_points(self, cube_rank, nproc=None):
+        '''
+        shared points of all ranks in one pass
+        the owner of a shared point is the lowest rank touching it
+
+        return ptr, gids, owners, elem_mult, rank_mult
+          ptr       : (nproc+1,) the points of rank r are [ptr[r]:ptr[r+1]]
+          gids      : global point ids, ascending in each rank
+          owners    : owner rank of the points
+          elem_mult : number of elements sharing the points
+          rank_mult : number of ranks sharing the points
+        '''
+        if nproc == None: nproc = int(cube_rank.max()) + 1
+
+        pt_gids, pt_ranks = self.rank_points(cube_rank, nproc)
+        nranks = np.bincount(pt_gids, minlength=self.size)
+
+        # (id, rank) are sorted, the first rank of an id is the lowest one
+        first = np.ones(pt_gids.size, bool)
+        first[1:] = pt_gids[1:] != pt_gids[:-1]
+        owner_of = np.zeros(self.size, 'i4')
+        owner_of[pt_gids[first]] = pt_ranks[first]
+
+        shared = nranks[pt_gids] > 1
+        pt_gids, pt_ranks = pt_gids[shared], pt_ranks[shared]
+        order = np.argsort(pt_ranks, kind='stable')
+        gids, ranks = pt_gids[order], pt_ranks[order]
+
+        ptr = np.zeros(nproc+1, 'i4')
+        np.cumsum(np.bincount(ranks, minlength=nproc), out=ptr[1:])
+        owners = owner_of[gids]
+        elem_mult = self.elem_multiplicity()[gids]
+        rank_mult = nranks[gids].astype('i4')
+
+        return ptr, gids, owners, elem_mult, rank_mult
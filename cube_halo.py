@@ -0,0 +1,237 @@
+'''
+
+abstract : halo exchange plan of the spectral-element method
+           for a partition of the cubed-sphere
+
+Every pair of neighbor ranks exchanges the partial sums of their
+shared GLL points. Both sides list the points in ascending global point id
+(see cube_gll.py), so the send list of (rank, nbr) is the receive list of
+(nbr, rank).
+
+'''
+
+from __future__ import print_function, division
+import logging
+import numpy as np
+
+from cube_gll import get_cube_gll
+
+
+
+
+def load_halo_plan(fpath):
+    '''
+    load a CubeHaloPlan saved by CubeHaloPlan.save()
+    '''
+    with np.load(fpath) as data:
+        arrays = dict((key, data[key]) for key in data.files)
+
+    plan = CubeHaloPlan.__new__(CubeHaloPlan)
+    plan.ne, plan.ngq, plan.nproc = [int(x) for x in arrays.pop('shape')]
+    for key, val in arrays.items():
+        setattr(plan, key, val)
+
+    return plan
+
+
+
+
+def make_exchange_schedule(pair_ranks, weights):
+    '''
+    greedy edge coloring of the rank graph
+    every rank talks to at most one peer per round,
+    the heavier messages are scheduled in the earlier rounds
+
+    pair_ranks: (2,npair) (rank_a, rank_b) of the neighbor ranks
+    weights   : (npair,) message sizes
+
+    return rounds, max_degree
+      rounds    : list of (2,n) (rank_a, rank_b) in the descending weights
+      max_degree: lower bound of the number of rounds
+    '''
+    pair_ranks = np.asarray(pair_ranks).reshape(2,-1)
+    weights = np.asarray(weights)
+    if weights.size == 0:
+        return [], 0
+
+    order = np.lexsort((pair_ranks[1], pair_ranks[0], -weights))
+    degrees = np.bincount(pair_ranks.ravel())
+
+    busy = [0]*degrees.size  # bitmask of the occupied rounds of every rank
+    round_of = np.zeros(weights.size, 'i4')
+    for k in order:
+        a, b = pair_ranks[0,k], pair_ranks[1,k]
+        used = busy[a] | busy[b]
+        r = ((~used) & (used+1)).bit_length() - 1  # lowest free round
+        busy[a] |= 1 << r
+        busy[b] |= 1 << r
+        round_of[k] = r
+
+    rounds = []
+    for r in range(round_of.max()+1):
+        ks = order[round_of[order] == r]
+        rounds.append(pair_ranks[:,ks])
+
+    return rounds, int(degrees.max())
+
+
+
+
+class CubeHaloPlan(object):
+    '''
+    exchange plan of all ranks in CSR format
+
+    nbr_ptr, nbr_ranks : neighbor ranks of rank r are
+                         nbr_ranks[nbr_ptr[r]:nbr_ptr[r+1]], ascending
+    for the k-th (rank, nbr) entry
+      pt_ptr, pt_gids  : shared points pt_gids[pt_ptr[k]:pt_ptr[k+1]]
+      pt_lps           : local point index (see cube_gll.py) of the points
+                         in the rank, to pack the send buffer
+      elem_ptr, elem_gids : elements of the rank touching the shared points
+      counts, displs   : buffer counts and offsets in the rank's
+                         alltoallv-style buffer (same for send and recv)
+      reverse          : index of the (nbr, rank) entry
+    '''
+
+    array_names = ['nbr_ptr', 'nbr_ranks', 'pt_ptr', 'pt_gids', 'pt_lps',
+                   'elem_ptr', 'elem_gids', 'counts', 'displs', 'reverse']
+
+
+    def __init__(self, ne, ngq, cube_rank, nproc=None):
+        self.ne = ne
+        self.ngq = ngq
+        if nproc == None: nproc = int(cube_rank.max()) + 1
+        self.nproc = nproc
+
+        gll = get_cube_gll(ne, ngq)
+        nlp = ngq*ngq
+        lp_ranks = np.repeat(cube_rank.ravel(order='F'), nlp).astype('i8')
+
+        #
+        # (global point id, rank) of the local points
+        # the first local point of a key is the lowest local point index
+        #
+        lp_keys = gll.gids.astype('i8')*nproc + lp_ranks
+        keys, first_lps, key_counts = np.unique(lp_keys,
+                return_index=True, return_counts=True)
+        pt_gids, pt_ranks = keys//nproc, keys%nproc
+
+        #
+        # (rank, nbr, point) of all shared points
+        #
+        nranks = np.bincount(pt_gids, minlength=gll.size)
+        ra, rb, gs = [], [], []
+        for d in range(1, nranks.max()):
+            same = pt_gids[:-d] == pt_gids[d:]
+            for r1, r2 in [(pt_ranks[:-d], pt_ranks[d:]), (pt_ranks[d:], pt_ranks[:-d])]:
+                ra.append(r1[same])
+                rb.append(r2[same])
+                gs.append(pt_gids[d:][same])
+        empty = [np.zeros(0, 'i8')]
+        ra, rb, gs = [np.concatenate(x + empty) for x in (ra, rb, gs)]
+        order = np.lexsort((gs, rb, ra))
+        ra, rb, gs = ra[order], rb[order], gs[order]
+
+        #
+        # neighbor entries
+        #
+        pair_keys = ra*nproc + rb
+        uniq_pairs, pt_start = np.unique(pair_keys, return_index=True)
+        nbr_owner = uniq_pairs//nproc
+        self.nbr_ranks = (uniq_pairs%nproc).astype('i4')
+        self.nbr_ptr = self.make_ptr(np.bincount(nbr_owner, minlength=nproc))
+        self.pt_ptr = np.append(pt_start, gs.size).astype('i4')
+        self.pt_gids = gs.astype('i4')
+
+        key_idx = np.searchsorted(keys, gs*nproc + ra)
+        self.pt_lps = first_lps[key_idx].astype('i4')
+
+        self.counts = np.diff(self.pt_ptr).astype('i4')
+        rank_start = self.pt_ptr[self.nbr_ptr[nbr_owner]]
+        self.displs = (self.pt_ptr[:-1] - rank_start).astype('i4')
+        self.reverse = np.searchsorted(uniq_pairs,
+                self.nbr_ranks.astype('i8')*nproc + nbr_owner).astype('i4')
+
+        #
+        # elements of the rank touching the shared points of every entry
+        #
+        lp_order = np.argsort(lp_keys, kind='stable')
+        key_start = np.cumsum(key_counts) - key_counts
+        n = key_counts[key_idx]
+        entry = np.repeat(np.arange(uniq_pairs.size), np.diff(self.pt_ptr))
+        entry = np.repeat(entry, n)
+        offset = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        elems = lp_order[np.repeat(key_start[key_idx], n) + offset]//nlp
+
+        elem_keys = np.unique(entry.astype('i8')*gll.nelem + elems)
+        self.elem_gids = (elem_keys%gll.nelem).astype('i4')
+        self.elem_ptr = self.make_ptr(np.bincount(elem_keys//gll.nelem,
+                minlength=uniq_pairs.size))
+
+
+    def make_ptr(self, counts):
+        ptr = np.zeros(len(counts)+1, 'i4')
+        np.cumsum(counts, out=ptr[1:])
+
+        return ptr
+
+
+    def neighbors(self, rank):
+        '''
+        return neighbor ranks, buffer counts and displacements of the rank
+        '''
+        sl = slice(self.nbr_ptr[rank], self.nbr_ptr[rank+1])
+
+        return self.nbr_ranks[sl], self.counts[sl], self.displs[sl]
+
+
+    def entry(self, rank, nbr):
+        '''
+        return the index of the (rank, nbr) entry
+        '''
+        k0 = self.nbr_ptr[rank]
+        ks = np.nonzero(self.nbr_ranks[k0:self.nbr_ptr[rank+1]] == nbr)[0]
+        if ks.size == 0:
+            raise ValueError('{} is not a neighbor of {}'.format(nbr, rank))
+
+        return k0 + ks[0]
+
+
+    def send(self, rank, nbr):
+        '''
+        return the points (gids, local point indices) and the elements
+        to send from the rank to the nbr
+        '''
+        k = self.entry(rank, nbr)
+        sl = slice(self.pt_ptr[k], self.pt_ptr[k+1])
+        elems = self.elem_gids[self.elem_ptr[k]:self.elem_ptr[k+1]]
+
+        return self.pt_gids[sl], self.pt_lps[sl], elems
+
+
+    def recv(self, rank, nbr):
+        '''
+        return the points (gids, local point indices) and the elements
+        to receive by the rank from the nbr
+        the local point indices are in the nbr
+        '''
+        return self.send(nbr, rank)
+
+
+    def save(self, fpath):
+        '''
+        save the plan to a numpy binary file (.npz)
+        '''
+        arrays = dict((key, getattr(self, key)) for key in self.array_names)
+        np.savez(fpath, shape=np.array([self.ne, self.ngq, self.nproc]), **arrays)
+
+
+    def exchange_schedule(self):
+        '''
+        pairwise exchange rounds of the plan, see make_exchange_schedule()
+        '''
+        owners = np.repeat(np.arange(self.nproc), np.diff(self.nbr_ptr))
+        half = owners < self.nbr_ranks
+
+        return make_exchange_schedule(
+                [owners[half], self.nbr_ranks[half]], self.counts[half])
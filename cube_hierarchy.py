@@ -0,0 +1,378 @@
+'''
+
+abstract : two-level (node, then rank) partitioning of the cubed-sphere
+
+The cube is partitioned into nnodes domains by the stripe or SFC method,
+then the elements of every node are split into ranks_per_node ranks by
+recursive bisection with the shortest cuts, see bisect_elems().
+The ranks of node n are n*ranks_per_node, ..., (n+1)*ranks_per_node - 1,
+so the node boundaries are the boundaries of the first level and the
+traffic between the nodes is separated from the traffic in the nodes.
+
+The elements of every rank can be split again into nthreads threads the
+same way, see make_cube_thread().
+
+The elements are numbered as cube_adjacency.py,
+  gid = (panel-1)*ne*ne + (ej-1)*ne + (ei-1)
+
+'''
+
+from __future__ import print_function, division
+import heapq
+import logging
+import numpy as np
+
+from cube_adjacency import get_cube_adjacency
+from cube_gll import get_cube_gll
+from cube_partition_pool import make_cube_rank
+from cube_partition_sfc import CubePartitionSFC
+
+
+
+
+# (normal, east, north) of the panels, the sequence of neighbor panels
+# of init_nbr_panels() in cube_neighbor.f90
+PANEL_FRAMES = np.array([
+    [( 1, 0, 0), ( 0, 1, 0), ( 0, 0, 1)],
+    [( 0, 1, 0), (-1, 0, 0), ( 0, 0, 1)],
+    [(-1, 0, 0), ( 0,-1, 0), ( 0, 0, 1)],
+    [( 0,-1, 0), ( 1, 0, 0), ( 0, 0, 1)],
+    [( 0, 0,-1), ( 0, 1, 0), ( 1, 0, 0)],
+    [( 0, 0, 1), ( 0, 1, 0), (-1, 0, 0)]], 'f8')
+
+
+
+
+def elem_centers(ne):
+    '''
+    return (6*ne*ne,3) centers of the elements on the unit sphere
+    (equiangular cubed-sphere)
+    '''
+    t = np.tan(-np.pi/4 + (np.arange(ne) + 0.5)*np.pi/(2*ne))
+    a, b, p = [x.ravel(order='F') for x in
+               np.meshgrid(t, t, np.arange(6), indexing='ij')]
+    xyz = PANEL_FRAMES[p,0] + a[:,None]*PANEL_FRAMES[p,1] \
+                            + b[:,None]*PANEL_FRAMES[p,2]
+
+    return xyz/np.linalg.norm(xyz, axis=1)[:,None]
+
+
+
+
+def bisect_elems(coords, edge_nbrs, elems, nelems):
+    '''
+    split the elements into len(nelems) parts of the nelems by recursive
+    bisection, the first half of the parts on the low side of the cut
+
+    coords   : (6*ne*ne,3) elem_centers()
+    edge_nbrs: (6*ne*ne,4) side neighbors, see CubeAdjacency
+    elems    : gids of the elements, sum(nelems) elements
+    return (len(elems),) part of every element
+
+    The elements are ordered both ways by the angle about the x, y and z axes
+    (the grid lines of the panels are the great circles about them)
+    and along the longest axis of their centers, the cut of the
+    fewest pieces of the halves, then of the fewest sides between them
+    is taken. If every cut leaves a half in pieces, the low half is grown
+    from the lowest element through the sides instead, see grow_order().
+    '''
+    nelems = np.asarray(nelems)
+    elems = np.asarray(elems)
+    parts = np.zeros(elems.size, 'i4')
+    in_part = np.zeros(len(coords), bool)
+
+    stack = [(np.arange(elems.size), 0, len(nelems))]
+    while stack:
+        idx, first, nparts = stack.pop()
+        if nparts == 1:
+            parts[idx] = first
+            continue
+
+        half = nparts//2
+        n1 = nelems[first:first+half].sum()
+        xyz = coords[elems[idx]]
+        mean = xyz.mean(axis=0)
+        x = xyz - mean
+        keys = [np.dot(x, np.linalg.eigh(np.dot(x.T, x))[1][:,-1])]
+        for k in range(3):
+            u, v = xyz[:,(k+1)%3], xyz[:,(k+2)%3]
+            phi = np.arctan2(mean[(k+2)%3], mean[(k+1)%3])
+            keys.append(np.arctan2(v*np.cos(phi) - u*np.sin(phi),
+                                   u*np.cos(phi) + v*np.sin(phi)))
+
+        cuts = []
+        for key in keys + [-key for key in keys]:
+            order = np.argsort(key, kind='stable')
+            low = elems[idx[order[:n1]]]
+            high = elems[idx[order[n1:]]]
+            in_part[high] = True
+            cut = np.count_nonzero(in_part[edge_nbrs[low]])
+            in_part[high] = False
+            cuts.append((cut, len(cuts), order))
+
+        best = None
+        for grow in [False, True]:
+            for cut, k, order in sorted(cuts, key=lambda c: c[:2]):
+                if grow:
+                    order = grow_order(edge_nbrs, elems[idx], order, n1)
+                pieces = count_pieces(edge_nbrs, elems[idx[order[:n1]]]) \
+                       + count_pieces(edge_nbrs, elems[idx[order[n1:]]])
+                if best is None or pieces < best[0]:
+                    best = (pieces, order)
+                if pieces == 2: break
+            if best[0] == 2: break
+        order = best[1]
+        stack.append((idx[order[:n1]], first, half))
+        stack.append((idx[order[n1:]], first+half, nparts-half))
+
+    return parts
+
+
+
+
+def grow_order(edge_nbrs, elems, order, n1):
+    '''
+    the order of the elements with the first n1 elements grown from
+    order[0] through the sides, the element of the lowest position in
+    the order next, so the first n1 elements are connected
+    '''
+    pos = np.full(len(edge_nbrs), -1)
+    pos[elems[order]] = np.arange(len(order))
+    taken = np.zeros(len(order), bool)
+
+    heap = [0]
+    taken[0] = True
+    first = []
+    while heap and len(first) < n1:
+        k = heapq.heappop(heap)
+        first.append(k)
+        for nbr in edge_nbrs[elems[order[k]]]:
+            j = pos[nbr]
+            if j >= 0 and not taken[j]:
+                taken[j] = True
+                heapq.heappush(heap, j)
+
+    rest = np.setdiff1d(np.arange(len(order)), first)  # ascending
+
+    return order[np.concatenate([first, rest]).astype('i8')]
+
+
+
+
+def count_pieces(edge_nbrs, elems):
+    '''
+    number of the pieces of the elements connected through the sides
+    '''
+    label = np.full(len(edge_nbrs), -1, 'i8')
+    label[elems] = elems
+    nbrs = edge_nbrs[elems]
+    while True:
+        new_label = np.maximum(label[elems], label[nbrs].max(axis=1))
+        new_label = label[new_label]  # pointer jumping
+        if np.array_equal(new_label, label[elems]): break
+        label[elems] = new_label
+
+    return np.unique(label[elems]).size
+
+
+
+
+def make_cube_lid(cube_rank, nproc):
+    '''
+    local numbering of the elements in every rank along the Fortran order,
+    as make_cube_rank()
+    '''
+    flat = cube_rank.ravel(order='F')
+    order = np.argsort(flat, kind='stable')
+    start = np.zeros(nproc+1, 'i4')
+    np.cumsum(np.bincount(flat, minlength=nproc), out=start[1:])
+
+    lids = np.zeros(flat.size, 'i4')
+    lids[order] = np.arange(flat.size) - start[flat[order]] + 1
+
+    return lids.reshape(cube_rank.shape, order='F')
+
+
+
+
+def make_cube_rank_hierarchical(method, ne, nnodes, ranks_per_node,
+                                capacity=None, **kwargs):
+    '''
+    partition into nnodes domains by the method ('sfc' or 'stripe'),
+    then every domain into ranks_per_node ranks
+
+    return nelems, cube_rank, cube_lid
+      the ranks of node n are n*ranks_per_node, ..., (n+1)*ranks_per_node - 1
+    capacity: (nnodes*ranks_per_node,) relative speeds of the ranks
+              (None: the same speeds), the nodes and the ranks in a node
+              get the elements in proportion
+    kwargs  : options of the first level, see cube_partition_pool.make_cube_rank()
+
+    The nelems differ by at most one with the same speeds, as make_cube_rank().
+    '''
+    if nnodes < 1 or ranks_per_node < 1:
+        raise ValueError('The nnodes and ranks_per_node must be positive: {} {}'.format(nnodes, ranks_per_node))
+    nproc = nnodes*ranks_per_node
+    if nproc > 6*ne*ne:
+        raise ValueError('The nnodes*ranks_per_node must not be greater than the elements: {}'.format(nproc))
+
+    sfc = CubePartitionSFC(ne, nproc)
+    if capacity is None: capacity = np.ones(nproc)
+    capacity = sfc.check_capacity(capacity).reshape(nnodes, ranks_per_node)
+
+    node_nelems, node_rank, _ = make_cube_rank(method, ne, nnodes,
+            capacity=capacity.sum(axis=1), **kwargs)[:3]
+
+    coords = elem_centers(ne)
+    edge_nbrs = get_cube_adjacency(ne).edge_nbrs
+    flat_node = node_rank.ravel(order='F')
+    flat_rank = np.zeros(flat_node.size, 'i4')
+    nelems = np.zeros(nproc, 'i4')
+    for node in range(nnodes):
+        ranks = slice(node*ranks_per_node, (node+1)*ranks_per_node)
+        nelems[ranks] = CubePartitionSFC(ne, ranks_per_node).capacity_nelems(
+                capacity[node], nelem=node_nelems[node])
+        elems = np.nonzero(flat_node == node)[0]
+        flat_rank[elems] = node*ranks_per_node + \
+                bisect_elems(coords, edge_nbrs, elems, nelems[ranks])
+
+    cube_rank = flat_rank.reshape((ne,ne,6), order='F')
+
+    return nelems, cube_rank, make_cube_lid(cube_rank, nproc)
+
+
+
+
+def node_communication(ne, ngq, cube_rank, ranks_per_node, nproc=None):
+    '''
+    shared points between the ranks in different nodes and in the same node
+    (see CubeGLL.communication_volume()), the node of a rank is
+    rank//ranks_per_node
+
+    return inter_pts, intra_pts, node_pts
+      inter_pts: points sent between the nodes
+      intra_pts: points sent in the nodes
+      node_pts : (nnodes,) points sent by every node to the other nodes
+    Every shared point of a pair of ranks is sent both ways.
+    '''
+    if nproc == None: nproc = int(cube_rank.max()) + 1
+    nnodes = -(-nproc//ranks_per_node)
+
+    _, num_pts, pair_pts = get_cube_gll(ne, ngq).communication_volume(
+            cube_rank, nproc)
+    node_a = pair_pts[0]//ranks_per_node
+    node_b = pair_pts[1]//ranks_per_node
+    inter = node_a != node_b
+
+    inter_pts = 2*int(pair_pts[2,inter].sum())
+    intra_pts = 2*int(pair_pts[2,~inter].sum())
+    node_pts = np.bincount(node_a[inter], weights=pair_pts[2,inter],
+                           minlength=nnodes) \
+             + np.bincount(node_b[inter], weights=pair_pts[2,inter],
+                           minlength=nnodes)
+
+    return inter_pts, intra_pts, node_pts.astype('i8')
+
+
+
+
+def thread_nelems(nelem, nthreads):
+    '''
+    return (nthreads,) elements of every thread, differ by at most one,
+    the first threads take the remainder
+    '''
+    return nelem//nthreads + (np.arange(nthreads) < nelem % nthreads)
+
+
+
+
+def make_cube_thread(ne, cube_rank, nthreads, nproc=None, cube_lid=None):
+    '''
+    split the elements of every rank into nthreads compact threads
+    by recursive bisection, see bisect_elems()
+
+    return (ne,ne,6) thread of every element, 0, ..., nthreads-1 in a rank
+    The elements of a thread are listed by make_elem_coord() at the
+    cube_lid of cube_rank == rank and cube_thread == thread,
+    the nelems of the threads are thread_nelems().
+    A rank keeps the chunks of lid_cube_thread() when the bisection does
+    not cut fewer sides, the cube_lid is make_cube_lid() by default.
+    '''
+    if nthreads < 1:
+        raise ValueError('The nthreads must be positive: {}'.format(nthreads))
+    if nproc == None: nproc = int(cube_rank.max()) + 1
+    if cube_lid is None: cube_lid = make_cube_lid(cube_rank, nproc)
+
+    coords = elem_centers(ne)
+    edge_nbrs = get_cube_adjacency(ne).edge_nbrs
+    flat_rank = cube_rank.ravel(order='F')
+    order = np.argsort(flat_rank, kind='stable')
+    counts = np.bincount(flat_rank, minlength=nproc)
+    flat_thread = lid_cube_thread(cube_rank, cube_lid, nthreads,
+                                  nproc).ravel(order='F')
+    pos = np.zeros(flat_rank.size, 'i8')
+    for elems in np.split(order, np.cumsum(counts)[:-1]):
+        nelems = thread_nelems(elems.size, nthreads)
+        nelems = nelems[nelems > 0]
+        if nelems.size == 1: continue
+
+        # local numbering of the rank, the elements of the other ranks are
+        # the last one, a neighbor of itself only
+        n = elems.size
+        pos[elems] = np.arange(n)
+        nbrs = edge_nbrs[elems]
+        local_nbrs = np.where(flat_rank[nbrs] == flat_rank[elems[0]],
+                              pos[nbrs], n)
+        local_nbrs = np.vstack([local_nbrs, np.full((1,4), n)])
+        local_coords = np.vstack([coords[elems], np.zeros((1,3))])
+        thread = bisect_elems(local_coords, local_nbrs, np.arange(n), nelems)
+
+        # sides between the threads, the sides to the other ranks are not cut
+        inner = local_nbrs[:n] < n
+        cut = lambda t: (inner & (np.append(t, -1)[local_nbrs[:n]]
+                                  != t[:,None])).sum()
+        if cut(thread) < cut(flat_thread[elems]):
+            flat_thread[elems] = thread
+
+    return flat_thread.reshape((ne,ne,6), order='F')
+
+
+
+
+def lid_cube_thread(cube_rank, cube_lid, nthreads, nproc=None):
+    '''
+    the naive split of every rank into nthreads chunks of the cube_lid order,
+    the same nelems of the threads as make_cube_thread()
+
+    return (ne,ne,6) thread of every element
+    '''
+    if nthreads < 1:
+        raise ValueError('The nthreads must be positive: {}'.format(nthreads))
+    if nproc == None: nproc = int(cube_rank.max()) + 1
+
+    nelem = np.bincount(cube_rank.ravel(), minlength=nproc)[cube_rank]
+    q, r = nelem//nthreads, nelem % nthreads
+    i = cube_lid - 1
+    thread = np.where(i < r*(q + 1), i//(q + 1),
+                      r + (i - r*(q + 1))//np.maximum(q, 1))
+
+    return thread.astype('i4')
+
+
+
+
+def thread_cut_sides(ne, cube_rank, cube_thread, nproc=None):
+    '''
+    return (nproc,) element sides between the threads of every rank
+    '''
+    if nproc == None: nproc = int(cube_rank.max()) + 1
+
+    edge_nbrs = get_cube_adjacency(ne).edge_nbrs
+    flat_rank = cube_rank.ravel(order='F')
+    flat_thread = cube_thread.ravel(order='F')
+    cut = (flat_rank[edge_nbrs] == flat_rank[:,None]) & \
+          (flat_thread[edge_nbrs] != flat_thread[:,None])
+
+    # every side is seen from both of its elements
+    return np.bincount(flat_rank, weights=cut.sum(axis=1),
+                       minlength=nproc).astype('i8')//2
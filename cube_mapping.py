@@ -0,0 +1,269 @@
+'''
+
+abstract : topology-aware mapping of the ranks of a partition to the nodes
+
+The ranks are launched in the order of their labels, ranks_per_node on a
+node, so the label of a rank decides its node. The mapper permutes the
+labels to lower the hop-weighted communication volume
+  hop_bytes = sum over the pairs of ranks of bytes(a,b)*hops(node_a,node_b)
+with the exact shared points of CubeGLL.communication_volume(), so it works
+for any cube_rank (SFC, stripe, METIS, ...).
+
+The machine is given by a distance function of two node index arrays,
+returning the hops between the nodes (0 in a node), see
+make_switch_distance(), make_torus_distance(), make_dragonfly_distance().
+
+'''
+
+from __future__ import print_function, division
+import logging
+import numpy as np
+
+from cube_gll import get_cube_gll
+
+
+
+
+def make_switch_distance(nodes_per_group, hops=(2, 4)):
+    '''
+    nodes on switch groups (fat tree), the nodes n*nodes_per_group, ...
+    are in a group
+    hops: (in a group, between the groups)
+    '''
+    def distance(node_a, node_b):
+        same_group = node_a//nodes_per_group == node_b//nodes_per_group
+        return np.where(node_a == node_b, 0,
+                        np.where(same_group, hops[0], hops[1]))
+
+    return distance
+
+
+
+
+def make_torus_distance(dims):
+    '''
+    nodes on a torus of the dims, numbered in the C order of the coordinates,
+    the hops are the shortest ways around every dimension
+    '''
+    dims = np.asarray(dims)
+
+    def distance(node_a, node_b):
+        node_a, node_b = np.broadcast_arrays(node_a, node_b)
+        a = np.array(np.unravel_index(node_a, dims))
+        b = np.array(np.unravel_index(node_b, dims))
+        d = np.abs(a - b)
+        n = dims.reshape((-1,) + (1,)*(d.ndim-1))
+        return np.minimum(d, n - d).sum(axis=0)
+
+    return distance
+
+
+
+
+def make_dragonfly_distance(nodes_per_router, routers_per_group):
+    '''
+    nodes on the routers of the dragonfly groups (all-to-all routers in a
+    group, a global link between the groups), minimal routing
+    hops: 0 in a node, 2 on a router, 3 in a group, 5 between the groups
+    '''
+    def distance(node_a, node_b):
+        router_a, router_b = node_a//nodes_per_router, node_b//nodes_per_router
+        group_a, group_b = router_a//routers_per_group, router_b//routers_per_group
+        return np.select([node_a == node_b, router_a == router_b,
+                          group_a == group_b], [0, 2, 3], 5)
+
+    return distance
+
+
+
+
+def hop_bytes(pair_pts, nodes, distance, point_bytes=8):
+    '''
+    hop-weighted communication bytes of the pairs of ranks
+    pair_pts: (3,npair) (rank_a, rank_b, shared points),
+              see CubeGLL.communication_volume()
+    nodes   : (nproc,) node of every rank
+    '''
+    hops = distance(nodes[pair_pts[0]], nodes[pair_pts[1]])
+
+    return 2*point_bytes*float(np.dot(pair_pts[2], hops))
+
+
+
+
+def group_ranks(pair_pts, nproc, ranks_per_node, max_pass=10):
+    '''
+    groups of ranks_per_node ranks (the last one may be smaller) with the
+    largest volume in the groups
+
+    return (nproc,) group of every rank
+
+    The consecutive labels and the groups grown greedily over the heaviest
+    pairs are tried, the one of the larger volume in the groups is improved
+    by swapping the ranks of two groups while the volume in the groups grows.
+    '''
+    nbrs = [dict() for r in range(nproc)]
+    for a, b, v in pair_pts.T:
+        nbrs[a][b] = nbrs[b][a] = float(v)
+    sizes = [ranks_per_node]*(nproc//ranks_per_node)
+    if nproc % ranks_per_node: sizes.append(nproc % ranks_per_node)
+
+    def intra_volume(group):
+        return sum(v for a, b, v in pair_pts.T if group[a] == group[b])
+
+    #
+    # greedy growing: a group starts from the unassigned rank of the most
+    # volume to the assigned ranks (the lowest label at first) and takes
+    # the rank of the most volume to the group
+    #
+    grown = -np.ones(nproc, 'i4')
+    to_assigned = np.zeros(nproc)
+    for g, size in enumerate(sizes):
+        free = np.nonzero(grown < 0)[0]
+        seed = free[np.argmax(to_assigned[free])]
+        to_group = dict()
+        for k in range(size):
+            grown[seed] = g
+            to_group.pop(seed, None)
+            for s, v in nbrs[seed].items():
+                to_assigned[s] += v
+                if grown[s] < 0: to_group[s] = to_group.get(s, 0) + v
+            if k == size - 1: break
+            if to_group:
+                seed = max(to_group, key=lambda s: (to_group[s], -s))
+            else:
+                free = np.nonzero(grown < 0)[0]
+                seed = free[np.argmax(to_assigned[free])]
+
+    identity = (np.arange(nproc)//ranks_per_node).astype('i4')
+    group = max([identity, grown], key=intra_volume).copy()
+
+    #
+    # swaps of two ranks between the groups
+    #
+    members = [set(np.nonzero(group == g)[0]) for g in range(len(sizes))]
+
+    def volume_to(r, g):
+        return sum(v for s, v in nbrs[r].items() if group[s] == g)
+
+    for pass_ in range(max_pass):
+        swaps = 0
+        for r in range(nproc):
+            a = group[r]
+            to_groups = dict()
+            for s, v in nbrs[r].items():
+                to_groups[group[s]] = to_groups.get(group[s], 0) + v
+            own = to_groups.pop(a, 0)
+
+            best = (0, None)
+            for b, vol_b in to_groups.items():
+                if vol_b <= own: continue
+                for s in members[b]:
+                    gain = vol_b - own + volume_to(s, a) - volume_to(s, b) \
+                         - 2*nbrs[r].get(s, 0)
+                    if gain > best[0]: best = (gain, s)
+            if best[1] is not None:
+                s = best[1]
+                b = group[s]
+                group[r], group[s] = b, a
+                members[a].remove(r); members[a].add(s)
+                members[b].remove(s); members[b].add(r)
+                swaps += 1
+        if swaps == 0: break
+
+    return group
+
+
+
+
+def place_groups(weights, dists, nfree=None, max_swaps=None):
+    '''
+    node of every group with the least sum of weights*dists,
+    steepest descent over the swaps of two groups
+
+    weights: (ngroup,ngroup) symmetric volume between the groups
+    dists  : (ngroup,ngroup) hops between the nodes
+    nfree  : the groups from nfree on stay on their nodes (None: ngroup)
+    return (ngroup,) node of every group, starting from the identity
+    '''
+    n = len(weights)
+    if nfree is None: nfree = n
+    if max_swaps is None: max_swaps = 10*n
+    place = np.arange(n)
+    W = np.asarray(weights, 'f8')
+    Dp = np.asarray(dists, 'f8').copy()  # hops between the nodes of the groups
+    A = np.dot(W, Dp)
+
+    for it in range(max_swaps):
+        # cost change of swapping the nodes of the groups g and h
+        # sum over k (W[g,k] - W[h,k])*(Dp[h,k] - Dp[g,k]), k != g, h
+        diag = np.diag(A)
+        delta = A + A.T - diag[:,None] - diag[None,:] + 2*W*Dp
+        delta[nfree:,:] = 0
+        delta[:,nfree:] = 0
+        g, h = np.unravel_index(np.argmin(delta), delta.shape)
+        if delta[g,h] >= -1e-9*max(1, abs(A).max()): break
+
+        dw = W[:,g] - W[:,h]
+        dd = Dp[h,:] - Dp[g,:]
+        A += np.outer(dw, dd)
+        Dp[[g,h],:] = Dp[[h,g],:]
+        Dp[:,[g,h]] = Dp[:,[h,g]]
+        A[:,[g,h]] = np.dot(W, Dp[:,[g,h]])
+        place[[g,h]] = place[[h,g]]
+
+    return place
+
+
+
+
+def map_ranks(ne, ngq, cube_rank, ranks_per_node, distance, nproc=None,
+              point_bytes=8, max_pass=10):
+    '''
+    permutation of the rank labels for the machine
+
+    return perm, (hop_bytes0, hop_bytes)
+      perm      : (nproc,) new label of every rank, perm[cube_rank] is the
+                  mapped partition (the cube_lid is kept)
+      hop_bytes0: hop-weighted bytes of the labels of cube_rank
+      hop_bytes : hop-weighted bytes of the new labels
+    distance   : hops between two node index arrays (0 in a node)
+    point_bytes: bytes sent per shared point
+
+    The ranks are grouped into the nodes (see group_ranks()), then the
+    groups are placed on the nodes (see place_groups()). The new labels
+    are not worse than the old ones.
+    '''
+    if nproc == None: nproc = int(cube_rank.max()) + 1
+    if ranks_per_node < 1:
+        raise ValueError('The ranks_per_node must be positive: {}'.format(ranks_per_node))
+    pair_pts = get_cube_gll(ne, ngq).communication_volume(cube_rank, nproc)[2]
+
+    nodes0 = np.arange(nproc)//ranks_per_node
+    hop_bytes0 = hop_bytes(pair_pts, nodes0, distance, point_bytes)
+
+    group = group_ranks(pair_pts, nproc, ranks_per_node, max_pass)
+    ngroup = nodes0[-1] + 1
+    weights = np.zeros((ngroup,ngroup))
+    np.add.at(weights, (group[pair_pts[0]], group[pair_pts[1]]), pair_pts[2])
+    weights = weights + weights.T
+    np.fill_diagonal(weights, 0)
+    node_ids = np.arange(ngroup)
+    dists = distance(node_ids[:,None], node_ids[None,:])
+
+    # the partial last group stays on the last node
+    nfree = ngroup if nproc % ranks_per_node == 0 else ngroup - 1
+    place = place_groups(weights, dists, nfree)
+
+    # new labels: the ranks of a group in their order on the node
+    nodes = place[group]
+    order = np.lexsort((np.arange(nproc), nodes))
+    perm = np.zeros(nproc, 'i4')
+    perm[order] = np.arange(nproc)
+
+    new_bytes = hop_bytes(pair_pts, perm//ranks_per_node, distance, point_bytes)
+    if new_bytes > hop_bytes0:
+        perm, new_bytes = np.arange(nproc, dtype='i4'), hop_bytes0
+    logging.info('map_ranks: hop_bytes {} -> {}'.format(hop_bytes0, new_bytes))
+
+    return perm, (hop_bytes0, new_bytes)
@@ -22,6 +22,32 @@ from f90wrap import fmod2py
 
 
 
+so_dpath = join(dirname(abspath(__file__)), 'f90')
+libname = 'libshared'
+modname = 'cube_neighbor'
+func_args = { \
+    'quotient': [('i','i'), 'i'],
+    'init_nbr_panels': [None, None],
+    'convert_rotated_ij': [('i','i','i','i','i1d'), None],
+    'convert_nbr_eij': [('i','i','i','i','i1d'), None],
+    'convert_nbr_gij': [('i','i','i','i','i','i','i','i1d'), None],
+    'convert_nbr_eij_array': [('i','i','i2d','i2d'), None],
+    'convert_nbr_gij_array': [('i','i','i','i2d','i2d'), None]}
+
+
+
+
+def init_cube_neighbor():
+    '''
+    load the cube_neighbor module and initialize the nbr_panels
+    once per process
+    '''
+    return fmod2py(so_dpath, libname, modname, func_args,
+                   init_funcs=['init_nbr_panels'])
+
+
+
+
 class CubeNeighbor(object):
     ''' 
     Wrapper the cube_neighbor.f90 library
@@ -32,20 +58,9 @@ class CubeNeighbor(object):
         
         #
         # Load the library using the numpy ctypeslib
+        # the library is loaded once per process
         #
-        so_dpath = join(dirname(abspath(__file__)), 'f90')
-        libname = 'libshared'
-        modname = 'cube_neighbor'
-        func_args = { \
-            'quotient': [('i','i'), 'i'],
-            'init_nbr_panels': [None, None],
-            'convert_rotated_ij': [('i','i','i','i','i1d'), None],
-            'convert_nbr_eij': [('i','i','i','i','i1d'), None],
-            'convert_nbr_gij': [('i','i','i','i','i','i','i','i1d'), None]}
-
-        self.f90_funcs = fmod2py(so_dpath, libname, modname, func_args)
-
-        self.f90_funcs['init_nbr_panels']()
+        self.f90_funcs = init_cube_neighbor()
 
 
     def quotient(self, n, i):
@@ -69,25 +84,43 @@ class CubeNeighbor(object):
 
 
     def convert_nbr_eij(self, ne, ei, ej, panel):
+        return self.convert_nbr_eij_array(ne, ei, ej, panel)[0]
+
+
+    def convert_nbr_gij(self, ne, ngq, gi, gj, ei, ej, panel):
+        return self.convert_nbr_gij_array(ne, ngq, gi, gj, ei, ej, panel)[0]
+
+
+    def convert_nbr_eij_array(self, ne, ei, ej, panel):
+        '''
+        arguments are broadcasted to (n,) arrays
+        return (n,4): rotated elem (ei, ej, panel, rot)
+        '''
+        eijs = np.array(np.broadcast_arrays(ei, ej, panel), 'i4').reshape(3,-1)
+        n = eijs.shape[1]
+
         ne_p = byref(c_int(ne))
-        ei_p = byref(c_int(ei))
-        ej_p = byref(c_int(ej))
-        p_p  = byref(c_int(panel))
-        ret = np.zeros(4, 'i4')  # rotated elem (ei, ej, panel, rot)
-        self.f90_funcs['convert_nbr_eij'](ne_p, ei_p, ej_p, p_p, ret)
+        n_p = byref(c_int(n))
+        eijs = np.asfortranarray(eijs)
+        ret = np.zeros((n,4), 'i4')
+        self.f90_funcs['convert_nbr_eij_array'](ne_p, n_p, eijs, ret.T)
 
         return ret
 
 
-    def convert_nbr_gij(self, ne, ngq, gi, gj, ei, ej, panel):
+    def convert_nbr_gij_array(self, ne, ngq, gi, gj, ei, ej, panel):
+        '''
+        arguments are broadcasted to (n,) arrays
+        return (n,5): rotated point (gi, gj, ei, ej, panel)
+        '''
+        gijs = np.array(np.broadcast_arrays(gi, gj, ei, ej, panel), 'i4').reshape(5,-1)
+        n = gijs.shape[1]
+
         ne_p = byref(c_int(ne))
         ngq_p = byref(c_int(ngq))
-        gi_p = byref(c_int(gi))
-        gj_p = byref(c_int(gj))
-        ei_p = byref(c_int(ei))
-        ej_p = byref(c_int(ej))
-        p_p  = byref(c_int(panel))
-        ret = np.zeros(5, 'i4')  # rotated point (gi, gj, ei, ej, panel)
-        self.f90_funcs['convert_nbr_gij'](ne_p, ngq_p, gi_p, gj_p, ei_p, ej_p, p_p, ret)
+        n_p = byref(c_int(n))
+        gijs = np.asfortranarray(gijs)
+        ret = np.zeros((n,5), 'i4')
+        self.f90_funcs['convert_nbr_gij_array'](ne_p, ngq_p, n_p, gijs, ret.T)
 
         return ret
@@ -0,0 +1,212 @@
+'''
+
+abstract : run many partitions concurrently in a thread pool
+
+The f90 kernels are reentrant after the module tables are initialized
+(done once per process by fmod2py) and ctypes releases the GIL
+during the calls, so the partitions run in parallel in one process.
+
+'''
+
+from __future__ import print_function, division
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import logging
+
+from cube_adjacency import get_cube_adjacency
+from cube_partition_sfc import CubePartitionSFC
+from cube_partition_stripe import CubePartitionStripe, unfoldings
+
+
+
+
+partition_classes = {
+        'sfc': CubePartitionSFC,
+        'stripe': CubePartitionStripe}
+
+_executor = None
+_executor_lock = threading.Lock()
+_local = threading.local()  # workspaces of the stripe partitioning per thread
+
+
+
+
+def get_executor(max_workers=None):
+    '''
+    return the process-wide thread pool, created at the first call
+    '''
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    return _executor
+
+
+
+
+def shutdown(wait=True):
+    '''
+    shut down the process-wide thread pool, a new one is made by the next call
+    '''
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
+
+
+
+
+def make_cube_rank(method, ne, nproc, **kwargs):
+    '''
+    return nelems, cube_rank, cube_lid of the method ('sfc' or 'stripe')
+    the stripe workspace is reused over the calls in a thread
+    kwargs: options of CubePartitionStripe.make_cube_rank() (nbands, budget, ...)
+    '''
+    if method not in partition_classes:
+        raise ValueError('The method must be one of {}: {}'.format(sorted(partition_classes), method))
+
+    obj = partition_classes[method](ne, nproc)
+    if method != 'stripe':
+        return obj.make_cube_rank(**kwargs)
+
+    workspaces = getattr(_local, 'workspaces', None)
+    if workspaces is None:
+        workspaces = _local.workspaces = dict()
+    if ne not in workspaces:
+        workspaces[ne] = obj.make_workspace()
+
+    return obj.make_cube_rank(workspace=workspaces[ne], **kwargs)
+
+
+
+
+def submit(method, ne, nproc, executor=None):
+    '''
+    partition in the thread pool
+
+    return a concurrent.futures.Future of (nelems, cube_rank, cube_lid)
+    '''
+    if method not in partition_classes:
+        raise ValueError('The method must be one of {}: {}'.format(sorted(partition_classes), method))
+
+    if executor is None: executor = get_executor()
+
+    return executor.submit(make_cube_rank, method, ne, nproc)
+
+
+
+
+def partition_metrics(ne, nproc, cube_rank, ngq=None):
+    '''
+    return a dict of the perimeter ratio (and the communication ratio with ngq)
+    of a partition, the adjacency tables are shared over the calls
+    '''
+    obj = CubePartitionStripe(ne, nproc)
+    adj = get_cube_adjacency(ne)
+
+    metrics = dict()
+    metrics['perimeter_ratio'], metrics['num_nbrs'] = \
+            obj.global_perimeter_ratio(cube_rank, adj)
+    if ngq is not None:
+        metrics['comm_ratio'], metrics['num_pts'] = \
+                obj.global_communication_ratio(ngq, cube_rank, adj)
+
+    return metrics
+
+
+
+
+def sweep_one(method, ne, nproc, ngq=None):
+    '''
+    return nproc, (nelems, cube_rank, cube_lid), metrics
+    '''
+    ret = make_cube_rank(method, ne, nproc)
+
+    return nproc, ret, partition_metrics(ne, nproc, ret[1], ngq)
+
+
+
+
+def sweep(method, ne, nprocs, ngq=None, executor=None, max_pending=64,
+          max_ratio=None):
+    '''
+    partition for every nproc in nprocs in the thread pool
+
+    yield nproc, (nelems, cube_rank, cube_lid), metrics in the order of nprocs
+    metrics: see partition_metrics()
+    max_ratio: perimeter ratio of a known partition, the nproc whose
+               CubePartitionStripe.perimeter_ratio_bound() is not below it
+               can not give a better partition and is skipped (not yielded)
+
+    The workspace and the adjacency tables are made once per thread and ne.
+    At most max_pending partitions are kept in flight,
+    so a long sweep streams in bounded memory.
+    '''
+    if method not in partition_classes:
+        raise ValueError('The method must be one of {}: {}'.format(sorted(partition_classes), method))
+
+    if executor is None: executor = get_executor()
+
+    get_cube_adjacency(ne)  # built once before the workers share it
+
+    pending = deque()
+    for nproc in nprocs:
+        if max_ratio is not None and \
+                CubePartitionStripe(ne, nproc).perimeter_ratio_bound() >= max_ratio:
+            continue
+        pending.append(executor.submit(sweep_one, method, ne, nproc, ngq))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+
+
+def unfolding_one(ne, nproc, unfolding, ngq=None, nbands=2, budget=None):
+    '''
+    return (nelems, cube_rank, cube_lid), metrics of a stripe unfolding
+    '''
+    ret = make_cube_rank('stripe', ne, nproc, nbands=nbands, budget=budget,
+                         unfolding=unfolding)
+
+    return ret, partition_metrics(ne, nproc, ret[1], ngq)
+
+
+
+
+def search_unfoldings(ne, nproc, ngq=None, nbands=2, budget=None,
+                      executor=None):
+    '''
+    stripe partitions of every unfolding in the thread pool
+
+    return (nelems, cube_rank, cube_lid), candidates
+    candidates: [(unfolding, metrics), ...] in the order of unfoldings
+                metrics: see partition_metrics()
+    nbands, budget: see CubePartitionStripe.make_cube_rank()
+
+    The cube_rank of every unfolding is in the canonical panel coordinates.
+    The partition of the lowest perimeter ratio is returned,
+    the lower unfolding wins a tie (0: the make_cube_rank() default).
+    '''
+    if executor is None: executor = get_executor()
+
+    get_cube_adjacency(ne)  # built once before the workers share it
+
+    futures = [executor.submit(unfolding_one, ne, nproc, unfolding, ngq,
+                               nbands, budget)
+               for unfolding in unfoldings]
+    results = [f.result() for f in futures]
+
+    best = min(range(len(unfoldings)),
+               key=lambda k: (results[k][1]['perimeter_ratio'], k))
+    candidates = [(unfolding, metrics)
+                  for unfolding, (ret, metrics) in zip(unfoldings, results)]
+
+    return results[best][0], candidates
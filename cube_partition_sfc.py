@@ -10,11 +10,32 @@ history :
 
 from __future__ import print_function, division
 from os.path import dirname, abspath, join
-from ctypes import c_int, byref
+from ctypes import c_int, c_double, byref
 import logging
 import numpy as np
 
-from f90wrap import fmod2py
+from f90wrap import fmod2py, out_array
+
+
+
+
+so_dpath = join(dirname(abspath(__file__)), 'f90')
+libname = 'libshared'
+modname = 'cube_partition_sfc'
+func_args = { \
+    'rot': [('i','i','i2d','i2d'), None],
+    'inv_x': [('i','i2d','i2d'), None],
+    'inv_y': [('i','i2d','i2d'), None],
+    'init_sfcs': [None, None],
+    'make_sfcs': [('i3d','i3d','i3d'), None],
+    'find_size_factors': [('i',), 'i'],
+    'find_factors': [('i','i','i','i1d'), None],
+    'make_panel_sfc': [('i','i','i2d'), None],
+    'make_global_sfc': [('i','i','i3d'), None],
+    'make_cube_rank': [('i','i','i1d','i3d','i3d'), None],
+    'make_cube_rank_capacity': [('i','i','f1d','i1d','i3d','i3d'), None],
+    'capacity_nelems': [('i','i','f1d','i1d'), None],
+    'make_elem_coord': [('i','i','i','i3d','i3d','i2d'), None]}
 
 
 
@@ -30,23 +51,10 @@ class CubePartitionSFC(object):
 
         #
         # Load the library using the numpy ctypeslib
+        # the library is loaded and the SFC tables are made once per process
         #
-        so_dpath = join(dirname(abspath(__file__)), 'f90')
-        libname = 'libshared'
-        modname = 'cube_partition_sfc'
-        func_args = { \
-            'rot': [('i','i','i2d','i2d'), None],
-            'inv_x': [('i','i2d','i2d'), None],
-            'inv_y': [('i','i2d','i2d'), None],
-            'make_sfcs': [('i3d','i3d','i3d'), None],
-            'find_size_factors': [('i',), 'i'],
-            'find_factors': [('i','i','i','i1d'), None],
-            'make_panel_sfc': [('i','i','i2d'), None],
-            'make_global_sfc': [('i','i','i3d'), None],
-            'make_cube_rank': [('i','i','i1d','i3d','i3d'), None],
-            'make_elem_coord': [('i','i','i','i3d','i3d','i2d'), None]}
-
-        self.f90_funcs = fmod2py(so_dpath, libname, modname, func_args)
+        self.f90_funcs = fmod2py(so_dpath, libname, modname, func_args,
+                                 init_funcs=['init_sfcs'])
 
 
     def rot(self, num_rot, arr):
@@ -124,29 +132,70 @@ class CubePartitionSFC(object):
         return ret
 
 
-    def make_cube_rank(self):
+    def check_capacity(self, capacity):
+        capacity = np.asarray(capacity, 'f8')
+        if capacity.shape != (self.nproc,):
+            raise ValueError('The capacity must be of shape {}: {}'.format((self.nproc,), capacity.shape))
+        if not np.all(np.isfinite(capacity) & (capacity > 0)):
+            raise ValueError('The capacity must be finite and positive')
+
+        return capacity
+
+
+    def capacity_nelems(self, capacity, nelem=None):
+        '''
+        nelems in proportion to the capacity by the largest remainders,
+        at least one element in every rank
+        nelem: total elements (None: the elements of the cube)
+        '''
+        nproc = self.nproc
+        if nelem is None: nelem = 6*self.ne*self.ne
+        capacity = self.check_capacity(capacity)
+        if nelem < nproc:
+            raise ValueError('The nelem must be at least the nproc: {}'.format(nelem))
+
+        nelems = np.zeros(nproc, 'i4')
+        self.f90_funcs['capacity_nelems'](
+                byref(c_int(nelem)), byref(c_int(nproc)), capacity, nelems)
+
+        return nelems
+
+
+    def make_cube_rank(self, out=None, capacity=None):
+        '''
+        out     : (nelems, cube_rank, cube_lid) buffers to be overwritten
+        capacity: (nproc,) positive relative speeds of the ranks (None: the
+                  same speeds), the nelems follow capacity_nelems()
+        '''
         ne = self.ne
         nproc = self.nproc
         ne_p = byref(c_int(ne))
         nproc_p = byref(c_int(nproc))
-        nelems = np.zeros(nproc, 'i4', order='F')
-        cube_rank = np.zeros((ne,ne,6), 'i4', order='F')
-        cube_lid = np.zeros((ne,ne,6), 'i4', order='F')
-        self.f90_funcs['make_cube_rank'](ne_p, nproc_p, nelems, cube_rank, cube_lid)
+        if out is None: out = (None, None, None)
+        nelems = out_array(out[0], nproc)
+        cube_rank = out_array(out[1], (ne,ne,6))
+        cube_lid = out_array(out[2], (ne,ne,6))
+        if capacity is None:
+            self.f90_funcs['make_cube_rank'](ne_p, nproc_p, nelems, cube_rank, cube_lid)
+        else:
+            capacity = self.check_capacity(capacity)
+            self.f90_funcs['make_cube_rank_capacity'](
+                    ne_p, nproc_p, capacity, nelems, cube_rank, cube_lid)
 
         return nelems, cube_rank, cube_lid
 
 
-    def make_elem_coord(self, iproc, nelem, cube_rank, cube_lid):
+    def make_elem_coord(self, iproc, nelem, cube_rank, cube_lid, out=None):
         '''
         return (ei,ej,panel)x(nelem)
+        out: (3,nelem) buffer to be overwritten
         '''
         ne = self.ne
 
         ne_p = byref(c_int(ne))
         iproc_p = byref(c_int(iproc))
         nelem_p = byref(c_int(nelem))
-        elem_coord = np.zeros((3,nelem), 'i4', order='F')
+        elem_coord = out_array(out, (3,nelem))
         self.f90_funcs['make_elem_coord'](ne_p, iproc_p, nelem_p, cube_rank, cube_lid, elem_coord)
 
         return elem_coord
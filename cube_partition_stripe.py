@@ -9,12 +9,44 @@ history :
 
 from __future__ import print_function, division
 from os.path import dirname, abspath, join
-from ctypes import c_int, byref
+from ctypes import c_int, c_double, byref
 import logging
 import numpy as np
 
-from f90wrap import fmod2py
-from cube_neighbor import CubeNeighbor
+from f90wrap import fmod2py, out_array
+from cube_adjacency import get_cube_adjacency
+from cube_neighbor import init_cube_neighbor
+
+
+
+
+so_dpath = join(dirname(abspath(__file__)), 'f90')
+libname = 'libshared'
+modname = 'cube_partition_stripe'
+func_args = { \
+    'calc_perimeter_ratio': [('i','i','i','i','i','i1d','i1d','i2d'), 'f'],
+    'calc_band_objective': [('i','i','i','i','i','i1d','i1d','i1d','i2d'), 'f'],
+    'band_ratio_bound': [('i','i','i','i1d'), 'f'],
+    'cube_ratio_bound': [('i','i'), 'f'],
+    'find_optimal_band': [('i','i','i','i','i','i1d','i1d','i2d','i1d'), None],
+    'band_work_size': [('i',), 'i'],
+    'band_partition': [('i','i','i1d','i3d'), None],
+    'band_partition_ws': [('i','i','i','f','i','i1d','i1d','i1d','i3d'), None],
+    'make_cube_rank': [('i','i','i1d','i3d','i3d'), None],
+    'make_cube_rank_ws': [('i','i','i','f','i','i1d','i1d','i1d','i3d','i3d'), None],
+    'make_cube_rank_capacity': [('i','i','i','f','i','i1d','f1d','i2d','i2d','i1d','i1d','i3d','i3d'), None],
+    'make_cube_rank_weighted': [('i','i','i','f','i','i1d','f1d','f3d','f','i2d','i2d','i1d','i1d','f1d','i3d','i3d'), None],
+    'refine_rank_times': [('i','i','i','f1d','f1d','i2d','i2d','i3d','i1d','i3d','f1d'), None],
+    'global_perimeter_ratio': [('i','i','i3d','i2d'), 'f'],
+    'global_communication_ratio': [('i','i','i','i3d','i2d'), 'f'],
+    'global_neighbor_count': [('i','i','i3d','i1d'), 'f'],
+    'make_cube_color': [('i','i','i3d','i3d'), None],
+    'global_perimeter_ratio_adj': [('i','i','i2d','i3d','i2d'), 'f'],
+    'global_communication_ratio_adj': [('i','i','i','i2d','i2d','i3d','i2d'), 'f'],
+    'make_cube_color_adj': [('i','i','i2d','i2d','i3d','i3d'), None]}
+
+unfoldings = (0, 1, 2, 3)  # the symmetry-distinct routes of the bands
+objectives = ('perimeter', 'comm', 'max_comm', 'nbrs')  # of the band search
 
 
 
@@ -30,22 +62,11 @@ class CubePartitionStripe(object):
 
         #
         # Load the library using the numpy ctypeslib
+        # the library is loaded once per process
         #
-        so_dpath = join(dirname(abspath(__file__)), 'f90')
-        libname = 'libshared'
-        modname = 'cube_partition_stripe'
-        func_args = { \
-            'calc_perimeter_ratio': [('i','i','i','i','i','i1d','i1d','i2d'), 'f'],
-            'find_optimal_band': [('i','i','i','i','i','i1d','i2d','i1d'), None],
-            'band_partition': [('i','i','i1d','i3d'), None],
-            'make_cube_rank': [('i','i','i1d','i3d','i3d'), None],
-            'global_perimeter_ratio': [('i','i','i3d','i2d'), 'f'],
-            'global_communication_ratio': [('i','i','i','i3d','i2d'), 'f'],
-            'make_cube_color': [('i','i','i3d','i3d'), None]}
-
         self.f90_funcs = fmod2py(so_dpath, libname, modname, func_args)
 
-        CubeNeighbor() # to initialize the cube_neighbor module
+        init_cube_neighbor()  # to initialize the cube_neighbor module
 
 
     def calc_perimeter_ratio(self, start_rank, end_rank, nelems, i12, box):
@@ -63,7 +84,48 @@ class CubePartitionStripe(object):
         return perimeter_ratio
 
 
-    def find_optimal_band(self, start_rank, start_i, nelems, box):
+    def calc_band_objective(self, start_rank, end_rank, nelems, i12, box,
+                            objective='perimeter', ngq=4, max_nbrs=None):
+        '''
+        calc_perimeter_ratio() with the objective, see make_objective()
+        '''
+        nproc = self.nproc
+        nx, ny = box.shape
+
+        to_i = lambda x: byref(c_int(x))
+
+        return self.f90_funcs['calc_band_objective'](
+                to_i(nx), to_i(ny), to_i(nproc), to_i(start_rank), to_i(end_rank),
+                nelems, self.make_objective(objective, ngq, max_nbrs), i12, box)
+
+
+    def band_ratio_bound(self, ny, width, nelems):
+        '''
+        lower bound of calc_perimeter_ratio() for the ranks of nelems
+        in a band of width columns and ny rows
+        '''
+        to_i = lambda x: byref(c_int(x))
+
+        nelems = np.ascontiguousarray(nelems, 'i4')
+        if width < 1 or nelems.size < 1 or nelems.min() < 1:
+            raise ValueError('The width and the nelems must be positive: {} {}'.format(width, nelems))
+
+        return self.f90_funcs['band_ratio_bound'](
+                to_i(ny), to_i(width), to_i(nelems.size), nelems)
+
+
+    def perimeter_ratio_bound(self):
+        '''
+        lower bound of global_perimeter_ratio() for any partition
+        with the nelems of make_cube_rank()
+        '''
+        to_i = lambda x: byref(c_int(x))
+
+        return self.f90_funcs['cube_ratio_bound'](to_i(self.ne), to_i(self.nproc))
+
+
+    def find_optimal_band(self, start_rank, start_i, nelems, box,
+                          objective='perimeter', ngq=4, max_nbrs=None):
         nx, ny = box.shape
         nproc = nelems.size
 
@@ -72,75 +134,342 @@ class CubePartitionStripe(object):
         ret = np.zeros(2, 'i4')
         self.f90_funcs['find_optimal_band'](
                 to_i(nx), to_i(ny), to_i(nproc), to_i(start_rank), to_i(start_i),
-                nelems, box, ret)
+                nelems, self.make_objective(objective, ngq, max_nbrs), box, ret)
 
         return ret[0], ret[1]  # (rank, i2)
 
 
-    def band_partition(self, nelems):
+    def make_workspace(self):
+        '''
+        scratch array of the band partitioning to reuse over the calls
+        with the same ne
+        '''
+        ne_p = byref(c_int(self.ne))
+
+        return np.zeros(self.f90_funcs['band_work_size'](ne_p), 'i4')
+
+
+    def check_workspace(self, workspace):
+        ne_p = byref(c_int(self.ne))
+        size = self.f90_funcs['band_work_size'](ne_p)
+        if workspace.dtype != np.int32 or workspace.ndim != 1 or \
+                workspace.size < size:
+            raise ValueError('The workspace must be an int32 array of size {}: {} {}'.format(size, workspace.shape, workspace.dtype))
+
+
+    def check_nbands(self, nbands):
+        if nbands < 2:
+            raise ValueError('The nbands must be at least 2: {}'.format(nbands))
+
+
+    def check_unfolding(self, unfolding):
+        if unfolding not in unfoldings:
+            raise ValueError('The unfolding must be one of {}: {}'.format(unfoldings, unfolding))
+
+
+    def check_capacity(self, capacity):
+        capacity = np.asarray(capacity, 'f8')
+        if capacity.shape != (self.nproc,):
+            raise ValueError('The capacity must be of shape {}: {}'.format((self.nproc,), capacity.shape))
+        if not np.all(np.isfinite(capacity) & (capacity > 0)):
+            raise ValueError('The capacity must be finite and positive')
+
+        return capacity
+
+
+    def make_objective(self, objective='perimeter', ngq=4, max_nbrs=None):
+        '''
+        objective of the band search, one of objectives
+          perimeter - mean foreign sides/elements of the ranks
+          comm      - mean communication/computation points of the ranks
+                      with ngq points on an element side, as
+                      global_communication_ratio()
+          max_comm  - maximum of comm over the ranks
+          nbrs      - mean number of the different neighbor ranks,
+                      a band is not taken if a rank has more than max_nbrs
+                      (None: no cap), the first rank of a band is not capped
+        '''
+        if objective not in objectives:
+            raise ValueError('The objective must be one of {}: {}'.format(objectives, objective))
+        if ngq < 2:
+            raise ValueError('The ngq must be at least 2: {}'.format(ngq))
+        if max_nbrs is not None and max_nbrs < 1:
+            raise ValueError('The max_nbrs must be positive: {}'.format(max_nbrs))
+
+        return np.array([objectives.index(objective), ngq, max_nbrs or 0], 'i4')
+
+
+    def band_partition(self, nelems, out=None, workspace=None, nbands=2,
+                       budget=None, unfolding=0, objective='perimeter', ngq=4,
+                       max_nbrs=None):
+        '''
+        out      : (ne,ne,6) buffer of the cube_rank
+        workspace: from make_workspace()
+        nbands   : number of the last bands to rearrange
+        budget   : seconds for the optimal band splits (None: greedy)
+        unfolding: route of the bands, see make_cube_rank()
+        objective: of the band search with ngq and max_nbrs,
+                   see make_objective()
+        '''
         ne = self.ne
         nproc = self.nproc
 
         to_i = lambda x: byref(c_int(x))
+        to_f = lambda x: byref(c_double(x))
 
-        cube_rank = np.zeros((ne,ne,6), 'i4', order='F')
-        self.f90_funcs['band_partition'](
-                to_i(ne), to_i(nproc), nelems, cube_rank)
+        self.check_nbands(nbands)
+        self.check_unfolding(unfolding)
+        obj = self.make_objective(objective, ngq, max_nbrs)
+        cube_rank = out_array(out, (ne,ne,6))
+        if workspace is None and nbands == 2 and budget is None \
+                and unfolding == 0 and objective == 'perimeter':
+            self.f90_funcs['band_partition'](
+                    to_i(ne), to_i(nproc), nelems, cube_rank)
+        else:
+            if workspace is None: workspace = self.make_workspace()
+            self.check_workspace(workspace)
+            self.f90_funcs['band_partition_ws'](
+                    to_i(ne), to_i(nproc), to_i(nbands), to_f(budget or 0),
+                    to_i(unfolding), obj, nelems, workspace, cube_rank)
+        if cube_rank[0,0,0] == -1:
+            raise ValueError('The bands can not go on with the nelems: {}'.format(nelems))
 
         return cube_rank
 
 
-    def make_cube_rank(self):
+    def make_cube_rank(self, out=None, workspace=None, nbands=2, budget=None,
+                       unfolding=0, objective='perimeter', ngq=4, max_nbrs=None,
+                       weights=None, tol=0.01, capacity=None):
+        '''
+        out      : (nelems, cube_rank, cube_lid) buffers to be overwritten,
+                   and rank_weights with the weights
+        workspace: from make_workspace()
+        nbands   : number of the last bands to rearrange,
+                   nbands > 2 searches the best splits of the last nbands bands
+                   in O(nrank**2) band evaluations (nrank: ranks of the bands)
+        budget   : seconds for the optimal band splits of every panel
+                   by dynamic programming, the panels left at the deadline
+                   keep the greedy bands (None: greedy)
+        unfolding: route of the bands over the cube, one of unfoldings
+                   bit 0 - the bands of the first panel in the mirror image
+                   bit 1 - the ranks in the reverse order along the route
+                   The cube_rank is returned in the canonical panel
+                   coordinates with the same nelems for any unfolding.
+        objective: minimized by the band search and the rearrangement of
+                   the last bands with ngq and max_nbrs, see make_objective(),
+                   the ranks left in pieces by the objectives other than
+                   'perimeter' are connected again with the nelems kept
+        weights  : (ne,ne,6) positive element weights (None: the same weights),
+                   the nelems are cut again along the route of the bands
+                   toward the equal summed weights of the ranks and the
+                   boundary elements of the heavy ranks are then moved to
+                   the lighter neighbor ranks, until the maximum weight is
+                   within tol of the mean or no move lowers it. The budget
+                   is run once with the balanced nelems. The rank_weights
+                   (nproc,) are returned in addition, nproc <= 3 keeps the
+                   whole panels.
+        tol      : relative excess of the maximum rank weight over the mean
+        capacity : (nproc,) positive relative speeds of the ranks (None: the
+                   same speeds), the nelems are in proportion to the capacity
+                   by the largest remainders (at least one element in every
+                   rank) and go to the bands as they are, the ranks left
+                   in pieces are connected again with the nelems kept,
+                   the nproc <= 3 ranks take the whole panels in proportion. With the
+                   weights, the times rank_weights/capacity are balanced.
+        '''
         ne = self.ne
         nproc = self.nproc
 
         to_i = lambda x: byref(c_int(x))
+        to_f = lambda x: byref(c_double(x))
 
-        nelems = np.zeros(nproc, 'i4')
-        cube_rank = np.zeros((ne,ne,6), 'i4', order='F')
-        cube_lid = np.zeros((ne,ne,6), 'i4', order='F')
-        self.f90_funcs['make_cube_rank'](
-                to_i(ne), to_i(nproc), nelems, cube_rank, cube_lid)
+        self.check_nbands(nbands)
+        self.check_unfolding(unfolding)
+        obj = self.make_objective(objective, ngq, max_nbrs)
+        if out is None: out = (None, None, None)
+        nelems = out_array(out[0], nproc)
+        cube_rank = out_array(out[1], (ne,ne,6))
+        cube_lid = out_array(out[2], (ne,ne,6))
+        if capacity is not None: capacity = self.check_capacity(capacity)
+        if weights is not None:
+            weights = np.asarray(weights, 'f8')
+            if weights.shape != (ne,ne,6):
+                raise ValueError('The weights must be of shape {}: {}'.format((ne,ne,6), weights.shape))
+            if not np.all(np.isfinite(weights) & (weights > 0)):
+                raise ValueError('The weights must be finite and positive')
+            if tol < 0:
+                raise ValueError('The tol must not be negative: {}'.format(tol))
+
+            rank_weights = out_array(out[3] if len(out) > 3 else None, nproc, 'f8')
+            if workspace is None: workspace = self.make_workspace()
+            self.check_workspace(workspace)
+            if capacity is None: capacity = np.ones(nproc, 'f8')
+            adj = get_cube_adjacency(ne)
+            self.f90_funcs['make_cube_rank_weighted'](
+                    to_i(ne), to_i(nproc), to_i(nbands), to_f(budget or 0),
+                    to_i(unfolding), obj, capacity, np.asfortranarray(weights),
+                    to_f(tol), adj.edge_nbrs.T, adj.corner_nbrs.T, workspace,
+                    nelems, rank_weights, cube_rank, cube_lid)
+            if cube_rank[0,0,0] == -1:
+                raise ValueError('The bands can not go on with the nelems: {}'.format(nelems))
+
+            return nelems, cube_rank, cube_lid, rank_weights
+
+        if workspace is None and nbands == 2 and budget is None \
+                and unfolding == 0 and objective == 'perimeter' \
+                and capacity is None:
+            self.f90_funcs['make_cube_rank'](
+                    to_i(ne), to_i(nproc), nelems, cube_rank, cube_lid)
+        elif capacity is not None or objective != 'perimeter':
+            if workspace is None: workspace = self.make_workspace()
+            self.check_workspace(workspace)
+            if capacity is None: capacity = np.ones(nproc, 'f8')
+            adj = get_cube_adjacency(ne)
+            self.f90_funcs['make_cube_rank_capacity'](
+                    to_i(ne), to_i(nproc), to_i(nbands), to_f(budget or 0),
+                    to_i(unfolding), obj, capacity, adj.edge_nbrs.T,
+                    adj.corner_nbrs.T, workspace, nelems, cube_rank, cube_lid)
+            if cube_rank[0,0,0] == -1:
+                raise ValueError('The bands can not go on or the ranks can not be connected with the nelems: {}'.format(nelems))
+        else:
+            if workspace is None: workspace = self.make_workspace()
+            self.check_workspace(workspace)
+            self.f90_funcs['make_cube_rank_ws'](
+                    to_i(ne), to_i(nproc), to_i(nbands), to_f(budget or 0),
+                    to_i(unfolding), obj, workspace, nelems, cube_rank, cube_lid)
+        if cube_rank[0,0,0] == -1:
+            raise ValueError('The bands can not go on with the nelems: {}'.format(nelems))
 
         return nelems, cube_rank, cube_lid
 
 
-    def global_perimeter_ratio(self, cube_rank):
+    def refine_rank_times(self, cube_rank, costs, ngq=4, capacity=None,
+                          adjacency=None, out=None):
+        '''
+        move the boundary elements of the slow ranks to the neighbor ranks
+        with the predicted time of a rank
+          elem_cost*nelems/capacity + point_cost*comm_pts + msg_cost*num_msgs
+        comm_pts and num_msgs as global_communication_ratio() with ngq and
+        global_neighbor_count(), see cube_cost.py
+
+        cube_rank: partition of any method, not changed
+        costs    : (elem_cost, point_cost, msg_cost)
+        capacity : (nproc,) relative speeds of the ranks (None: the same speeds)
+        adjacency: CubeAdjacency of the ne (None: get_cube_adjacency())
+        out      : (nelems, cube_rank, cube_lid, times) buffers to be overwritten
+
+        return nelems, cube_rank, cube_lid, times
+        The maximum time never goes up and the ranks stay connected.
+        The partition of the lowest max/mean time ratio over the passes is
+        returned, so the ratio never goes up either.
+        '''
         ne = self.ne
         nproc = self.nproc
 
         to_i = lambda x: byref(c_int(x))
 
-        num_nbrs = np.zeros((2,nproc), 'i4', order='F')
-        perimeter_ratio = self.f90_funcs['global_perimeter_ratio'](
-                to_i(ne), to_i(nproc), cube_rank, num_nbrs)
+        costs = np.asarray(costs, 'f8')
+        if costs.shape != (3,) or not np.all(np.isfinite(costs) & (costs >= 0)) \
+                or costs[0] <= 0:
+            raise ValueError('The costs must be (elem_cost > 0, point_cost >= 0, msg_cost >= 0): {}'.format(costs))
+        if capacity is None: capacity = np.ones(nproc)
+        capacity = self.check_capacity(capacity)
+        if out is None: out = (None, None, None, None)
+        nelems = out_array(out[0], nproc)
+        new_rank = out_array(out[1], (ne,ne,6))
+        cube_lid = out_array(out[2], (ne,ne,6))
+        times = out_array(out[3], nproc, 'f8')
+        if adjacency is None: adjacency = get_cube_adjacency(ne)
+        new_rank[:] = cube_rank
+        self.f90_funcs['refine_rank_times'](
+                to_i(ne), to_i(ngq), to_i(nproc), costs, capacity,
+                adjacency.edge_nbrs.T, adjacency.corner_nbrs.T, new_rank,
+                nelems, cube_lid, times)
+
+        return nelems, new_rank, cube_lid, times
+
+
+    def global_perimeter_ratio(self, cube_rank, adjacency=None, out=None):
+        '''
+        adjacency: CubeAdjacency to skip the neighbor search
+        out      : output buffer to be overwritten
+        '''
+        ne = self.ne
+        nproc = self.nproc
+
+        to_i = lambda x: byref(c_int(x))
+
+        num_nbrs = out_array(out, (2,nproc))
+        if adjacency is None:
+            perimeter_ratio = self.f90_funcs['global_perimeter_ratio'](
+                    to_i(ne), to_i(nproc), cube_rank, num_nbrs)
+        else:
+            perimeter_ratio = self.f90_funcs['global_perimeter_ratio_adj'](
+                    to_i(ne), to_i(nproc), adjacency.edge_nbrs.T,
+                    cube_rank, num_nbrs)
 
         return perimeter_ratio, num_nbrs
 
 
 
-    def global_communication_ratio(self, ngq, cube_rank):
+    def global_communication_ratio(self, ngq, cube_rank, adjacency=None, out=None):
+        '''
+        adjacency: CubeAdjacency to skip the neighbor search
+        out      : output buffer to be overwritten
+        '''
         ne = self.ne
         nproc = self.nproc
 
         to_i = lambda x: byref(c_int(x))
 
-        num_pts = np.zeros((2,nproc), 'i4', order='F')
-        comm_ratio = self.f90_funcs['global_communication_ratio'](
-                to_i(ne), to_i(ngq), to_i(nproc), cube_rank, num_pts)
+        num_pts = out_array(out, (2,nproc))
+        if adjacency is None:
+            comm_ratio = self.f90_funcs['global_communication_ratio'](
+                    to_i(ne), to_i(ngq), to_i(nproc), cube_rank, num_pts)
+        else:
+            comm_ratio = self.f90_funcs['global_communication_ratio_adj'](
+                    to_i(ne), to_i(ngq), to_i(nproc), adjacency.edge_nbrs.T,
+                    adjacency.corner_nbrs.T, cube_rank, num_pts)
 
         return comm_ratio, num_pts
 
 
 
-    def make_cube_color(self, cube_rank):
+    def global_neighbor_count(self, cube_rank, out=None):
+        '''
+        mean number of the different neighbor ranks
+        out      : output buffer to be overwritten
+        '''
+        ne = self.ne
+        nproc = self.nproc
+
+        to_i = lambda x: byref(c_int(x))
+
+        num_nbrs = out_array(out, nproc)
+        mean_nbrs = self.f90_funcs['global_neighbor_count'](
+                to_i(ne), to_i(nproc), cube_rank, num_nbrs)
+
+        return mean_nbrs, num_nbrs
+
+
+
+    def make_cube_color(self, cube_rank, adjacency=None, out=None):
+        '''
+        adjacency: CubeAdjacency to skip the neighbor search
+        out      : output buffer to be overwritten
+        '''
         ne = self.ne
         nproc = self.nproc
 
         to_i = lambda x: byref(c_int(x))
 
-        cube_color = np.zeros((ne,ne,6), 'i4', order='F')
-        perimeter_ratio = self.f90_funcs['make_cube_color'](
-                to_i(ne), to_i(nproc), cube_rank, cube_color)
+        cube_color = out_array(out, (ne,ne,6))
+        if adjacency is None:
+            self.f90_funcs['make_cube_color'](
+                    to_i(ne), to_i(nproc), cube_rank, cube_color)
+        else:
+            self.f90_funcs['make_cube_color_adj'](
+                    to_i(ne), to_i(nproc), adjacency.edge_nbrs.T,
+                    adjacency.corner_nbrs.T, cube_rank, cube_color)
 
         return cube_color
@@ -0,0 +1,81 @@
+'''
+
+abstract : wrapper to cube_threads.f90
+           number of the OpenMP threads of the f90 kernels
+
+'''
+
+from __future__ import print_function, division
+from os.path import dirname, abspath, join
+from contextlib import contextmanager
+from ctypes import c_int, byref
+import logging
+
+from f90wrap import fmod2py
+
+
+
+
+so_dpath = join(dirname(abspath(__file__)), 'f90')
+libname = 'libshared'
+modname = 'cube_threads'
+func_args = { \
+    'openmp_enabled': [(), 'i'],
+    'set_num_threads': [('i',), None],
+    'get_num_threads': [(), 'i']}
+
+_num_threads = None  # the session setting, None is the OpenMP default
+
+
+
+
+def openmp_enabled():
+    '''
+    True if the library is compiled with OpenMP
+    '''
+    f90_funcs = fmod2py(so_dpath, libname, modname, func_args)
+
+    return bool(f90_funcs['openmp_enabled']())
+
+
+
+
+def set_num_threads(n):
+    '''
+    set the number of threads of the parallel kernels for the session
+    n=None or n<=0 restores the OpenMP default (OMP_NUM_THREADS)
+    '''
+    global _num_threads
+
+    f90_funcs = fmod2py(so_dpath, libname, modname, func_args)
+    f90_funcs['set_num_threads'](byref(c_int(n if n != None else 0)))
+    _num_threads = n if (n != None and n > 0) else None
+
+
+
+
+def get_num_threads():
+    '''
+    number of threads of the parallel kernels
+    '''
+    f90_funcs = fmod2py(so_dpath, libname, modname, func_args)
+
+    return f90_funcs['get_num_threads']()
+
+
+
+
+@contextmanager
+def num_threads(n):
+    '''
+    number of threads for the calls in the with-block
+
+    The setting is shared by the process, do not nest the blocks
+    with the different numbers in concurrent Python threads.
+    '''
+    prev = _num_threads
+    set_num_threads(n)
+    try:
+        yield
+    finally:
+        set_num_threads(prev)
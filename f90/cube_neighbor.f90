@@ -24,6 +24,8 @@
    public :: convert_rotated_ij
    public :: convert_nbr_eij
    public :: convert_nbr_gij
+   public :: convert_nbr_eij_array
+   public :: convert_nbr_gij_array
 !
    contains
 !-------------------------------------------------------------------------------
@@ -226,6 +228,57 @@
 !-------------------------------------------------------------------------------
 !
 !
+!-------------------------------------------------------------------------------
+   subroutine convert_nbr_eij_array(ne, n, eijs, ret)
+!-------------------------------------------------------------------------------
+! convert_nbr_eij() over an array of elements
+! input : (ei+a, ej+b, panel) x (n)
+! return: (ei2, ej2, panel2, rotation) x (n)
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer,                 intent(in   ) :: ne, n
+   integer, dimension(3,n), intent(in   ) :: eijs
+   integer, dimension(4,n), intent(  out) :: ret
+!
+   integer :: k
+!-------------------------------------------------------------------------------
+!
+   do k=1,n
+     call convert_nbr_eij(ne, eijs(1,k), eijs(2,k), eijs(3,k), ret(:,k))
+   end do
+!
+   end subroutine convert_nbr_eij_array
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine convert_nbr_gij_array(ne, np, n, gijs, ret)
+!-------------------------------------------------------------------------------
+! convert_nbr_gij() over an array of points
+! input : (gi+a, gj+b, ei, ej, panel) x (n)
+! return: (gi2, gj2, ei2, ej2, panel2) x (n)
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer,                 intent(in   ) :: ne, np, n
+   integer, dimension(5,n), intent(in   ) :: gijs
+   integer, dimension(5,n), intent(  out) :: ret
+!
+   integer :: k
+!-------------------------------------------------------------------------------
+!
+   do k=1,n
+     call convert_nbr_gij(ne, np, gijs(1,k), gijs(2,k),                        &
+         gijs(3,k), gijs(4,k), gijs(5,k), ret(:,k))
+   end do
+!
+   end subroutine convert_nbr_gij_array
+!-------------------------------------------------------------------------------
+!
+!
 !-------------------------------------------------------------------------------
 end module cube_neighbor
 !-------------------------------------------------------------------------------
@@ -10,7 +10,12 @@
 !   2017-05-17  ki-hwan kim  bug fix the intervals in make_cube_rank()
 !   2017-06-16  ki-hwan kim  add make_elem_coord()
 !
+! The module tables are written only by init_sfcs(), the other routines
+! keep their state in the arguments so that they can run in threads.
+!
 !-------------------------------------------------------------------------------
+!
+   use cube_threads, only : get_num_threads, min_omp_work
 !
    implicit none
 !
@@ -19,6 +24,7 @@
    integer, dimension(2,2,4), target  :: hilbert
    integer, dimension(3,3,4), target  :: peano
    integer, dimension(5,5,4), target  :: cinco
+   logical                            :: sfcs_initialized = .false.
 !
    type sfc_t
      integer                            :: p
@@ -29,12 +35,16 @@
 ! subroutines
 !
    public :: rot, inv_x, inv_y
+   public :: init_sfcs
    public :: make_sfcs
    public :: find_size_factors
    public :: find_factors
    public :: make_panel_sfc
    public :: make_global_sfc
    public :: make_cube_rank
+   public :: make_cube_rank_nelems
+   public :: make_cube_rank_capacity
+   public :: capacity_nelems
    public :: make_elem_coord
 !
    contains
@@ -131,6 +141,24 @@
 !-------------------------------------------------------------------------------
 !
 !
+!-------------------------------------------------------------------------------
+   subroutine init_sfcs()
+!-------------------------------------------------------------------------------
+! make the module tables of the space-filling curves and direction vectors
+! they are read-only after the initialization
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!-------------------------------------------------------------------------------
+!
+   call make_sfcs(hilbert, peano, cinco)
+   call make_direction_vector_table(direction_vector_table)
+   sfcs_initialized = .true.
+!
+   end subroutine init_sfcs
+!-------------------------------------------------------------------------------
+!
+!
 !-------------------------------------------------------------------------------
    subroutine make_sfcs(hilbert, peano, cinco)
 !-------------------------------------------------------------------------------
@@ -209,7 +237,7 @@
 !
    integer :: n, p, i
    integer :: size_factors
-   integer, dimension(3) :: prime_numbers = (/2,3,5/)
+   integer, dimension(3), parameter :: prime_numbers = (/2,3,5/)
 !-------------------------------------------------------------------------------
 !
    n = ne
@@ -364,12 +392,13 @@
    integer,     dimension(nlev), intent(inout) :: prev_nbrs, next_nbrs
    integer,     dimension(nlev), intent(inout) :: dvs
 !
-   integer :: next_nbr=-1, prev_nbr
+   integer :: next_nbr, prev_nbr  ! no implicit save, reentrant
    integer :: uplev_size
    integer, dimension(4) :: next2prev
    integer, dimension(2) :: ij1, ij2, dij
 !-------------------------------------------------------------------------------
 !
+   next_nbr = -1
    uplev_size = curves(lev+1)%p * curves(lev+1)%p
 !
    if (uplev_seq .eq. uplev_size) then
@@ -438,8 +467,7 @@
    allocate(intervals(nlev))
    allocate(curves(nlev))
 
-   call make_sfcs(hilbert, peano, cinco)
-   call make_direction_vector_table(direction_vector_table)
+   if (.not. sfcs_initialized) call init_sfcs()
    call find_factors(ne, nproc, nlev, factors)
 !
    dvs(:) = 1        ! direction vector index
@@ -571,48 +599,217 @@
    integer, dimension(ne,ne,6), intent(  out) :: cube_rank
    integer, dimension(ne,ne,6), intent(  out) :: cube_lid
 !
-   integer :: i, ei, ej, p
-   integer :: remain_nelem, gid, proc
-   integer, dimension(nproc)   :: lids
-   integer, dimension(nproc+1) :: accum_nelems
-   integer, dimension(ne,ne,6) :: global_elem_id
+   integer :: i
+   integer :: remain_nelem
 !-------------------------------------------------------------------------------
-!
-   call make_global_sfc(ne, nproc, global_elem_id)
 !
    remain_nelem = mod(ne*ne*6, nproc)
    do i=1,nproc
      nelems(i) = ne*ne*6/nproc
      if (i .le. remain_nelem) nelems(i) = nelems(i) + 1
    end do
+!
+   call make_cube_rank_nelems(ne, nproc, nelems, cube_rank, cube_lid)
+!
+   end subroutine make_cube_rank
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine make_cube_rank_capacity(ne, nproc, capacity, nelems, cube_rank,  &
+       cube_lid)
+!-------------------------------------------------------------------------------
+! make_cube_rank() with the nelems in proportion to the capacity of the ranks
+! (relative speeds), see capacity_nelems()
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer,                     intent(in   ) :: ne, nproc
+   real(8), dimension(nproc),   intent(in   ) :: capacity
+   integer, dimension(nproc),   intent(  out) :: nelems
+   integer, dimension(ne,ne,6), intent(  out) :: cube_rank
+   integer, dimension(ne,ne,6), intent(  out) :: cube_lid
+!-------------------------------------------------------------------------------
+!
+   call capacity_nelems(ne*ne*6, nproc, capacity, nelems)
+   call make_cube_rank_nelems(ne, nproc, nelems, cube_rank, cube_lid)
+!
+   end subroutine make_cube_rank_capacity
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine make_cube_rank_nelems(ne, nproc, nelems, cube_rank, cube_lid)
+!-------------------------------------------------------------------------------
+! assign the process numbers to elements on the cubed-sphere
+! along the space-filling curves with the given nelems
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer,                     intent(in   ) :: ne, nproc
+   integer, dimension(nproc),   intent(in   ) :: nelems
+   integer, dimension(ne,ne,6), intent(  out) :: cube_rank
+   integer, dimension(ne,ne,6), intent(  out) :: cube_lid
+!
+   integer :: i, ei, ej, p
+   integer :: gid, proc
+   integer :: lo, hi, mid
+   integer, dimension(nproc)   :: lids
+   integer, dimension(nproc+1) :: accum_nelems
+   integer, dimension(ne,ne,6) :: global_elem_id
+!-------------------------------------------------------------------------------
+!
+   call make_global_sfc(ne, nproc, global_elem_id)
 !
    accum_nelems(1) = 0
    do i=2,nproc+1
      accum_nelems(i) = accum_nelems(i-1) + nelems(i-1)
    end do
 !
-   lids(:) = 1
 !
+! the rank of an element is the last proc with accum_nelems(proc) < gid
+!
+!$omp parallel do collapse(2) private(ei, gid, lo, hi, mid)                   &
+!$omp   num_threads(get_num_threads()) if(6*ne*ne .ge. min_omp_work)
    do p=1,6
      do ej=1,ne
        do ei=1,ne
          gid = global_elem_id(ei,ej,p)
 !
-         do proc=1,nproc
-           if ((gid .gt. accum_nelems(proc)) .and. &
-               (gid .le. accum_nelems(proc+1))) then
-             cube_rank(ei,ej,p) = proc-1
-             cube_lid(ei,ej,p) = lids(proc)
-             lids(proc) = lids(proc) + 1
-             exit
+         lo = 1
+         hi = nproc
+         do while (lo .lt. hi)
+           mid = (lo + hi + 1)/2
+           if (accum_nelems(mid) .lt. gid) then
+             lo = mid
+           else
+             hi = mid - 1
            end if
          end do
+         cube_rank(ei,ej,p) = lo-1
+       end do
+     end do
+   end do
+!$omp end parallel do
 !
+   lids(:) = 1
+!
+   do p=1,6
+     do ej=1,ne
+       do ei=1,ne
+         proc = cube_rank(ei,ej,p) + 1
+         cube_lid(ei,ej,p) = lids(proc)
+         lids(proc) = lids(proc) + 1
        end do
      end do
    end do
 !
-   end subroutine make_cube_rank
+   end subroutine make_cube_rank_nelems
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine capacity_nelems(nelem, nproc, capacity, nelems)
+!-------------------------------------------------------------------------------
+! split the nelem elements in proportion to the capacity of the ranks
+! by the largest remainders, at least one element in every rank
+!
+! The floors of the shares (at least one) are raised by one in the order of
+! the largest remainders, the first ranks first in a tie, so the same
+! capacities give the nelems of make_cube_rank(). The ranks raised to one
+! element are paid by the ranks of the smallest remainders.
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer,                   intent(in   ) :: nelem, nproc
+   real(8), dimension(nproc), intent(in   ) :: capacity
+   integer, dimension(nproc), intent(  out) :: nelems
+!
+   integer :: i, k, remain
+   real(8), dimension(nproc) :: share
+   integer, dimension(nproc) :: order
+!-------------------------------------------------------------------------------
+!
+   if (nproc .gt. nelem) stop 'nproc is greater than the number of elements'
+   share(:) = nelem*(capacity(:)/sum(capacity))
+   do i=1,nproc
+     nelems(i) = max(int(share(i)), 1)
+   end do
+   remain = nelem - sum(nelems)
+!
+   call sort_index(nproc, nelems - share, order)
+   k = 0
+   do while (remain .gt. 0)
+     k = k + 1
+     nelems(order(k)) = nelems(order(k)) + 1
+     remain = remain - 1
+   end do
+!
+   k = nproc + 1
+   do while (remain .lt. 0)
+     k = k - 1
+     if (k .eq. 0) k = nproc
+     if (nelems(order(k)) .gt. 1) then
+       nelems(order(k)) = nelems(order(k)) - 1
+       remain = remain + 1
+     end if
+   end do
+!
+   end subroutine capacity_nelems
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine sort_index(n, keys, order)
+!-------------------------------------------------------------------------------
+! the indices of the keys in the ascending order, stable (merge sort)
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer,               intent(in   ) :: n
+   real(8), dimension(n), intent(in   ) :: keys
+   integer, dimension(n), intent(  out) :: order
+!
+   integer :: i, j, k, lo, mid, hi, width
+   integer, dimension(n) :: tmp
+!-------------------------------------------------------------------------------
+!
+   do i=1,n
+     order(i) = i
+   end do
+!
+   width = 1
+   do while (width .lt. n)
+     do lo=1,n,2*width
+       mid = min(lo+width-1, n)
+       hi = min(lo+2*width-1, n)
+       i = lo
+       j = mid + 1
+       do k=lo,hi
+         if (j.gt.hi) then
+           tmp(k) = order(i)
+           i = i + 1
+         else if (i.gt.mid) then
+           tmp(k) = order(j)
+           j = j + 1
+         else if (keys(order(j)) .lt. keys(order(i))) then
+           tmp(k) = order(j)
+           j = j + 1
+         else
+           tmp(k) = order(i)
+           i = i + 1
+         end if
+       end do
+     end do
+     order(:) = tmp(:)
+     width = 2*width
+   end do
+!
+   end subroutine sort_index
 !-------------------------------------------------------------------------------
 !
 !
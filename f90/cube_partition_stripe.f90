@@ -10,20 +10,46 @@
 !-------------------------------------------------------------------------------
 !
    use cube_neighbor, only : convert_nbr_eij
+   use cube_partition_sfc, only : capacity_nelems
+   use cube_threads,  only : get_num_threads, min_omp_work
+   use iso_c_binding, only : c_loc, c_f_pointer
+   use iso_fortran_env, only : int16, int64
 !
    implicit none
    logical, parameter :: debug=.false.
+   real(8), parameter :: bound_tol=1.D-12  ! rounding of the bound comparisons
+!
+   ! kinds of the band objective(3): (kind, np, max_nbrs)
+   integer, parameter :: obj_perimeter=0  ! mean foreign sides/elements
+   integer, parameter :: obj_comm=1       ! mean communication/computation
+   integer, parameter :: obj_max_comm=2   ! maximum over the ranks of obj_comm
+   integer, parameter :: obj_nbrs=3       ! mean neighbor ranks, max_nbrs cap
+   integer, parameter :: perimeter_objective(3)=(/obj_perimeter, 0, 0/)
 !
    private
 !
    public :: calc_perimeter_ratio
+   public :: calc_band_objective
+   public :: band_ratio_bound
+   public :: cube_ratio_bound
    public :: find_optimal_band
+   public :: find_optimal_band_ws
+   public :: band_work_size
    public :: band_partition
+   public :: band_partition_ws
    public :: make_cube_rank
+   public :: make_cube_rank_ws
+   public :: make_cube_rank_capacity
+   public :: make_cube_rank_weighted
+   public :: refine_rank_times
    public :: make_elem_coord
    public :: global_perimeter_ratio
    public :: global_communication_ratio
+   public :: global_neighbor_count
    public :: make_cube_color
+   public :: global_perimeter_ratio_adj
+   public :: global_communication_ratio_adj
+   public :: make_cube_color_adj
 !
    contains
 !-------------------------------------------------------------------------------
@@ -43,15 +69,39 @@
    integer, intent(inout) :: i12(4)  ! (i1, i2, band_elem, remain_elem)
    integer, intent(inout) :: box(nx,ny)
    real(8) :: mean_perimeter_ratio
+!-------------------------------------------------------------------------------
 !
-   integer :: i, j, k
-   integer :: i1, i2, j1, j2
-   integer :: seq
-   integer :: rank, myrank
+   mean_perimeter_ratio = calc_band_objective(nx, ny, nproc,                   &
+       start_rank, end_rank, nelems, perimeter_objective, i12, box)
+!
+   end function calc_perimeter_ratio
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function calc_band_objective(nx, ny, nproc,                                 &
+       start_rank, end_rank, nelems, objective, i12, box) result(ratio)
+!-------------------------------------------------------------------------------
+! fill the band of start_rank~end_rank and evaluate it with the objective
+! -1 if the band does not fit in the box or a rank of the band has
+! more neighbor ranks than the max_nbrs (obj_nbrs, more than one rank),
+! the maximum (4 for obj_perimeter) for a single-column band before nx
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: start_rank  ! start from zero
+   integer, intent(in   ) :: end_rank
+   integer, intent(in   ) :: nelems(0:nproc-1)
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(inout) :: i12(4)  ! (i1, i2, band_elem, remain_elem)
+   integer, intent(inout) :: box(nx,ny)
+   real(8) :: ratio
+!
+   integer :: i1, i2
    integer :: band_elem, required_elem, remain_elem
-   integer :: same_sides
-   integer :: num_nbrs(2,end_rank-start_rank+1)
-   real(8) :: sum_perimeter_ratio
+   real(8), allocatable :: vals(:)
 !-------------------------------------------------------------------------------
 !
 ! determine the i2: band interval
@@ -76,453 +126,3557 @@
 ! exit condition
 !
    if (i2.eq.nx .and. required_elem.gt.band_elem) then
-     mean_perimeter_ratio = -1.D0
+     ratio = -1.D0
      if (debug) print *, 'i2 exceeded the nx (exit)'
 !
    else if (i2.ne.nx .and. i1.eq.i2) then
-     mean_perimeter_ratio = 4.D0
+     ratio = max_objective(objective)
      if (debug) print *, 'i1=i2 single-line band (exit)'
 !
    else
      remain_elem = band_elem - required_elem
-     if (remain_elem .ne. 0) then
-       do j=ny,1,-1
-         if (box(i2,j) .eq. -1) exit
-       end do
-       j2 = j
-       j1 = j - remain_elem + 1
-       box(i2,j1:j2) = -3  ! temporary mask
-     end if
      if (debug) print *, 'remain_elem', remain_elem
 !
-     !
-     ! partitioning in the band
-     !
-     rank = start_rank
-     seq = 1
-     do j=1,ny
-       do i=i2,i1,-1
-         if (box(i,j) .eq. -1) then
-           box(i,j) = rank
-           if (seq .eq. nelems(rank)) then
-             rank = rank + 1
-             seq = 1
-           else
-             seq = seq + 1
-           end if
-         else if (box(i,j) .eq. -3) then
-           box(i,j) = -1
-         end if
-       end do
-     end do 
-     if (rank-1 .ne. end_rank) stop 'The rank is greater than the end_rank in calc_perimeter_ratio()'
+     call fill_band(nx, ny, nproc, start_rank, end_rank, nelems,              &
+         i1, i2, remain_elem, box)
 !
      ! 
-     ! compare the perimeter ratio
+     ! compare the objective
      ! 
-     num_nbrs(:,:) = 0
-     do j=1,ny
-       do i=i1,i2
-         myrank = box(i,j)
-         same_sides = 0  ! contact with an element having the same rank number
-!
-         if (myrank.ge.start_rank .and. myrank.le.end_rank) then
-           if (i .gt. 1) then
-             if (box(i-1,j) .eq. myrank) same_sides = same_sides + 1
-           end if
-           if (i .lt. nx) then
-             if (box(i+1,j) .eq. myrank) same_sides = same_sides + 1
-           end if
-           if (j .gt. 1) then
-             if (box(i,j-1) .eq. myrank) same_sides = same_sides + 1
-           end if
-           if (j .lt. ny) then
-             if (box(i,j+1) .eq. myrank) same_sides = same_sides + 1
-           end if
+     if (objective(1) .eq. obj_perimeter) then
+       ratio = band_ratio(nx, ny, start_rank, end_rank, i1, i2, box)
+     else
+       allocate(vals(start_rank:end_rank))
+       call rank_values(nx, ny, start_rank, end_rank, i1, i2, 1, objective,   &
+           box, vals)
+       ratio = objective_value(objective, end_rank-start_rank+1, vals)
+       if (over_cap(objective, end_rank-start_rank+1, vals)) ratio = -1.D0
+       deallocate(vals)
+     end if
+     i12(:) = (/i1, i2, band_elem, remain_elem/)
+!
+   end if
+!
+   end function calc_band_objective
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function band_ratio(nx, ny, start_rank, end_rank, i1, i2, box)             &
+       result(mean_perimeter_ratio)
+!-------------------------------------------------------------------------------
+! mean perimeter ratio of the ranks start_rank~end_rank in the columns i1~i2
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: start_rank, end_rank
+   integer, intent(in   ) :: i1, i2
+   integer, intent(in   ) :: box(nx,ny)
+   real(8) :: mean_perimeter_ratio
+!
+   integer :: i, j, k
+   integer :: myrank
+   integer :: same_sides
+   integer, allocatable :: num_nbrs(:,:)
+   real(8) :: sum_perimeter_ratio
+!-------------------------------------------------------------------------------
+!
+   allocate(num_nbrs(2,end_rank-start_rank+1))
+   num_nbrs(:,:) = 0
+!$omp parallel do private(i, k, myrank, same_sides) reduction(+:num_nbrs)     &
+!$omp   num_threads(get_num_threads()) if((i2-i1+1)*ny .ge. min_omp_work)
+   do j=1,ny
+     do i=i1,i2
+       myrank = box(i,j)
+       same_sides = 0  ! contact with an element having the same rank number
+!
+       if (myrank.ge.start_rank .and. myrank.le.end_rank) then
+         if (i .gt. 1) then
+           if (box(i-1,j) .eq. myrank) same_sides = same_sides + 1
+         end if
+         if (i .lt. nx) then
+           if (box(i+1,j) .eq. myrank) same_sides = same_sides + 1
+         end if
+         if (j .gt. 1) then
+           if (box(i,j-1) .eq. myrank) same_sides = same_sides + 1
+         end if
+         if (j .lt. ny) then
+           if (box(i,j+1) .eq. myrank) same_sides = same_sides + 1
+         end if
 !
          k = myrank - start_rank + 1
          num_nbrs(1,k) = num_nbrs(1,k) + 1
          num_nbrs(2,k) = num_nbrs(2,k) + 4 - same_sides 
-         end if
-       end do
+       end if
      end do
-     sum_perimeter_ratio = sum(num_nbrs(2,:)*1.D0/num_nbrs(1,:))
-     mean_perimeter_ratio = sum_perimeter_ratio/(end_rank-start_rank+1)
-     i12(:) = (/i1, i2, band_elem, remain_elem/)
-!
-   end if
+   end do
+!$omp end parallel do
+   sum_perimeter_ratio = sum(num_nbrs(2,:)*1.D0/num_nbrs(1,:))
+   deallocate(num_nbrs)
+   mean_perimeter_ratio = sum_perimeter_ratio/(end_rank-start_rank+1)
 !
-   end function calc_perimeter_ratio
+   end function band_ratio
 !-------------------------------------------------------------------------------
 !
 !
 !-------------------------------------------------------------------------------
-   subroutine find_optimal_band(nx, ny, nproc, start_rank, start_i, nelems,    &
-       box, ret)
+   function band_objective(nx, ny, start_rank, end_rank, i1, i2, objective,   &
+       box) result(ratio)
 !-------------------------------------------------------------------------------
-! find the optimal band partitioning with minimum perimeter ratio
+! objective of the ranks start_rank~end_rank in the columns i1~i2
+! without the cap of the neighbor ranks
 !-------------------------------------------------------------------------------
    implicit none
 !
    integer, intent(in   ) :: nx, ny
-   integer, intent(in   ) :: nproc
-   integer, intent(in   ) :: start_rank  ! start from zero
-   integer, intent(in   ) :: start_i
-   integer, intent(in   ) :: nelems(0:nproc-1)
-   integer, intent(inout) :: box(nx,ny)
-   integer, intent(  out) :: ret(2)  ! (rank, i2)
+   integer, intent(in   ) :: start_rank, end_rank
+   integer, intent(in   ) :: i1, i2
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(in   ) :: box(nx,ny)
+   real(8) :: ratio
 !
-   integer :: end_rank
-   integer :: next_i2
-   real(8) :: perimeter_ratio, prev_perimeter_ratio
-   integer :: tmp_box(nx,ny), prev_box(nx,ny)
-   integer :: i12(4), prev_i12(4)  ! (i1, i2, band_elem, remain_elem)
+   real(8), allocatable :: vals(:)
 !-------------------------------------------------------------------------------
 !
-   i12(:) = (/start_i, start_i, count(box(start_i,:) .eq. -1), -1/)
-   end_rank = start_rank !+ int(i12(3)/nelems(start_rank))
-   prev_perimeter_ratio = 4.D0  ! max perimeter ratio
-   prev_i12(:) = i12(:)
-   prev_box(:,:) = box(:,:)
+   if (objective(1) .eq. obj_perimeter) then
+     ratio = band_ratio(nx, ny, start_rank, end_rank, i1, i2, box)
+   else
+     allocate(vals(start_rank:end_rank))
+     call rank_values(nx, ny, start_rank, end_rank, i1, i2, 1, objective,     &
+         box, vals)
+     ratio = objective_value(objective, end_rank-start_rank+1, vals)
+     deallocate(vals)
+   end if
 !
-   search_loop: do
-     if (debug) print *, ''
-     tmp_box(:,:) = box(:,:)
-     perimeter_ratio = calc_perimeter_ratio(                                   &
-         nx, ny, nproc, start_rank, end_rank, nelems, i12, tmp_box) 
-     if (debug) print *, 'preimeter_ratio', prev_perimeter_ratio, perimeter_ratio
+   end function band_objective
+!-------------------------------------------------------------------------------
 !
-     if (perimeter_ratio .lt. 0.D0 .or.                                        &
-         perimeter_ratio .gt. prev_perimeter_ratio) then
-       box(:,:) = prev_box(:,:)
-       exit search_loop
 !
-     else
-       prev_perimeter_ratio = perimeter_ratio
-       end_rank = end_rank + 1
-       prev_i12(:) = i12(:)
+!-------------------------------------------------------------------------------
+   subroutine rank_values(nx, ny, first_rank, end_rank, i1, i2, j1,            &
+       objective, box, vals)
+!-------------------------------------------------------------------------------
+! objective of every rank first_rank~end_rank in the columns i1~i2
+! from the row j1, all the elements of the ranks are in these rows
+!   obj_comm, obj_max_comm: np points for every foreign side and one point
+!                           for every foreign corner over np*np points
+!                           of every element, as global_communication_ratio()
+!   obj_nbrs              : number of the different neighbor ranks in the
+!                           eight directions, the free elements as one rank
+! The sides and the corners outside the box are foreign.
+!-------------------------------------------------------------------------------
+   implicit none
 !
-       if (end_rank .eq. nproc) then
-         box(:,:) = tmp_box(:,:)
-         exit search_loop
-       else
-         prev_box(:,:) = tmp_box(:,:)
-       end if
-     end if
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: first_rank, end_rank
+   integer, intent(in   ) :: i1, i2, j1
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(in   ) :: box(nx,ny)
+   real(8), intent(  out) :: vals(first_rank:end_rank)
+!
+   integer, parameter :: max_nbr=20  ! empirical, as make_cube_color()
+   integer :: i, j, k, a, b, np
+   integer :: myrank, nbr_rank
+   integer, allocatable :: num_pts(:,:)      ! (3,first_rank:end_rank)
+                                             ! (elems, sides, corners)
+   integer, allocatable :: rank_links(:,:)   ! (max_nbr,first_rank:end_rank)
+!-------------------------------------------------------------------------------
 !
-   end do search_loop
-   if (debug) print *, '---------- end search_loop ----------'
+   np = objective(2)
+   allocate(num_pts(3,first_rank:end_rank))
+   allocate(rank_links(max_nbr,first_rank:end_rank))
+   num_pts(:,:) = 0
+   rank_links(:,:) = -2
+!
+   do j=j1,ny
+     do i=i1,i2
+       myrank = box(i,j)
+       if (myrank.lt.first_rank .or. myrank.gt.end_rank) cycle
+       num_pts(1,myrank) = num_pts(1,myrank) + 1
+!
+       do b=-1,1
+         do a=-1,1
+           if (a.eq.0 .and. b.eq.0) cycle
+           nbr_rank = -2  ! outside the box
+           if (i+a.ge.1 .and. i+a.le.nx .and. j+b.ge.1 .and. j+b.le.ny)       &
+             nbr_rank = box(i+a,j+b)
+           if (nbr_rank .eq. myrank) cycle
+!
+           if (a.eq.0 .or. b.eq.0) then
+             num_pts(2,myrank) = num_pts(2,myrank) + 1
+           else
+             num_pts(3,myrank) = num_pts(3,myrank) + 1
+           end if
 !
-   next_i2 = prev_i12(2)
-   if (prev_i12(4) .eq. 0) next_i2 = next_i2 + 1
-   ret(:) = (/end_rank, next_i2/)
+           if (objective(1).eq.obj_nbrs .and. nbr_rank.ge.-1) then
+             do k=1,max_nbr
+               if (rank_links(k,myrank) .eq. nbr_rank) exit
+               if (rank_links(k,myrank) .eq. -2) then
+                 rank_links(k,myrank) = nbr_rank
+                 exit
+               end if
+             end do
+           end if
+         end do
+       end do
+     end do
+   end do
 !
-   if (debug) print *, '(rank,i2)', ret
+   if (objective(1) .eq. obj_nbrs) then
+     do k=first_rank,end_rank
+       vals(k) = count(rank_links(:,k) .ne. -2)
+     end do
+   else
+     do k=first_rank,end_rank
+       vals(k) = (np*num_pts(2,k) + num_pts(3,k))*1.D0/(np*np*num_pts(1,k))
+     end do
+   end if
+   deallocate(num_pts, rank_links)
 !
-   end subroutine find_optimal_band
+   end subroutine rank_values
 !-------------------------------------------------------------------------------
 !
 !
 !-------------------------------------------------------------------------------
-   subroutine band_partition(ne, nproc, nelems, cube_rank)
+   function objective_value(objective, nrank, vals) result(ratio)
 !-------------------------------------------------------------------------------
-! assign the rank number to elements on the cubed-sphere
-! band partitioning the cubed-sphere
-! Caution: The nproc must be greater than 3.
+! the maximum of the rank values for obj_max_comm, the mean for the others
 !-------------------------------------------------------------------------------
    implicit none
 !
-   integer, intent(in   ) :: ne, nproc
-   integer, intent(in   ) :: nelems(nproc)
-   integer, intent(  out) :: cube_rank(ne,ne,6)
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(in   ) :: nrank
+   real(8), intent(in   ) :: vals(nrank)
+   real(8) :: ratio
+!-------------------------------------------------------------------------------
 !
-   integer :: i, j, k
-   integer :: start_rank, start_i
-   integer :: prev_start_rank, prev_start_i
-   integer :: box2(2*ne,ne), tmp_box2(2*ne,ne)
-   integer :: box4(2*ne,2*ne)
-   integer :: ret(2)  ! (rank, i2)
+   if (objective(1) .eq. obj_max_comm) then
+     ratio = maxval(vals)
+   else
+     ratio = sum(vals)/nrank
+   end if
 !
-   integer :: num_block
-   integer :: band1_start_rank, band2_start_rank
-   integer :: box(ne,ne), tmp_box(ne,ne)
-   integer :: nelem1, nelem2
-   integer :: i12(4)  ! (i1, i2, band_elem, remain_elem)
-   real(8) :: ratio1, ratio2
-   real(8), allocatable :: ratios(:)
-   integer, allocatable :: boxes(:,:,:)
+   end function objective_value
 !-------------------------------------------------------------------------------
-!
-   box4(ne+1:2*ne,ne+1:2*ne) = -2  ! permanant mask
 !
 !
-! panel 6
+!-------------------------------------------------------------------------------
+   function over_cap(objective, nrank, vals) result(over)
+!-------------------------------------------------------------------------------
+! a band of more than one rank has a rank over the max_nbrs (> 0) of obj_nbrs
+!-------------------------------------------------------------------------------
+   implicit none
 !
-   box2(:,:) = -1
-   tmp_box2(:,:) = -1
-   start_rank = 0
-   start_i = 1
-   do 
-     prev_start_rank = start_rank
-     prev_start_i = start_i
-     call find_optimal_band(2*ne, ne, nproc, start_rank, start_i, nelems,      &
-         box2, ret)
-     start_rank = ret(1)
-     start_i = ret(2)
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(in   ) :: nrank
+   real(8), intent(in   ) :: vals(nrank)
+   logical :: over
+!-------------------------------------------------------------------------------
 !
-     if (start_i .gt. ne) then
-       if (count(box2(ne+1:2*ne,:).ne.-1) .gt.                                 &
-           count(tmp_box2(1:ne,:).eq.-1)) then
-         do j=1,2*ne
-           do i=1,ne
-             box4(i,j) = tmp_box2(2*ne-j+1,i)
-           end do
-         end do
-         start_rank = prev_start_rank
-         start_i = prev_start_i
-       else
-         do j=1,2*ne
-           do i=1,ne
-             box4(i,j) = box2(2*ne-j+1,i)
-           end do
-         end do
-       end if
-       exit
-     else
-       tmp_box2(:,:) = box2(:,:)
-     end if
-   end do
-   if (debug) print *, '========== end panel 6 =========='
+   over = .false.
+   if (objective(1).eq.obj_nbrs .and. objective(3).gt.0 .and. nrank.gt.1)    &
+     over = maxval(vals) .gt. objective(3)
 !
+   end function over_cap
+!-------------------------------------------------------------------------------
 !
-! panel 1
 !
-   box4(ne+1:2*ne,1:ne) = -1 ! candidate mask
-   start_i = 1
-   do
-     call find_optimal_band(2*ne, 2*ne, nproc, start_rank, start_i, nelems,    &
-         box4, ret)
-     start_rank = ret(1)
-     start_i = ret(2)
+!-------------------------------------------------------------------------------
+   subroutine band_split(nx, ny, i1, i2, j1, rank1, rank2, box, split)
+!-------------------------------------------------------------------------------
+! the ranks rank1~rank2 filled in the band i1~i2 from the row j1 in
+! pieces through the sides of the box
 !
-     if (start_i .gt. ne) then
-       box2(1:ne,:) = box4(ne+1:2*ne,1:ne)
-       cube_rank(:,:,6) = box4(1:ne,ne+1:2*ne)
-       cube_rank(:,:,1) = box4(1:ne,1:ne)
-       exit
-     end if
-   end do
-   if (debug) print *, '========== end panel 1 =========='
+! A rank of one run of elements in every row of consecutive rows with the
+! runs overlapping is connected, as the row-by-row fill mostly makes it.
+! The other ranks are filled through the sides.
+!-------------------------------------------------------------------------------
+   implicit none
 !
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: i1, i2, j1
+   integer, intent(in   ) :: rank1, rank2
+   integer, intent(in   ) :: box(nx,ny)
+   logical, intent(  out) :: split(rank1:rank2)
+!
+   integer :: i, j, a, b, rank, top, nfill
+   integer, allocatable :: counts(:), seed(:,:), stack(:,:)
+   integer, allocatable :: row_run(:,:)   ! (row, lo, hi, elems) of the row
+   integer, allocatable :: prev_run(:,:)  ! (row, lo, hi) of the row before
+   logical, allocatable :: runs(:), filled(:,:)
+!-------------------------------------------------------------------------------
 !
-! panel 2
+   allocate(counts(rank1:rank2), seed(2,rank1:rank2))
+   allocate(row_run(4,rank1:rank2), prev_run(3,rank1:rank2))
+   allocate(runs(rank1:rank2))
+   counts(:) = 0
+   row_run(1,:) = 0
+   prev_run(1,:) = 0
+   runs(:) = .true.
+   do j=j1,ny
+     do i=i1,i2
+       rank = box(i,j)
+       if (rank.lt.rank1 .or. rank.gt.rank2) cycle
+       if (counts(rank) .eq. 0) seed(:,rank) = (/i, j/)
+       counts(rank) = counts(rank) + 1
+       if (row_run(1,rank) .ne. j) then
+         if (row_run(1,rank) .ne. 0) call end_run(rank)
+         row_run(:,rank) = (/j, i, i, 0/)
+       end if
+       row_run(3,rank) = i
+       row_run(4,rank) = row_run(4,rank) + 1
+     end do
+   end do
+   do rank=rank1,rank2
+     if (row_run(1,rank) .ne. 0) call end_run(rank)
+   end do
 !
-   box2(ne+1:2*ne,:) = -1  ! candidate mask
-   start_i = start_i - ne
-   do
-     call find_optimal_band(2*ne, ne, nproc, start_rank, start_i, nelems,      &
-         box2, ret)
-     start_rank = ret(1)
-     start_i = ret(2)
+   split(:) = .false.
+   if (all(runs(:))) then
+     deallocate(counts, seed, row_run, prev_run, runs)
+     return
+   end if
 !
-     if (start_i .gt. ne) then
-       do j=1,ne
-         do i=1,ne
-           tmp_box2(i,j) = box2(ne+i,ne-j+1)
-           cube_rank(i,j,2) = box2(i,j)
+   allocate(filled(i1:i2,j1:ny), stack(2,(i2-i1+1)*(ny-j1+1)))
+   filled(:,:) = .false.
+   do rank=rank1,rank2
+     if (runs(rank) .or. counts(rank).eq.0) cycle
+     top = 1
+     stack(:,1) = seed(:,rank)
+     filled(seed(1,rank),seed(2,rank)) = .true.
+     nfill = 0
+     do while (top .gt. 0)
+       i = stack(1,top)
+       j = stack(2,top)
+       top = top - 1
+       nfill = nfill + 1
+       do b=-1,1
+         do a=-1,1
+           if (abs(a)+abs(b) .eq. 1) call fill_side(i+a, j+b)
          end do
        end do
-       exit
-     end if
+     end do
+     split(rank) = nfill .lt. counts(rank)
    end do
-   if (debug) print *, '========== end panel 2 =========='
+   deallocate(counts, seed, row_run, prev_run, runs, filled, stack)
 !
+   contains
+!-------------------------------------------------------------------------------
 !
-! panel 3
 !
-   box2(1:ne,:) = tmp_box2(1:ne,:)
-   box2(ne+1:2*ne,:) = -1  ! candidate mask
-   start_i = start_i - ne
-   do 
-     prev_start_rank = start_rank
-     prev_start_i = start_i
-     call find_optimal_band(2*ne, ne, nproc, start_rank, start_i, nelems,      &
-         box2, ret)
-     start_rank = ret(1)
-     start_i = ret(2)
+!-------------------------------------------------------------------------------
+   subroutine end_run(r)
+!-------------------------------------------------------------------------------
+! the rank r stays of the overlapping runs with its run of the row
+!-------------------------------------------------------------------------------
+   implicit none
 !
-     if (start_i .gt. ne) then
-       if (count(box2(ne:2*ne,:) .ne. -1) .gt.                                 &
-           count(tmp_box2(1:ne,:) .eq. -1)) then
-         do j=1,2*ne
-           do i=1,ne
-             box4(i,j) = tmp_box2(2*ne-j+1,i)
-           end do
+   integer, intent(in   ) :: r
+!-------------------------------------------------------------------------------
+!
+   if (row_run(4,r) .ne. row_run(3,r)-row_run(2,r)+1) runs(r) = .false.
+   if (prev_run(1,r) .ne. 0) then
+     if (prev_run(1,r) .ne. row_run(1,r)-1) runs(r) = .false.
+     if (max(prev_run(2,r), row_run(2,r)) .gt.                                &
+         min(prev_run(3,r), row_run(3,r))) runs(r) = .false.
+   end if
+   prev_run(:,r) = row_run(1:3,r)
+!
+   end subroutine end_run
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine fill_side(si, sj)
+!-------------------------------------------------------------------------------
+! push the side element (si,sj) of the rank
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: si, sj
+!-------------------------------------------------------------------------------
+!
+   if (si.lt.i1 .or. si.gt.i2 .or. sj.lt.j1 .or. sj.gt.ny) return
+   if (box(si,sj).ne.rank .or. filled(si,sj)) return
+   filled(si,sj) = .true.
+   top = top + 1
+   stack(:,top) = (/si, sj/)
+!
+   end subroutine fill_side
+!-------------------------------------------------------------------------------
+!
+   end subroutine band_split
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function max_objective(objective) result(ratio)
+!-------------------------------------------------------------------------------
+! the initial objective of the band search, taken by any band
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   real(8) :: ratio
+!-------------------------------------------------------------------------------
+!
+   ratio = huge(1.D0)
+   if (objective(1) .eq. obj_perimeter) ratio = 4.D0  ! max perimeter ratio
+!
+   end function max_objective
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function band_ratio_bound(ny, width, nrank, nelems) result(bound)
+!-------------------------------------------------------------------------------
+! lower bound of the mean perimeter ratio of the nrank ranks
+! filled by fill_band() in a band of width columns and ny rows
+!
+! A rank of s elements in h rows and w columns has a perimeter of at least
+! 2*(w+h) with s <= w*h and w <= width, so its ratio is at least
+! 2*(1/h + h/s). The ranks are the runs of the row-by-row fill, so their
+! rows sum to at most ny+nrank-1. The bound is the convex ratio at the
+! mean rows. It holds if no other element in the box has these ranks.
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ny, width
+   integer, intent(in   ) :: nrank
+   integer, intent(in   ) :: nelems(nrank)
+   real(8) :: bound
+!
+   real(8) :: h, s
+!-------------------------------------------------------------------------------
+!
+   s = maxval(nelems)
+   h = max(sqrt(s), minval(nelems)*1.D0/width, 1.D0)
+   h = min(h, (ny + nrank - 1)*1.D0/nrank)
+   bound = 2*(1/h + h/s)
+!
+   end function band_ratio_bound
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function cube_ratio_bound(ne, nproc) result(bound)
+!-------------------------------------------------------------------------------
+! lower bound of global_perimeter_ratio() for the nelems of make_cube_rank()
+!
+! The cube has 3*ne belts of 4*ne elements, every element is in two belts
+! and every side between two elements in one belt. A rank in b belts
+! without a whole belt has at least 2*b different sides and at most
+! 2*b**2/3 elements (one element of a belt pair on each of the opposite
+! panels). A rank of 4*ne or more elements may hold a whole belt,
+! its bound is zero.
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ne, nproc
+   real(8) :: bound
+!
+   integer :: s, remain_elem
+!-------------------------------------------------------------------------------
+!
+   s = ne*ne*6/nproc
+   remain_elem = mod(ne*ne*6, nproc)
+   bound = ((nproc - remain_elem)*rank_bound(s) +                              &
+            remain_elem*rank_bound(s+1))/nproc
+!
+   contains
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function rank_bound(nelem) result(ratio)
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nelem
+   real(8) :: ratio
+!-------------------------------------------------------------------------------
+!
+   ratio = 0.D0
+   if (nelem .lt. 4*ne) ratio = 2*ceiling(sqrt(1.5D0*nelem))*1.D0/nelem
+!
+   end function rank_bound
+!-------------------------------------------------------------------------------
+!
+   end function cube_ratio_bound
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine fill_band(nx, ny, nproc, start_rank, end_rank, nelems,           &
+       i1, i2, remain_elem, box)
+!-------------------------------------------------------------------------------
+! assign the ranks to the free elements in the band i1~i2
+! row by row from the i2 side, except the top remain_elem elements of i2
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: start_rank, end_rank
+   integer, intent(in   ) :: nelems(0:nproc-1)
+   integer, intent(in   ) :: i1, i2, remain_elem
+   integer, intent(inout) :: box(nx,ny)
+!
+   integer :: i, j, j1, j2
+   integer :: seq, rank
+!-------------------------------------------------------------------------------
+!
+   if (remain_elem .ne. 0) then
+     do j=ny,1,-1
+       if (box(i2,j) .eq. -1) exit
+     end do
+     j2 = j
+     j1 = j - remain_elem + 1
+     box(i2,j1:j2) = -3  ! temporary mask
+   end if
+!
+   rank = start_rank
+   seq = 1
+   do j=1,ny
+     do i=i2,i1,-1
+       if (box(i,j) .eq. -1) then
+         box(i,j) = rank
+         if (seq .eq. nelems(rank)) then
+           rank = rank + 1
+           seq = 1
+         else
+           seq = seq + 1
+         end if
+       else if (box(i,j) .eq. -3) then
+         box(i,j) = -1
+       end if
+     end do
+   end do 
+   if (rank-1 .ne. end_rank) stop 'The rank is greater than the end_rank in calc_perimeter_ratio()'
+!
+   end subroutine fill_band
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine find_optimal_band(nx, ny, nproc, start_rank, start_i, nelems,    &
+       objective, box, ret)
+!-------------------------------------------------------------------------------
+! find the optimal band partitioning with minimum objective
+! objective: (kind, np, max_nbrs), kind is one of obj_perimeter, obj_comm,
+!            obj_max_comm and obj_nbrs, np the points of an element side
+!            and max_nbrs the cap of the neighbor ranks (0: no cap)
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: start_rank  ! start from zero
+   integer, intent(in   ) :: start_i
+   integer, intent(in   ) :: nelems(0:nproc-1)
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(inout) :: box(nx,ny)
+   integer, intent(  out) :: ret(2)  ! (rank, i2)
+!
+   integer, allocatable :: work(:)
+!-------------------------------------------------------------------------------
+!
+   allocate(work(2*nx*ny))
+   call find_optimal_band_ws(nx, ny, nproc, start_rank, start_i, nelems,       &
+       objective, box, work, ret)
+   deallocate(work)
+!
+   end subroutine find_optimal_band
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine find_optimal_band_ws(nx, ny, nproc, start_rank, start_i, nelems, &
+       objective, box, work, ret)
+!-------------------------------------------------------------------------------
+! find_optimal_band() with the caller-provided workspace
+! work: scratch of 2*nx*ny, the int16 prefix tables of band_search(),
+!       the two box copies of band_search_copy() or
+!       the box of band_search_objective()
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: start_rank  ! start from zero
+   integer, intent(in   ) :: start_i
+   integer, intent(in   ) :: nelems(0:nproc-1)
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(inout) :: box(nx,ny)
+   integer, target, intent(inout) :: work(2*nx*ny)
+   integer, intent(  out) :: ret(2)  ! (rank, i2)
+!
+   integer(int16), pointer, contiguous :: tab(:)
+   integer :: m
+   logical :: done
+!-------------------------------------------------------------------------------
+!
+   ! three tables of (ny,0:nx-start_i+1) fit in the workspace for nx >= 3
+   done = .false.
+   if (objective(1) .ne. obj_perimeter) then
+     call band_search_objective(nx, ny, nproc, start_rank, start_i, nelems,    &
+         objective, box, work(1:nx*ny), ret)
+     done = .true.
+   else if (nx.ge.3 .and. nx.lt.huge(0_int16)) then
+     m = ny*(nx - start_i + 2)
+     call c_f_pointer(c_loc(work), tab, (/4*int(nx,int64)*ny/))
+     call band_search(nx, ny, nproc, start_rank, start_i, nelems, box,         &
+         tab(1:m), tab(m+1:2*m), tab(2*m+1:3*m), ret, done)
+   end if
+   if (.not. done) call band_search_copy(nx, ny, nproc, start_rank, start_i,   &
+       nelems, box, work(1:nx*ny), work(nx*ny+1:2*nx*ny), ret)
+!
+   end subroutine find_optimal_band_ws
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine band_search_objective(nx, ny, nproc, start_rank, start_i,        &
+       nelems, objective, box, tmp_box, ret)
+!-------------------------------------------------------------------------------
+! the same search as band_search_copy() with the objective other than
+! obj_perimeter, filling and evaluating only what the end_rank changes
+!
+! With the same i2, the next end_rank only shortens the remain elements on
+! the top of i2, so the fill of the rows below them is kept in the tmp_box
+! and the ranks below the row under them keep their values.
+! The box is filled once with the band found. A band over the max_nbrs
+! or with a rank in pieces (see band_split()) is taken only if no shorter
+! band is filled (single-column bands before nx) or, for the pieces,
+! the shorter band has them too. A band without the pieces is taken
+! over a shorter band with them.
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: start_rank  ! start from zero
+   integer, intent(in   ) :: start_i
+   integer, intent(in   ) :: nelems(0:nproc-1)
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(inout) :: box(nx,ny)
+   integer, intent(inout) :: tmp_box(nx,ny)  ! scratch
+   integer, intent(  out) :: ret(2)  ! (rank, i2)
+!
+   integer :: j, end_rank
+   integer :: i1, i2, band_elem, required_elem, remain_elem
+   integer :: fill_i2   ! i2 of the fill in the tmp_box (0: none)
+   integer :: fill_j1   ! first row of the remain elements of the fill
+   integer :: top_j     ! top free element of i2
+   integer :: jf, seq, first_rank, first_elem
+   integer :: next_i2
+   real(8) :: ratio, prev_ratio
+   integer :: prev_i12(4)  ! (i1, i2, band_elem, remain_elem)
+   logical :: filled, prev_filled
+   logical :: split, prev_split  ! a rank of the band in pieces
+   integer, allocatable :: row_elem(:)  ! (0:ny) free elements up to a row
+   real(8), allocatable :: vals(:)      ! (start_rank:nproc-1)
+   logical, allocatable :: in_pieces(:) ! (start_rank:nproc-1)
+!-------------------------------------------------------------------------------
+!
+   allocate(row_elem(0:ny), vals(start_rank:nproc-1))
+   allocate(in_pieces(start_rank:nproc-1))
+   i1 = start_i
+   i2 = start_i
+   band_elem = count(box(i1,:) .eq. -1)
+   required_elem = 0
+   end_rank = start_rank
+   prev_ratio = max_objective(objective)
+   prev_i12(:) = (/i1, i2, band_elem, -1/)
+   prev_filled = .false.
+   prev_split = .false.
+   fill_i2 = 0
+   fill_j1 = 0
+   tmp_box(:,:) = box(:,:)
+!
+   search_loop: do
+     required_elem = required_elem + nelems(end_rank)
+     do while (i2.lt.nx .and. required_elem.gt.band_elem)
+       i2 = i2 + 1
+       band_elem = band_elem + count(box(i2,:) .eq. -1)
+     end do
+     if (required_elem .gt. band_elem) exit search_loop  ! i2 exceeded the nx
+!
+     filled = .not. (i2.ne.nx .and. i1.eq.i2)
+     split = .false.
+     if (.not. filled) then
+       ratio = max_objective(objective)  ! single-line band
+     else
+       remain_elem = band_elem - required_elem
+       do top_j=ny,1,-1
+         if (box(i2,top_j) .eq. -1) exit
+       end do
+!
+       ! the fill from the first changed row
+       jf = 1
+       if (i2 .eq. fill_i2) then
+         jf = fill_j1
+       else
+         tmp_box(i1:i2,:) = box(i1:i2,:)
+         row_elem(0) = 0
+         do j=1,ny
+           row_elem(j) = row_elem(j-1) + count(box(i1:i2,j) .eq. -1)
+         end do
+       end if
+       call fill_rows(jf)
+!
+       ! the ranks with an element from the row under the changed rows
+       ! are evaluated from the first row of the first one
+       j = max(jf-1, 1)
+       call locate_seq(row_elem(j-1) + 1, first_rank, seq)
+       first_elem = row_elem(j-1) - seq + 2
+       do while (j .gt. 1)
+         if (row_elem(j-1) .lt. first_elem) exit
+         j = j - 1
+       end do
+       call rank_values(nx, ny, first_rank, end_rank, i1, i2, j,              &
+           objective, tmp_box, vals(first_rank:end_rank))
+       ratio = objective_value(objective, end_rank-start_rank+1,              &
+           vals(start_rank:end_rank))
+       if (over_cap(objective, end_rank-start_rank+1,                         &
+           vals(start_rank:end_rank)) .and. prev_filled) ratio = -1.D0
+       call band_split(nx, ny, i1, i2, j, first_rank, end_rank, tmp_box,     &
+           in_pieces(first_rank:end_rank))
+       split = any(in_pieces(start_rank:end_rank))
+       if (split .and. prev_filled .and. .not.prev_split) ratio = -1.D0
+     end if
+     if (debug) print *, 'objective', prev_ratio, ratio
+!
+     if (ratio .lt. 0.D0) exit search_loop
+     if (ratio .gt. prev_ratio) then
+       ! a band without the ranks in pieces goes over a band with them
+       if (.not. (filled .and. prev_split .and. .not.split)) exit search_loop
+     end if
+!
+     prev_ratio = ratio
+     prev_filled = filled
+     prev_split = split
+     if (filled) prev_i12(:) = (/i1, i2, band_elem, remain_elem/)
+     end_rank = end_rank + 1
+     if (end_rank .eq. nproc) exit search_loop
+   end do search_loop
+   if (debug) print *, '---------- end search_loop ----------'
+!
+   if (prev_filled) call fill_band(nx, ny, nproc, start_rank, end_rank-1,     &
+       nelems, prev_i12(1), prev_i12(2), prev_i12(4), box)
+!
+   next_i2 = prev_i12(2)
+   if (prev_i12(4) .eq. 0) next_i2 = next_i2 + 1
+   ret(:) = (/end_rank, next_i2/)
+   deallocate(row_elem, vals, in_pieces)
+!
+   if (debug) print *, '(rank,i2)', ret
+!
+   contains
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine fill_rows(j1)
+!-------------------------------------------------------------------------------
+! fill_band() of the tmp_box from the row j1, the rows below are filled
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: j1
+!
+   integer :: i, j
+   integer :: rank, seq
+!-------------------------------------------------------------------------------
+!
+   tmp_box(i1:i2,j1:ny) = box(i1:i2,j1:ny)
+   fill_j1 = top_j - remain_elem + 1
+   if (remain_elem .ne. 0) tmp_box(i2,fill_j1:top_j) = -3  ! temporary mask
+   ! the remain elements must be the top run of the free elements
+   fill_i2 = i2
+   if (remain_elem .ne. 0) then
+     if (any(box(i2,fill_j1:top_j) .ne. -1)) fill_i2 = 0
+   end if
+!
+   call locate_seq(row_elem(j1-1) + 1, rank, seq)
+   do j=j1,ny
+     do i=i2,i1,-1
+       if (tmp_box(i,j) .eq. -1) then
+         tmp_box(i,j) = rank
+         if (seq .eq. nelems(rank)) then
+           rank = rank + 1
+           seq = 1
+         else
+           seq = seq + 1
+         end if
+       else if (tmp_box(i,j) .eq. -3) then
+         tmp_box(i,j) = -1
+       end if
+     end do
+   end do
+   if (rank-1 .ne. end_rank) stop 'The rank is greater than the end_rank in band_search_objective()'
+!
+   end subroutine fill_rows
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine locate_seq(q, rank, seq)
+!-------------------------------------------------------------------------------
+! rank and sequence in the rank of the q-th element of the fill
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: q
+   integer, intent(  out) :: rank, seq
+!-------------------------------------------------------------------------------
+!
+   rank = start_rank
+   seq = q
+   do while (rank.lt.nproc-1 .and. seq.gt.nelems(rank))
+     seq = seq - nelems(rank)
+     rank = rank + 1
+   end do
+!
+   end subroutine locate_seq
+!-------------------------------------------------------------------------------
+!
+   end subroutine band_search_objective
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine band_search_copy(nx, ny, nproc, start_rank, start_i, nelems,     &
+       box, tmp_box, prev_box, ret)
+!-------------------------------------------------------------------------------
+! search the band by filling a copy of the box for every end_rank
+! the end_rank whose band_ratio_bound() is above the previous ratio
+! is not filled
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: start_rank  ! start from zero
+   integer, intent(in   ) :: start_i
+   integer, intent(in   ) :: nelems(0:nproc-1)
+   integer, intent(inout) :: box(nx,ny)
+   integer, intent(inout) :: tmp_box(nx,ny), prev_box(nx,ny)  ! scratch
+   integer, intent(  out) :: ret(2)  ! (rank, i2)
+!
+   integer :: end_rank
+   integer :: next_i2
+   real(8) :: perimeter_ratio, prev_perimeter_ratio
+   integer :: i12(4), prev_i12(4)  ! (i1, i2, band_elem, remain_elem)
+   logical :: prune  ! no element of the ranks from start_rank around the band
+!-------------------------------------------------------------------------------
+!
+   i12(:) = (/start_i, start_i, count(box(start_i,:) .eq. -1), -1/)
+   end_rank = start_rank !+ int(i12(3)/nelems(start_rank))
+   prev_perimeter_ratio = 4.D0  ! max perimeter ratio
+   prev_i12(:) = i12(:)
+   prev_box(:,:) = box(:,:)
+   prune = .not. any(box(max(start_i-1,1):nx,:) .ge. start_rank)
+!
+   search_loop: do
+     if (debug) print *, ''
+     if (prune .and. end_rank.gt.start_rank) then
+       if (band_ratio_bound(ny, nx-start_i+1, end_rank-start_rank+1,           &
+           nelems(start_rank:end_rank)) .gt. prev_perimeter_ratio + bound_tol) &
+           then
+         box(:,:) = prev_box(:,:)
+         exit search_loop
+       end if
+     end if
+!
+     tmp_box(:,:) = box(:,:)
+     perimeter_ratio = calc_perimeter_ratio(                                   &
+         nx, ny, nproc, start_rank, end_rank, nelems, i12, tmp_box) 
+     if (debug) print *, 'preimeter_ratio', prev_perimeter_ratio, perimeter_ratio
+!
+     if (perimeter_ratio .lt. 0.D0 .or.                                        &
+         perimeter_ratio .gt. prev_perimeter_ratio) then
+       box(:,:) = prev_box(:,:)
+       exit search_loop
+!
+     else
+       prev_perimeter_ratio = perimeter_ratio
+       end_rank = end_rank + 1
+       prev_i12(:) = i12(:)
+!
+       if (end_rank .eq. nproc) then
+         box(:,:) = tmp_box(:,:)
+         exit search_loop
+       else
+         prev_box(:,:) = tmp_box(:,:)
+       end if
+     end if
+!
+   end do search_loop
+   if (debug) print *, '---------- end search_loop ----------'
+!
+   next_i2 = prev_i12(2)
+   if (prev_i12(4) .eq. 0) next_i2 = next_i2 + 1
+   ret(:) = (/end_rank, next_i2/)
+!
+   if (debug) print *, '(rank,i2)', ret
+!
+   end subroutine band_search_copy
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine band_search(nx, ny, nproc, start_rank, start_i, nelems, box,     &
+       cnt, hp, vp, ret, done)
+!-------------------------------------------------------------------------------
+! the same search as band_search_copy() without filling the box copies
+!
+! fill_band() gives the elements of a rank as a run of the fill sequence,
+! so the perimeter of a rank is evaluated from the prefix sums of the free
+! elements and of their horizontal and vertical contacts in the band.
+! The columns are added to the prefix sums as the band grows, and only the
+! ranks above the changed rows are evaluated again as the end_rank advances.
+!
+! done is .false. and the box is untouched if the incremental evaluation
+! does not apply (the top remain_elem elements of i2 are not all free,
+! a rank has no element or the box has the ranks from start_rank around
+! the band), then band_search_copy() should be used.
+!
+! cnt, hp, vp: int16 scratch, the counts are bounded by the columns (< nx)
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: start_rank  ! start from zero
+   integer, intent(in   ) :: start_i
+   integer, intent(in   ) :: nelems(0:nproc-1)
+   integer, intent(inout) :: box(nx,ny)
+   integer(int16), intent(inout) :: cnt(ny,0:nx-start_i+1)  ! free elements
+   integer(int16), intent(inout) :: hp(ny,0:nx-start_i+1)  ! horizontal contacts
+   integer(int16), intent(inout) :: vp(ny,0:nx-start_i+1)  ! with the upper row
+   integer, intent(  out) :: ret(2)  ! (rank, i2)
+   logical, intent(  out) :: done
+!
+   integer, allocatable :: colcnt(:), top(:), run(:)  ! free, top, top run
+   integer, allocatable :: off(:), hf(:), vf(:), la(:)  ! (0:ny) row prefix
+   integer, allocatable :: pos(:)   ! (0:nrank) last sequence of the ranks
+   real(8), allocatable :: psum(:)  ! (0:nrank) prefix sum of the ratios
+!
+   integer :: i1, ncol, nc
+   integer :: end_rank, k, k0, kk, lo, hi, mid
+   integer :: i2, band_elem, remain_elem
+   integer :: st(3), prev_st(3)  ! (i2, band_elem, remain_elem)
+   integer :: cand(4), prev_fill(4), fin(4)  ! (end_rank, i2, remain, filled)
+   integer :: c2, j1, j2, lay_c2, lay_j1, lay_nk
+   real(8) :: ratio, prev_ratio
+   logical :: foreign  ! the ranks from start_rank in the box
+!-------------------------------------------------------------------------------
+!
+   done = .false.
+   i1 = start_i
+   ncol = nx - i1 + 1
+   allocate(colcnt(0:ncol-1), top(0:ncol-1), run(0:ncol-1))
+   allocate(off(0:ny), hf(0:ny), vf(0:ny), la(0:ny))
+   allocate(pos(0:nproc-start_rank), psum(0:nproc-start_rank))
+!
+   cnt(:,0) = 0
+   hp(:,0) = 0
+   vp(:,0) = 0
+   nc = 0
+   foreign = .false.
+   if (i1 .gt. 1) foreign = any(box(i1-1,:) .ge. start_rank)
+   call add_column()
+!
+   st(:) = (/i1, colcnt(0), -1/)
+   prev_st(:) = st(:)
+   cand(:) = 0
+   prev_fill(:) = 0
+   pos(0) = 0
+   psum(0) = 0.D0
+   lay_c2 = -1
+   lay_j1 = 0
+   lay_nk = 0
+   end_rank = start_rank
+   prev_ratio = 4.D0  ! max perimeter ratio
+!
+   search_loop: do
+     k = end_rank - start_rank + 1
+     if (nelems(end_rank) .lt. 1) exit search_loop
+     pos(k) = pos(k-1) + nelems(end_rank)
+!
+     i2 = st(1)
+     band_elem = st(2)
+     do while (i2.lt.nx .and. pos(k).gt.band_elem)
+       i2 = i2 + 1
+       if (i2-i1 .ge. nc) call add_column()
+       band_elem = band_elem + colcnt(i2-i1)
+       if (i2 .eq. nx) exit
+     end do
+!
+     cand(:) = 0
+     if (i2.eq.nx .and. pos(k).gt.band_elem) then
+       ratio = -1.D0
+!
+     else if (i2.ne.nx .and. i1.eq.i2) then
+       ratio = 4.D0
+!
+     else
+       remain_elem = band_elem - pos(k)
+       c2 = i2 - i1
+       if (remain_elem .gt. run(c2)) exit search_loop
+       if (c2.ne.lay_c2 .and. i2.lt.nx) then
+         if (any(box(i2+1,:) .ge. start_rank)) foreign = .true.
+       end if
+       if (foreign) exit search_loop
+!
+       ! the band can not be below the previous ratio
+       if (k .gt. 1) then
+         if (band_ratio_bound(ny, c2+1, k, nelems(start_rank:end_rank)) .gt.   &
+             prev_ratio + bound_tol) then
+           fin(:) = prev_fill(:)
+           done = .true.
+           exit search_loop
+         end if
+       end if
+!
+       if (remain_elem .gt. 0) then
+         j2 = top(c2)
+         j1 = j2 - remain_elem + 1
+       else
+         j1 = ny + 1
+         j2 = ny
+       end if
+!
+       ! the ranks below the previous remain elements are not changed
+       k0 = 1
+       if (c2 .eq. lay_c2) then
+         lo = 1
+         hi = lay_nk + 1
+         do while (lo .lt. hi)
+           mid = (lo + hi)/2
+           if (pos(mid) .gt. off(lay_j1-1)) then
+             hi = mid
+           else
+             lo = mid + 1
+           end if
+         end do
+         k0 = lo
+       else
+         call make_row_prefix()
+       end if
+!
+       do kk=k0,k
+         psum(kk) = psum(kk-1)                                                 &
+                  + perimeter(kk)*1.D0/nelems(start_rank+kk-1)
+       end do
+       ratio = psum(k)/k
+       lay_c2 = c2
+       lay_j1 = min(j1, ny+1)
+       lay_nk = k
+!
+       st(:) = (/i2, band_elem, remain_elem/)
+       cand(:) = (/end_rank, i2, remain_elem, 1/)
+     end if
+!
+     if (ratio .lt. 0.D0 .or. ratio .gt. prev_ratio) then
+       fin(:) = prev_fill(:)
+       done = .true.
+       exit search_loop
+!
+     else
+       prev_ratio = ratio
+       end_rank = end_rank + 1
+       prev_st(:) = st(:)
+!
+       if (end_rank .eq. nproc) then
+         fin(:) = cand(:)
+         done = .true.
+         exit search_loop
+       else
+         prev_fill(:) = cand(:)
+       end if
+     end if
+   end do search_loop
+!
+   if (done) then
+     if (fin(4) .eq. 1) call fill_band(nx, ny, nproc, start_rank, fin(1),      &
+         nelems, i1, fin(2), fin(3), box)
+!
+     ret(1) = end_rank
+     ret(2) = prev_st(1)
+     if (prev_st(3) .eq. 0) ret(2) = ret(2) + 1
+   end if
+!
+   deallocate(colcnt, top, run, off, hf, vf, la, pos, psum)
+!
+   contains
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine add_column()
+!-------------------------------------------------------------------------------
+! prefix sums of the next column c=nc (i=i1+nc)
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer :: i, j, c, a, a_left, a_up
+!-------------------------------------------------------------------------------
+!
+   c = nc
+   i = i1 + c
+   colcnt(c) = 0
+   top(c) = 0
+   do j=1,ny
+     a = 0
+     if (box(i,j) .eq. -1) a = 1
+     a_left = 0
+     if (c .ge. 1) a_left = cnt(j,c) - cnt(j,c-1)
+     a_up = 0
+     if (j .lt. ny) then
+       if (box(i,j+1) .eq. -1) a_up = 1
+     end if
+!
+     cnt(j,c+1) = int(cnt(j,c) + a, int16)
+     hp(j,c+1) = int(hp(j,c) + a*a_left, int16)
+     vp(j,c+1) = int(vp(j,c) + a*a_up, int16)
+     colcnt(c) = colcnt(c) + a
+     if (a .eq. 1) top(c) = j
+     if (box(i,j) .ge. start_rank) foreign = .true.
+   end do
+!
+   run(c) = 0
+   do j=top(c),1,-1
+     if (box(i,j) .ne. -1) exit
+     run(c) = run(c) + 1
+   end do
+!
+   nc = nc + 1
+!
+   end subroutine add_column
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine make_row_prefix()
+!-------------------------------------------------------------------------------
+! prefix sums over the rows for the band i1~i2 (c2)
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer :: j
+!-------------------------------------------------------------------------------
+!
+   off(0) = 0
+   hf(0) = 0
+   vf(0) = 0
+   la(0) = 0
+   do j=1,ny
+     off(j) = off(j-1) + cnt(j,c2+1)
+     hf(j) = hf(j-1) + hp(j,c2+1)
+     vf(j) = vf(j-1) + vp(j,c2+1)
+     la(j) = la(j-1)
+     if (c2 .ge. 1) la(j) = la(j) + free(j,c2-1)
+   end do
+!
+   end subroutine make_row_prefix
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function free(j, c) result(a)
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: j, c
+   integer :: a
+!-------------------------------------------------------------------------------
+!
+   a = cnt(j,c+1) - cnt(j,c)
+!
+   end function free
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function in_remain(j) result(ret)
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: j
+   logical :: ret
+!-------------------------------------------------------------------------------
+!
+   ret = j.ge.j1 .and. j.le.j2
+!
+   end function in_remain
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function seq_off(j) result(ret)
+!-------------------------------------------------------------------------------
+! number of the filled elements in the rows 1~j
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: j
+   integer :: ret
+!-------------------------------------------------------------------------------
+!
+   ret = off(j) - max(0, min(j,j2)-j1+1)
+!
+   end function seq_off
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine locate(q, j, c)
+!-------------------------------------------------------------------------------
+! (row, column) of the q-th element in the fill sequence
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: q
+   integer, intent(  out) :: j, c
+!
+   integer :: m, t, lo, hi, mid
+!-------------------------------------------------------------------------------
+!
+   lo = 1
+   hi = ny
+   do while (lo .lt. hi)
+     mid = (lo + hi)/2
+     if (seq_off(mid) .ge. q) then
+       hi = mid
+     else
+       lo = mid + 1
+     end if
+   end do
+   j = lo
+!
+   ! the free elements are filled from the column c2
+   m = q - seq_off(j-1)
+   if (in_remain(j)) m = m + 1
+   t = cnt(j,c2+1) - m + 1
+!
+   lo = 0
+   hi = c2
+   do while (lo .lt. hi)
+     mid = (lo + hi)/2
+     if (cnt(j,mid+1) .ge. t) then
+       hi = mid
+     else
+       lo = mid + 1
+     end if
+   end do
+   c = lo
+!
+   end subroutine locate
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function hrow(j, lo, hi) result(h)
+!-------------------------------------------------------------------------------
+! horizontal contacts of the filled elements in the columns lo~hi of a row
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: j, lo, hi
+   integer :: h
+!-------------------------------------------------------------------------------
+!
+   h = hp(j,hi+1) - hp(j,lo+1)
+   if (c2.ge.1 .and. hi.eq.c2 .and. lo.le.c2-1 .and. in_remain(j))            &
+       h = h - free(j,c2-1)
+!
+   end function hrow
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function vrow(j, lo, hi) result(v)
+!-------------------------------------------------------------------------------
+! vertical contacts of the filled elements between the rows j and j+1
+! in the columns lo~hi
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: j, lo, hi
+   integer :: v
+!-------------------------------------------------------------------------------
+!
+   v = 0
+   if (lo .gt. hi) return
+!
+   v = vp(j,hi+1) - vp(j,lo)
+   if (lo.le.c2 .and. c2.le.hi .and. j.lt.ny) then
+     if (free(j,c2).eq.1 .and. free(j+1,c2).eq.1 .and.                         &
+         (in_remain(j) .or. in_remain(j+1))) v = v - 1
+   end if
+!
+   end function vrow
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function perimeter(kk) result(perim)
+!-------------------------------------------------------------------------------
+! sides of the kk-th rank in the band not contacting the same rank
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: kk
+   integer :: perim
+!
+   integer :: ja, ca, jb, cb
+   integer :: h, v, lo, hi
+!-------------------------------------------------------------------------------
+!
+   call locate(pos(kk-1)+1, ja, ca)
+   call locate(pos(kk), jb, cb)
+!
+   if (ja .eq. jb) then
+     h = hrow(ja, cb, ca)
+     v = 0
+!
+   else
+     ! full rows ja+1~jb-1 except the remain elements
+     h = hrow(ja, 0, ca) + hf(jb-1) - hf(ja) + hrow(jb, cb, c2)
+     lo = max(ja+1, j1)
+     hi = min(jb-1, j2)
+     if (c2.ge.1 .and. lo.le.hi) h = h - (la(hi) - la(lo-1))
+!
+     if (jb .eq. ja+1) then
+       v = vrow(ja, cb, ca)
+     else
+       ! full row pairs ja+1~jb-2 except the contacts to the remain elements
+       v = vrow(ja, 0, ca) + vf(jb-2) - vf(ja) + vrow(jb-1, cb, c2)
+       v = v - max(0, min(jb-2, j2-1) - max(ja+1, j1) + 1)
+       if (j1.le.j2 .and. j1-1.ge.max(ja+1,1) .and. j1-1.le.jb-2) then
+         if (free(j1-1,c2) .eq. 1) v = v - 1
+       end if
+     end if
+   end if
+!
+   perim = 4*nelems(start_rank+kk-1) - 2*(h + v)
+!
+   end function perimeter
+!-------------------------------------------------------------------------------
+!
+   end subroutine band_search
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function band_work_size(ne) result(nwork)
+!-------------------------------------------------------------------------------
+! size of the workspace of band_partition_ws()
+!   box2, tmp_box2 (2*ne,ne), box4 (2*ne,2*ne) and the scratch (8*ne*ne)
+!   of find_optimal_band_ws() shared with the boxes of rearrange_bands()
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ne
+   integer :: nwork
+!-------------------------------------------------------------------------------
+!
+   nwork = 16*ne*ne
+!
+   end function band_work_size
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine band_partition(ne, nproc, nelems, cube_rank)
+!-------------------------------------------------------------------------------
+! assign the rank number to elements on the cubed-sphere
+! band partitioning the cubed-sphere
+! Caution: The nproc must be greater than 3.
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ne, nproc
+   integer, intent(in   ) :: nelems(nproc)
+   integer, intent(  out) :: cube_rank(ne,ne,6)
+!
+   integer, allocatable :: work(:)
+!-------------------------------------------------------------------------------
+!
+   allocate(work(band_work_size(ne)))
+   call band_partition_ws(ne, nproc, 2, 0.D0, 0, perimeter_objective, nelems,  &
+       work, cube_rank)
+   deallocate(work)
+!
+   end subroutine band_partition
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine band_partition_ws(ne, nproc, nbands, budget, unfolding,          &
+       objective, nelems, work, cube_rank)
+!-------------------------------------------------------------------------------
+! band_partition() with the caller-provided workspace
+! nbands   : number of the last bands to rearrange (2: the default)
+! budget   : seconds for the optimal band splits of every panel (<= 0: greedy),
+!            the partition with the lower global objective is returned
+! unfolding: route of the bands over the cube (0: the default, 0..3)
+!            bit 0 - the bands of panel 6 in the mirror image
+!            bit 1 - the ranks in the reverse order along the route
+!            The cube_rank is in the canonical panel coordinates and
+!            the rank numbers for any unfolding. The ranks go in the
+!            forward order if the reverse order does not place all the
+!            elements of every rank (ranks of one or two elements).
+! objective: (kind, np, max_nbrs) of the band search, see find_optimal_band()
+! work     : scratch of band_work_size(ne)
+! The cube_rank is -1 if the bands can not go on with the nelems
+! (ranks much larger than a panel).
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ne, nproc
+   integer, intent(in   ) :: nbands
+   real(8), intent(in   ) :: budget
+   integer, intent(in   ) :: unfolding
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(in   ) :: nelems(nproc)
+   integer, intent(inout) :: work(16*ne*ne)
+   integer, intent(  out) :: cube_rank(ne,ne,6)
+!
+   integer :: n1, mirror
+   integer :: i, j, p
+   logical :: reverse
+   integer(int64) :: clock, rate, deadline
+   integer, allocatable :: route_nelems(:), counts(:)
+   integer, allocatable :: greedy_rank(:,:,:)
+!-------------------------------------------------------------------------------
+!
+   if (unfolding .lt. 0 .or. unfolding .gt. 3) stop 'unfolding out of 0..3'
+   n1 = ne*ne
+   mirror = mod(unfolding, 2)
+   reverse = unfolding .ge. 2
+   allocate(route_nelems(nproc), counts(0:nproc-1))
+!
+   do
+     if (reverse) then
+       route_nelems(:) = nelems(nproc:1:-1)
+     else
+       route_nelems(:) = nelems(:)
+     end if
+!
+     call band_partition_boxes(ne, nproc, nbands, 0_int64, mirror, objective,  &
+         route_nelems, work(1:2*n1), work(2*n1+1:4*n1), work(4*n1+1:8*n1),     &
+         work(8*n1+1:16*n1), cube_rank)
+     if (cube_rank(1,1,1) .eq. -1) then
+       if (.not. reverse) exit
+       reverse = .false.
+       cycle
+     end if
+!
+     if (budget .gt. 0.D0) then
+       call system_clock(clock, rate)
+       deadline = clock + max(int(budget*rate, int64), 1_int64)
+       allocate(greedy_rank(ne,ne,6))
+       greedy_rank(:,:,:) = cube_rank(:,:,:)
+       call band_partition_boxes(ne, nproc, nbands, deadline, mirror,          &
+           objective, route_nelems, work(1:2*n1), work(2*n1+1:4*n1),           &
+           work(4*n1+1:8*n1), work(8*n1+1:16*n1), cube_rank)
+       if (global_objective(ne, nproc, objective, greedy_rank) .le.            &
+           global_objective(ne, nproc, objective, cube_rank))                  &
+         cube_rank(:,:,:) = greedy_rank(:,:,:)
+       deallocate(greedy_rank)
+     end if
+     if (.not. reverse) exit
+!
+     cube_rank(:,:,:) = nproc - 1 - cube_rank(:,:,:)
+     counts(:) = 0
+     do p=1,6
+       do j=1,ne
+         do i=1,ne
+           counts(cube_rank(i,j,p)) = counts(cube_rank(i,j,p)) + 1
+         end do
+       end do
+     end do
+     if (all(counts(:) .eq. nelems(:))) exit
+     reverse = .false.
+   end do
+   deallocate(route_nelems, counts)
+!
+   end subroutine band_partition_ws
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine band_partition_boxes(ne, nproc, nbands, deadline, mirror,        &
+       objective, nelems, box2, tmp_box2, box4, band_work, cube_rank)
+!-------------------------------------------------------------------------------
+! band partitioning over the boxes in the workspace
+! deadline > 0: the bands of every panel are split again by optimize_bands()
+!               until the system_clock count
+! mirror = 1  : panel 6 is flipped along its edge with panel 1 before
+!               the bands go on to panel 1
+! The cube_rank is -1 if a band search does not go on.
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ne, nproc
+   integer, intent(in   ) :: nbands
+   integer(int64), intent(in   ) :: deadline
+   integer, intent(in   ) :: mirror
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(in   ) :: nelems(nproc)
+   integer, intent(inout) :: box2(2*ne,ne), tmp_box2(2*ne,ne)
+   integer, intent(inout) :: box4(2*ne,2*ne)
+   integer, intent(inout) :: band_work(8*ne*ne)
+   integer, intent(  out) :: cube_rank(ne,ne,6)
+!
+   integer :: i, j
+   integer :: start_rank, start_i
+   integer :: prev_start_rank, prev_start_i
+   integer :: ret(2)  ! (rank, i2)
+   integer :: n1
+   integer :: r0, i0, max_len  ! start rank, start i, longest band of a panel
+   integer :: nfree  ! free cells of the box before a band search
+   integer, allocatable :: init_box(:)  ! the box at the start of a panel
+!-------------------------------------------------------------------------------
+!
+   n1 = ne*ne
+   if (deadline .gt. 0) allocate(init_box(4*n1))
+   box4(ne+1:2*ne,ne+1:2*ne) = -2  ! permanant mask
+!
+!
+! panel 6
+!
+   box2(:,:) = -1
+   tmp_box2(:,:) = -1
+   start_rank = 0
+   start_i = 1
+   call start_panel(2*n1, box2)
+   do 
+     prev_start_rank = start_rank
+     prev_start_i = start_i
+     nfree = count(box2 .eq. -1)
+     call find_optimal_band_ws(2*ne, ne, nproc, start_rank, start_i, nelems,   &
+         objective, box2, band_work(1:4*ne*ne), ret)
+     if (stalled(count(box2 .eq. -1), ret(2) .gt. ne)) return
+     max_len = max(max_len, ret(1) - start_rank)
+     start_rank = ret(1)
+     start_i = ret(2)
+!
+     if (start_i .gt. ne) then
+       if (count(box2(ne+1:2*ne,:).ne.-1) .gt.                                 &
+           count(tmp_box2(1:ne,:).eq.-1)) then
+         if (deadline .gt. 0) call optimize_bands(2*ne, ne, nproc, r0,         &
+             prev_start_rank-1, i0, 2*max_len, deadline, objective, nelems,    &
+             init_box(1:2*n1), tmp_box2)
+         do j=1,2*ne
+           do i=1,ne
+             box4(i,j) = tmp_box2(2*ne-j+1,mirror_i(i))
+           end do
+         end do
+         start_rank = prev_start_rank
+         start_i = prev_start_i
+       else
+         if (deadline .gt. 0) call optimize_bands(2*ne, ne, nproc, r0,         &
+             start_rank-1, i0, 2*max_len, deadline, objective, nelems,         &
+             init_box(1:2*n1), box2)
+         do j=1,2*ne
+           do i=1,ne
+             box4(i,j) = box2(2*ne-j+1,mirror_i(i))
+           end do
+         end do
+       end if
+       exit
+     else
+       tmp_box2(:,:) = box2(:,:)
+     end if
+   end do
+   if (debug) print *, '========== end panel 6 =========='
+!
+!
+! panel 1
+!
+   box4(ne+1:2*ne,1:ne) = -1 ! candidate mask
+   start_i = 1
+   call start_panel(4*n1, box4)
+   do
+     nfree = count(box4 .eq. -1)
+     call find_optimal_band_ws(2*ne, 2*ne, nproc, start_rank, start_i, nelems, &
+         objective, box4, band_work, ret)
+     if (stalled(count(box4 .eq. -1), ret(2) .gt. ne)) return
+     max_len = max(max_len, ret(1) - start_rank)
+     start_rank = ret(1)
+     start_i = ret(2)
+!
+     if (start_i .gt. ne) then
+       if (deadline .gt. 0) call optimize_bands(2*ne, 2*ne, nproc, r0,         &
+           start_rank-1, i0, 2*max_len, deadline, objective, nelems,           &
+           init_box, box4)
+       box2(1:ne,:) = box4(ne+1:2*ne,1:ne)
+       cube_rank(:,:,6) = box4(1:ne,ne+1:2*ne)
+       cube_rank(:,:,1) = box4(1:ne,1:ne)
+       exit
+     end if
+   end do
+   if (debug) print *, '========== end panel 1 =========='
+!
+!
+! panel 2
+!
+   box2(ne+1:2*ne,:) = -1  ! candidate mask
+   start_i = start_i - ne
+   call start_panel(2*n1, box2)
+   do
+     nfree = count(box2 .eq. -1)
+     call find_optimal_band_ws(2*ne, ne, nproc, start_rank, start_i, nelems,   &
+         objective, box2, band_work(1:4*ne*ne), ret)
+     if (stalled(count(box2 .eq. -1), ret(2) .gt. ne)) return
+     max_len = max(max_len, ret(1) - start_rank)
+     start_rank = ret(1)
+     start_i = ret(2)
+!
+     if (start_i .gt. ne) then
+       if (deadline .gt. 0) call optimize_bands(2*ne, ne, nproc, r0,           &
+           start_rank-1, i0, 2*max_len, deadline, objective, nelems,           &
+           init_box(1:2*n1), box2)
+       do j=1,ne
+         do i=1,ne
+           tmp_box2(i,j) = box2(ne+i,ne-j+1)
+           cube_rank(i,j,2) = box2(i,j)
+         end do
+       end do
+       exit
+     end if
+   end do
+   if (debug) print *, '========== end panel 2 =========='
+!
+!
+! panel 3
+!
+   box2(1:ne,:) = tmp_box2(1:ne,:)
+   box2(ne+1:2*ne,:) = -1  ! candidate mask
+   start_i = start_i - ne
+   call start_panel(2*n1, box2)
+   do 
+     prev_start_rank = start_rank
+     prev_start_i = start_i
+     nfree = count(box2 .eq. -1)
+     call find_optimal_band_ws(2*ne, ne, nproc, start_rank, start_i, nelems,   &
+         objective, box2, band_work(1:4*ne*ne), ret)
+     if (stalled(count(box2 .eq. -1), ret(2) .gt. ne)) return
+     max_len = max(max_len, ret(1) - start_rank)
+     start_rank = ret(1)
+     start_i = ret(2)
+!
+     if (start_i .gt. ne) then
+       if (count(box2(ne:2*ne,:) .ne. -1) .gt.                                 &
+           count(tmp_box2(1:ne,:) .eq. -1)) then
+         if (deadline .gt. 0) call optimize_bands(2*ne, ne, nproc, r0,         &
+             prev_start_rank-1, i0, 2*max_len, deadline, objective, nelems,    &
+             init_box(1:2*n1), tmp_box2)
+         do j=1,2*ne
+           do i=1,ne
+             box4(i,j) = tmp_box2(2*ne-j+1,i)
+           end do
+         end do
+         start_rank = prev_start_rank
+         start_i = prev_start_i
+       else
+         if (deadline .gt. 0) call optimize_bands(2*ne, ne, nproc, r0,         &
+             start_rank-1, i0, 2*max_len, deadline, objective, nelems,         &
+             init_box(1:2*n1), box2)
+         do j=1,2*ne
+           do i=1,ne
+             box4(i,j) = box2(2*ne-j+1,i)
+           end do
+         end do
+       end if
+       exit
+     else
+       tmp_box2(:,:) = box2(:,:)
+     end if
+   end do
+   if (debug) print *, '========== end panel 3 =========='
+!
+!
+! panel 4,5
+!
+   box4(ne+1:2*ne,1:ne) = -1  ! candidate mask
+   start_i = 1
+   call start_panel(4*n1, box4)
+   do
+     prev_start_rank = start_rank
+     nfree = count(box4 .eq. -1)
+     call find_optimal_band_ws(2*ne, 2*ne, nproc, start_rank, start_i, nelems, &
+         objective, box4, band_work, ret)
+     if (stalled(count(box4 .eq. -1), count(box4 .eq. -1) .eq. 0)) return
+     max_len = max(max_len, ret(1) - start_rank)
+     start_rank = ret(1)
+     start_i = ret(2)
+!
+     if (count(box4.eq.-1) .eq. 0) then
+       if (deadline .gt. 0) call optimize_bands(2*ne, 2*ne, nproc, r0,         &
+           start_rank-1, i0, 2*max_len, deadline, objective, nelems,           &
+           init_box, box4)
+       do j=1,ne
+       do i=start_i,2*ne
+         if (box4(i,j).eq.-1) box4(i,j) = 0
+       end do
+       end do
+       do j=1,ne
+         do i=1,ne
+           cube_rank(i,j,3) = box4(ne-j+1,2*ne-i+1)
+           cube_rank(i,j,4) = box4(ne-j+1,ne-i+1)
+           cube_rank(i,j,5) = box4(ne+i,ne-j+1)
+         end do
+       end do
+       exit
+     end if
+   end do
+   if (debug) print *, '========== end panel 4,5 =========='
+   if (any(cube_rank.eq.-1)) stop 'cube_rank has -1 rank number'
+!
+!
+! rearrange last bands
+!
+   call rearrange_bands(ne, nproc, nbands, objective, nelems, box4,            &
+       band_work(1:n1), band_work(n1+1:2*n1), band_work(2*n1+1:3*n1),          &
+       band_work(3*n1+1:4*n1), band_work(4*n1+1:5*n1), cube_rank)
+   if (debug) print *, '========== end rearrange last bands =========='
+!
+   if (any(cube_rank.eq.-1)) stop 'cube_rank has -1 rank number'
+   if (deadline .gt. 0) deallocate(init_box)
+!
+   contains
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function mirror_i(i) result(k)
+!-------------------------------------------------------------------------------
+! column of the panel 6 box moved to the column i of box4
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: i
+   integer :: k
+!-------------------------------------------------------------------------------
+!
+   k = i
+   if (mirror .eq. 1) k = ne - i + 1
+!
+   end function mirror_i
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function stalled(new_nfree, done) result(stall)
+!-------------------------------------------------------------------------------
+! the band search returned its start without filling the box before
+! the panel is done, the cube_rank is marked -1
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: new_nfree
+   logical, intent(in   ) :: done
+   logical :: stall
+!-------------------------------------------------------------------------------
+!
+   stall = .not. done .and. ret(1) .eq. start_rank .and.                       &
+       ret(2) .eq. start_i .and. new_nfree .eq. nfree
+   if (stall) cube_rank(:,:,:) = -1
+!
+   end function stalled
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine start_panel(n, box)
+!-------------------------------------------------------------------------------
+! keep the state at the start of a panel for optimize_bands()
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: n
+   integer, intent(in   ) :: box(n)
+!-------------------------------------------------------------------------------
+!
+   r0 = start_rank
+   i0 = start_i
+   max_len = 0
+   if (deadline .gt. 0) init_box(1:n) = box(:)
+!
+   end subroutine start_panel
+!-------------------------------------------------------------------------------
+!
+   end subroutine band_partition_boxes
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine optimize_bands(nx, ny, nproc, start_rank, end_rank, start_i,     &
+       max_len, deadline, objective, nelems, init_box, box)
+!-------------------------------------------------------------------------------
+! split the ranks start_rank~end_rank of the greedy bands in the box again
+! with segment_bands() from the state init_box at the start of the panel
+!
+! The box is replaced if the same elements are filled and the objective
+! is lower, so the next panels are not changed.
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: start_rank, end_rank  ! start from zero
+   integer, intent(in   ) :: start_i
+   integer, intent(in   ) :: max_len  ! maximum number of the ranks in a band
+   integer(int64), intent(in   ) :: deadline
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(in   ) :: nelems(0:nproc-1)
+   integer, intent(in   ) :: init_box(nx,ny)
+   integer, intent(inout) :: box(nx,ny)
+!
+   integer, allocatable :: state_box(:,:), new_box(:,:)
+   logical :: found
+!-------------------------------------------------------------------------------
+!
+   if (end_rank .le. start_rank) return
+!
+   allocate(state_box(nx,ny), new_box(nx,ny))
+   call segment_bands(nx, ny, nproc, start_rank, end_rank, start_i,            &
+       nproc, max(max_len,1), deadline, objective, nelems, init_box,           &
+       state_box, new_box, found)
+!
+   if (found) then
+     if (all((new_box.ge.start_rank) .eqv. (box.ge.start_rank)) .and.          &
+         all((new_box.eq.-1) .eqv. (box.eq.-1))) then
+       if (band_objective(nx, ny, start_rank, end_rank, 1, nx, objective,     &
+           new_box) .lt. band_objective(nx, ny, start_rank, end_rank, 1, nx,  &
+           objective, box)) box(:,:) = new_box(:,:)
+     end if
+   end if
+   deallocate(state_box, new_box)
+!
+   end subroutine optimize_bands
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine rearrange_bands(ne, nproc, nbands, objective, nelems, box4, box, &
+       tmp_box, best_box, kbox, state_box, cube_rank)
+!-------------------------------------------------------------------------------
+! rearrange the last bands in the panel 5 with the minimum objective
+!
+! The splits of the last two bands are evaluated in parallel and only their
+! ratios are kept, the best one is filled again in the best_box.
+! The panel 5 is kept if no split fills it (the first row of the panel
+! changes the rank inside a band when the ranks are narrower than the band).
+! nbands > 2: the best splits of the last nbands bands by segment_bands(),
+!             taken if the objective is lower than the two bands
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ne, nproc
+   integer, intent(in   ) :: nbands
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(in   ) :: nelems(nproc)
+   integer, intent(in   ) :: box4(2*ne,2*ne)
+   integer, intent(inout) :: box(ne,ne), tmp_box(ne,ne), best_box(ne,ne)
+   integer, intent(inout) :: kbox(ne,ne), state_box(ne,ne)  ! nbands > 2
+   integer, intent(inout) :: cube_rank(ne,ne,6)
+!
+   integer :: i, j, k
+   integer :: start_i
+   integer :: num_block
+   integer :: band1_start_rank, band2_start_rank, bandk_start_rank
+   real(8) :: ratio
+   real(8), allocatable :: ratios(:)
+   integer, allocatable :: cand_box(:,:)  ! of every thread
+   logical :: found
+!-------------------------------------------------------------------------------
+!
+   band1_start_rank = box4(2*ne,1)
+   band2_start_rank = band1_start_rank
+   do i=2*ne-1,ne+1,-1
+     band2_start_rank = box4(i,1)
+     if (band2_start_rank .ne. band1_start_rank) exit
+   end do
+   num_block = nproc - band2_start_rank
+   if (debug) print *, 'num_block', num_block
+!
+   call free_band_ranks(band2_start_rank, box, start_i)
+   if (debug) print *, 'start_i', start_i
+!
+   if (count(box(:,:).eq.-1) .eq. ne*ne) return
+!
+   ! k=num_block is the one band, the first minimum is taken
+   allocate(ratios(num_block))
+!$omp parallel private(cand_box) num_threads(get_num_threads())               &
+!$omp   if(num_block*ne*ne .ge. min_omp_work)
+   allocate(cand_box(ne,ne))
+!$omp do schedule(dynamic)
+   do k=1,num_block
+     ratios(k) = split_ratio(k, cand_box)
+   end do
+!$omp end do
+   deallocate(cand_box)
+!$omp end parallel
+!
+   k = minloc(ratios, dim=1)
+   if (ratios(k) .lt. huge(1.D0)) then
+     ratio = split_ratio(k, best_box)
+   else
+     best_box(:,:) = box4(ne+1:2*ne,1:ne)
+   end if
+   deallocate(ratios)
+!
+   ! the bands from the nbands-th last band
+   if (nbands .gt. 2) then
+     ! a band starts where the rank of the first row drops
+     bandk_start_rank = band1_start_rank
+     j = 1
+     do i=2*ne-1,ne+1,-1
+       if (j .eq. nbands) exit
+       if (box4(i,1) .lt. bandk_start_rank) then
+         bandk_start_rank = box4(i,1)
+         j = j + 1
+       end if
+     end do
+!
+     ! all elements of the ranks from bandk_start_rank are in the panel 5
+     call free_band_ranks(bandk_start_rank, kbox, start_i)
+     if (bandk_start_rank .lt. band2_start_rank .and.                          &
+         count(kbox(:,:).eq.-1) .eq. sum(nelems(bandk_start_rank+1:nproc))) then
+       call segment_bands(ne, ne, nproc, bandk_start_rank, nproc-1, start_i,  &
+           nbands, nproc, 0_int64, objective, nelems, kbox, state_box,        &
+           tmp_box, found)
+       if (found) then
+         if (band_objective(ne, ne, bandk_start_rank, nproc-1, 1, ne,          &
+             objective, tmp_box) .lt. band_objective(ne, ne, bandk_start_rank, &
+             nproc-1, 1, ne, objective, best_box)) best_box(:,:) = tmp_box(:,:)
+       end if
+     end if
+   end if
+!
+   do j=1,ne
+     do i=1,ne
+       cube_rank(i,j,5) = best_box(i,ne-j+1)
+     end do
+   end do
+!
+   contains
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine free_band_ranks(first_rank, fbox, first_i)
+!-------------------------------------------------------------------------------
+! the panel 5 with the ranks from first_rank freed
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: first_rank
+   integer, intent(  out) :: fbox(ne,ne)
+   integer, intent(  out) :: first_i
+!
+   integer :: i, j
+!-------------------------------------------------------------------------------
+!
+   fbox(:,:) = box4(ne+1:2*ne,1:ne)
+   first_i = 1
+   do i=ne,1,-1
+     do j=ne,1,-1
+       if (fbox(i,j) .ge. first_rank) then
+         fbox(i,j) = -1
+         first_i = i
+       end if
+     end do
+   end do
+!
+   end subroutine free_band_ranks
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function split_ratio(k, cand_box) result(ratio)
+!-------------------------------------------------------------------------------
+! the last k ranks in the last band and the others in the band before
+! k=num_block: all in one band
+! the mean weighted by the elements of the bands (the maximum for
+! obj_max_comm), huge if the bands do not fill the panel
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: k
+   integer, intent(  out) :: cand_box(ne,ne)
+   real(8) :: ratio
+!
+   integer :: nelem1, nelem2
+   integer :: i12(4)  ! (i1, i2, band_elem, remain_elem)
+   real(8) :: ratio1, ratio2
+!-------------------------------------------------------------------------------
+!
+   cand_box(:,:) = box(:,:)
+   i12(:) = (/start_i, start_i, count(cand_box(start_i,:).eq.-1), -1/)
+   if (k .eq. num_block) then
+     ratio = calc_band_objective(ne, ne, nproc,                                &
+         band2_start_rank, nproc-1, nelems, objective, i12, cand_box)
+!
+   else
+     ratio2 = calc_band_objective(ne, ne, nproc,                               &
+         band2_start_rank, nproc-k-1, nelems, objective, i12, cand_box)
+     nelem2 = sum(nelems(band2_start_rank:nproc-k-1))
+     if (ratio2 .lt. 0.D0) then
+       ratio = huge(1.D0)
+       return
+     end if
+!
+     i12(:) = (/i12(2), i12(2), count(cand_box(i12(2),:).eq.-1), -1/)
+     ratio1 = calc_band_objective(ne, ne, nproc,                               &
+         nproc-k, nproc-1, nelems, objective, i12, cand_box)
+     nelem1 = sum(nelems(nproc-k:nproc-1))
+!
+     if (objective(1) .eq. obj_max_comm) then
+       ratio = max(ratio2, ratio1)
+     else
+       ratio = (ratio2*nelem2 + ratio1*nelem1)/(nelem2 + nelem1)
+     end if
+     if (ratio1 .lt. 0.D0) ratio = huge(1.D0)
+   end if
+   if (ratio .lt. 0.D0 .or. any(cand_box(:,:).eq.-1)) ratio = huge(1.D0)
+!
+   end function split_ratio
+!-------------------------------------------------------------------------------
+!
+   end subroutine rearrange_bands
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine segment_bands(nx, ny, nproc, start_rank, end_rank, start_i,      &
+       max_bands, max_len, deadline, objective, nelems, box, state_box,        &
+       new_box, found)
+!-------------------------------------------------------------------------------
+! split the ranks start_rank~end_rank into the bands over the box
+! with the minimum sum of the objectives of the ranks (dynamic programming),
+! the minimum maximum for obj_max_comm
+!
+! After the bands of the ranks start_rank~r, the free elements of the box
+! depend only on r, so the ratio of a band is independent of the splits
+! before it. The bands from the a-th rank are evaluated in parallel
+! on the state after the a-th rank, O(nrank*max_len) band evaluations.
+!
+! The bands whose band_ratio_bound() can not lower f are not filled
+! (obj_perimeter).
+!
+! max_bands: maximum number of the bands (>= nrank: no limit)
+! max_len  : maximum number of the ranks in a band
+! deadline : system_clock count to give up the search (0: no limit)
+! found is .false. if no split fills the box or the deadline is passed.
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: start_rank, end_rank  ! start from zero
+   integer, intent(in   ) :: start_i
+   integer, intent(in   ) :: max_bands, max_len
+   integer(int64), intent(in   ) :: deadline
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(in   ) :: nelems(0:nproc-1)
+   integer, intent(in   ) :: box(nx,ny)  ! the ranks from start_rank are free
+   integer, intent(inout) :: state_box(nx,ny)  ! scratch
+   integer, intent(  out) :: new_box(nx,ny)
+   logical, intent(  out) :: found
+!
+   integer :: a, b, t, nrank, nb, t0
+   real(8) :: gap
+   integer :: i12(4), state_i12(4)  ! (i1, i2, band_elem, remain_elem)
+   integer(int64) :: clock
+   logical :: timeout
+   real(8) :: ratio, cost
+   real(8), allocatable :: f(:,:)    ! (0:nb,0:nrank) minimum sum of the ratios
+   integer, allocatable :: par(:,:)  ! (0:nb,nrank) start of the last band
+   real(8), allocatable :: costs(:)  ! (nrank) ratio sum of the band a~b-1
+   integer, allocatable :: cand_box(:,:)  ! of every thread
+   integer, allocatable :: splits(:)
+!-------------------------------------------------------------------------------
+!
+   ! f(t,b): t bands for the first b ranks, only f(0,b) without the limit
+   nrank = end_rank - start_rank + 1
+   nb = min(max_bands, nrank)
+   if (nb .eq. nrank) nb = 0
+   t0 = min(1, nb)
+   allocate(f(0:nb,0:nrank), par(0:nb,nrank), costs(nrank))
+   f(:,:) = huge(1.D0)
+   f(0,0) = 0.D0
+   par(:,:) = 0
+   timeout = .false.
+!
+   do a=0,nrank-1
+     if (all(f(0:max(nb-1,0),a) .ge. huge(1.D0))) cycle
+     if (deadline .gt. 0) then
+       call system_clock(clock)
+       timeout = clock .gt. deadline
+       if (timeout) exit
+     end if
+!
+     ! the state after the ranks start_rank~start_rank+a-1
+     state_box(:,:) = box(:,:)
+     state_i12(:) = (/start_i, start_i, count(box(start_i,:).eq.-1), -1/)
+     if (a .gt. 0) then
+       if (.not. band_fits(nx, ny, nproc, start_rank, start_rank+a-1, nelems, &
+           state_i12, state_box)) cycle
+       ratio = calc_perimeter_ratio(nx, ny, nproc,                             &
+           start_rank, start_rank+a-1, nelems, state_i12, state_box)
+       state_i12(:) = (/state_i12(2), state_i12(2),                            &
+           count(state_box(state_i12(2),:).eq.-1), -1/)
+     end if
+!
+     ! only the columns of the band are restored in the cand_box
+     costs(:) = -1.D0  ! not filling
+!$omp parallel private(cand_box, i12, ratio, gap, t)                         &
+!$omp   num_threads(get_num_threads())                                        &
+!$omp   if((min(nrank,a+max_len)-a)*nx*ny .ge. min_omp_work)
+     allocate(cand_box(nx,ny))
+     cand_box(:,:) = state_box(:,:)
+!$omp do schedule(dynamic)
+     do b=a+1,min(nrank,a+max_len)
+       ! the lowest f(t,b) - f(t-1,a) to improve
+       gap = -1.D0
+       do t=t0,nb
+         if (f(max(t-1,0),a) .ge. huge(1.D0)) cycle
+         if (f(t,b) .ge. huge(1.D0)) then
+           gap = huge(1.D0)
+         else
+           gap = max(gap, f(t,b) - f(max(t-1,0),a))
+         end if
+       end do
+       if (gap.lt.huge(1.D0) .and. objective(1).eq.obj_perimeter) then
+         if (band_ratio_bound(ny, nx-state_i12(1)+1, b-a,                      &
+             nelems(start_rank+a:start_rank+b-1))*(b-a) .gt. gap + bound_tol) &
+           cycle
+       end if
+!
+       i12(:) = state_i12(:)
+       if (band_fits(nx, ny, nproc, start_rank+a, start_rank+b-1, nelems,     &
+           i12, state_box)) then
+         ratio = calc_band_objective(nx, ny, nproc,                            &
+             start_rank+a, start_rank+b-1, nelems, objective, i12, cand_box)
+         if (ratio .ge. 0.D0) then
+           costs(b) = ratio*(b-a)
+           if (objective(1) .eq. obj_max_comm) costs(b) = ratio
+         end if
+         cand_box(i12(1):i12(2),:) = state_box(i12(1):i12(2),:)
+       end if
+     end do
+!$omp end do
+     deallocate(cand_box)
+!$omp end parallel
+!
+     do b=a+1,min(nrank,a+max_len)
+       if (costs(b) .lt. 0.D0) cycle
+       do t=t0,nb
+         if (f(max(t-1,0),a) .ge. huge(1.D0)) cycle
+         cost = f(max(t-1,0),a) + costs(b)
+         if (objective(1) .eq. obj_max_comm)                                   &
+           cost = max(f(max(t-1,0),a), costs(b))
+         if (cost .lt. f(t,b)) then
+           f(t,b) = cost
+           par(t,b) = a
+         end if
+       end do
+     end do
+   end do
+!
+   ! the fewest bands among the equal minimums
+   t = -1
+   if (.not. timeout) then
+     do b=t0,nb
+       if (f(b,nrank) .lt. huge(1.D0)) then
+         if (t .lt. 0) then
+           t = b
+         else if (f(b,nrank) .lt. f(t,nrank)) then
+           t = b
+         end if
+       end if
+     end do
+   end if
+   found = t .ge. 0
+!
+   if (found) then
+     allocate(splits(0:nrank))
+     splits(0) = nrank
+     nb = 0
+     do while (splits(nb) .gt. 0)
+       splits(nb+1) = par(t,splits(nb))
+       nb = nb + 1
+       t = max(t-1, 0)
+     end do
+!
+     new_box(:,:) = box(:,:)
+     i12(:) = (/start_i, start_i, count(box(start_i,:).eq.-1), -1/)
+     do b=nb,1,-1
+       ratio = calc_perimeter_ratio(nx, ny, nproc,                             &
+           start_rank+splits(b), start_rank+splits(b-1)-1, nelems, i12, new_box)
+       i12(:) = (/i12(2), i12(2), count(new_box(i12(2),:).eq.-1), -1/)
+     end do
+     deallocate(splits)
+   end if
+!
+   deallocate(f, par, costs)
+!
+   end subroutine segment_bands
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function band_fits(nx, ny, nproc, start_rank, end_rank, nelems, i12, box)   &
+       result(fits)
+!-------------------------------------------------------------------------------
+! calc_perimeter_ratio() fills the band of start_rank~end_rank:
+! the band ends in the box, it is not a single column before nx,
+! and the remain elements are the top run of the free elements of i2
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: nx, ny
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: start_rank, end_rank
+   integer, intent(in   ) :: nelems(0:nproc-1)
+   integer, intent(in   ) :: i12(4)  ! (i1, i2, band_elem, remain_elem)
+   integer, intent(in   ) :: box(nx,ny)
+   logical :: fits
+!
+   integer :: i1, i2, j, j2
+   integer :: band_elem, required_elem, remain_elem
+!-------------------------------------------------------------------------------
+!
+   i1 = i12(1)
+   i2 = i12(2)
+   band_elem = i12(3)
+!
+   required_elem = sum(nelems(start_rank:end_rank))
+   do while (i2.lt.nx .and. required_elem.gt.band_elem)
+     i2 = i2 + 1
+     band_elem = band_elem + count(box(i2,:) .eq. -1)
+     if (i2 .eq. nx) exit
+   end do
+!
+   fits = .not. (i2.eq.nx .and. required_elem.gt.band_elem) .and.             &
+          .not. (i2.ne.nx .and. i1.eq.i2)
+   if (.not. fits) return
+!
+   remain_elem = band_elem - required_elem
+   if (remain_elem .gt. 0) then
+     do j2=ny,1,-1
+       if (box(i2,j2) .eq. -1) exit
+     end do
+     do j=j2,j2-remain_elem+1,-1
+       if (j .lt. 1) then
+         fits = .false.
+       else if (box(i2,j) .ne. -1) then
+         fits = .false.
+       end if
+       if (.not. fits) exit
+     end do
+   end if
+!
+   end function band_fits
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine make_cube_rank(ne, nproc, nelems, cube_rank, cube_lid)
+!-------------------------------------------------------------------------------
+! assign the process numbers to elements on the cubed-sphere
+! using the band-partitioning
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer,                     intent(in   ) :: ne, nproc
+   integer, dimension(nproc),   intent(  out) :: nelems
+   integer, dimension(ne,ne,6), intent(  out) :: cube_rank
+   integer, dimension(ne,ne,6), intent(  out) :: cube_lid
+!
+   integer, allocatable :: work(:)
+!-------------------------------------------------------------------------------
+!
+   allocate(work(band_work_size(ne)))
+   call make_cube_rank_ws(ne, nproc, 2, 0.D0, 0, perimeter_objective, work,    &
+       nelems, cube_rank, cube_lid)
+   deallocate(work)
+!
+   end subroutine make_cube_rank
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine make_cube_rank_ws(ne, nproc, nbands, budget, unfolding,          &
+       objective, work, nelems, cube_rank, cube_lid)
+!-------------------------------------------------------------------------------
+! make_cube_rank() with the caller-provided workspace
+! nbands   : number of the last bands to rearrange (2: the default)
+! budget   : seconds for the optimal band splits (<= 0: greedy)
+! unfolding: route of the bands, see band_partition_ws() (0: the default)
+! objective: (kind, np, max_nbrs) of the band search, see find_optimal_band()
+! work     : scratch of band_work_size(ne)
+! The cube_rank and cube_lid are -1 if the bands can not go on.
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer,                     intent(in   ) :: ne, nproc
+   integer,                     intent(in   ) :: nbands
+   real(8),                     intent(in   ) :: budget
+   integer,                     intent(in   ) :: unfolding
+   integer, dimension(3),       intent(in   ) :: objective
+   integer, dimension(16*ne*ne),intent(inout) :: work
+   integer, dimension(nproc),   intent(  out) :: nelems
+   integer, dimension(ne,ne,6), intent(  out) :: cube_rank
+   integer, dimension(ne,ne,6), intent(  out) :: cube_lid
+!
+   real(8), allocatable :: capacity(:)
+!-------------------------------------------------------------------------------
+!
+   allocate(capacity(nproc))
+   capacity(:) = 1.D0
+   call band_cube_rank(ne, nproc, nbands, budget, unfolding, objective,       &
+       capacity, work, nelems, cube_rank)
+   call make_cube_lid(ne, nproc, cube_rank, cube_lid)
+   deallocate(capacity)
+!
+   end subroutine make_cube_rank_ws
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine make_cube_rank_capacity(ne, nproc, nbands, budget, unfolding,    &
+       objective, capacity, edge_nbrs, corner_nbrs, work, nelems, cube_rank,   &
+       cube_lid)
+!-------------------------------------------------------------------------------
+! make_cube_rank_ws() with the nelems in proportion to the capacity of
+! the ranks (relative speeds), see band_cube_rank()
+!
+! The uneven nelems can leave a rank of the bands in pieces, so the ranks
+! are connected again by connect_ranks() with the nelems kept.
+! edge_nbrs, corner_nbrs: the neighbor tables, see make_elem_ring()
+! The cube_rank and cube_lid are -1 if the bands can not go on or
+! the ranks can not be connected.
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer,                     intent(in   ) :: ne, nproc
+   integer,                     intent(in   ) :: nbands
+   real(8),                     intent(in   ) :: budget
+   integer,                     intent(in   ) :: unfolding
+   integer, dimension(3),       intent(in   ) :: objective
+   real(8), dimension(nproc),   intent(in   ) :: capacity
+   integer, dimension(4,6*ne*ne),intent(in   ) :: edge_nbrs
+   integer, dimension(4,6*ne*ne),intent(in   ) :: corner_nbrs
+   integer, dimension(16*ne*ne),intent(inout) :: work
+   integer, dimension(nproc),   intent(  out) :: nelems
+   integer, dimension(ne,ne,6), intent(  out) :: cube_rank
+   integer, dimension(ne,ne,6), intent(  out) :: cube_lid
+!
+   integer, allocatable :: ring(:,:)
+!-------------------------------------------------------------------------------
+!
+   call band_cube_rank(ne, nproc, nbands, budget, unfolding, objective,       &
+       capacity, work, nelems, cube_rank)
+   if (cube_rank(1,1,1).ne.-1 .and. nproc.gt.3) then
+     allocate(ring(8,6*ne*ne))
+     call make_elem_ring(ne, edge_nbrs, corner_nbrs, ring)
+     call connect_ranks(ne, nproc, ring, nelems, cube_rank)
+     deallocate(ring)
+   end if
+!
+!
+! local numbering
+!
+   call make_cube_lid(ne, nproc, cube_rank, cube_lid)
+!
+   end subroutine make_cube_rank_capacity
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine band_cube_rank(ne, nproc, nbands, budget, unfolding, objective,  &
+       capacity, work, nelems, cube_rank)
+!-------------------------------------------------------------------------------
+! the band partitioning with the nelems in proportion to the capacity of
+! the ranks (relative speeds), see capacity_nelems()
+!
+! The nelems go to the band partitioning as they are, the same capacities
+! give the nelems of make_cube_rank() (the remain elements to the last
+! ranks). With nproc <= 3 the whole panels are split along the route
+! (6, 1, 2, 3, 4, 5) in proportion to the capacity.
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer,                     intent(in   ) :: ne, nproc
+   integer,                     intent(in   ) :: nbands
+   real(8),                     intent(in   ) :: budget
+   integer,                     intent(in   ) :: unfolding
+   integer, dimension(3),       intent(in   ) :: objective
+   real(8), dimension(nproc),   intent(in   ) :: capacity
+   integer, dimension(16*ne*ne),intent(inout) :: work
+   integer, dimension(nproc),   intent(  out) :: nelems
+   integer, dimension(ne,ne,6), intent(  out) :: cube_rank
+!
+   integer, parameter :: route_panels(6)=(/6,1,2,3,4,5/)
+   integer :: i, k
+   real(8), dimension(nproc) :: rev_capacity
+!-------------------------------------------------------------------------------
+!
+! the remain elements to the last ranks
+!
+   rev_capacity(:) = capacity(nproc:1:-1)
+   if (nproc .le. 3) then
+     call capacity_nelems(6, nproc, rev_capacity, nelems)
+     nelems(:) = nelems(nproc:1:-1)
+     k = 0
+     do i=1,nproc
+       cube_rank(:,:,route_panels(k+1:k+nelems(i))) = i - 1
+       k = k + nelems(i)
+     end do
+     nelems(:) = ne*ne*nelems(:)
+   else
+     call capacity_nelems(ne*ne*6, nproc, rev_capacity, nelems)
+     nelems(:) = nelems(nproc:1:-1)
+     call band_partition_ws(ne, nproc, nbands, budget, unfolding, objective,   &
+         nelems, work, cube_rank)
+   end if
+!
+   end subroutine band_cube_rank
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine make_cube_rank_weighted(ne, nproc, nbands, budget, unfolding,    &
+       objective, capacity, weights, tol, edge_nbrs, corner_nbrs, work,        &
+       nelems, rank_weights, cube_rank, cube_lid)
+!-------------------------------------------------------------------------------
+! make_cube_rank_capacity() with the sums of the element weights balanced
+! in proportion to the capacity, i.e. the times rank_weights/capacity
+!
+! The ranks follow the route of the bands, so the nelems are cut again
+! toward the equal shares of the weights along the route (the weights taken
+! uniform in a rank) and the bands are searched again with them, keeping
+! the nelems of the lowest maximum weight. The ranks of the bands are
+! connected by connect_ranks(), the nelems the bands can not take or
+! the ranks can not be connected with are cut again from the kept ones
+! by the half step. The step of the cut is damped while the maximum
+! weight does not go down, the search stops within the tol or when the
+! nelems repeat. The rank boundaries are then moved by
+! refine_rank_weights().
+! budget      : seconds for the optimal band splits with the nelems kept,
+!               taken if the maximum weight stays within the tol
+!               or not above the greedy one (<= 0: greedy)
+! tol         : relative excess of the maximum time over the mean
+! edge_nbrs, corner_nbrs: the neighbor tables, see make_elem_ring()
+! nelems      : the elements of every rank after the refinement
+! rank_weights: sum of the element weights of every rank
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer,                     intent(in   ) :: ne, nproc
+   integer,                     intent(in   ) :: nbands
+   real(8),                     intent(in   ) :: budget
+   integer,                     intent(in   ) :: unfolding
+   integer, dimension(3),       intent(in   ) :: objective
+   real(8), dimension(nproc),   intent(in   ) :: capacity
+   real(8), dimension(ne,ne,6), intent(in   ) :: weights
+   real(8),                     intent(in   ) :: tol
+   integer, dimension(4,6*ne*ne),intent(in   ) :: edge_nbrs
+   integer, dimension(4,6*ne*ne),intent(in   ) :: corner_nbrs
+   integer, dimension(16*ne*ne),intent(inout) :: work
+   integer, dimension(nproc),   intent(  out) :: nelems
+   real(8), dimension(nproc),   intent(  out) :: rank_weights
+   integer, dimension(ne,ne,6), intent(  out) :: cube_rank
+   integer, dimension(ne,ne,6), intent(  out) :: cube_lid
+!
+   integer, parameter :: max_iter=20
+   real(8), parameter :: decay=0.7D0  ! of the step of the cut
+   integer :: iter
+   real(8) :: step, excess, prev_excess, best_excess
+   integer, allocatable :: best_nelems(:), new_nelems(:)
+   integer, allocatable :: best_rank(:,:,:)
+   integer, allocatable :: ring(:,:)
+!-------------------------------------------------------------------------------
+!
+   call make_cube_rank_capacity(ne, nproc, nbands, 0.D0, unfolding, objective, &
+       capacity, edge_nbrs, corner_nbrs, work, nelems, cube_rank, cube_lid)
+   rank_weights(:) = 0.D0
+   if (cube_rank(1,1,1) .eq. -1) return
+   excess = weight_excess(cube_rank)
+   if (nproc .le. 3) return
+!
+   allocate(best_nelems(nproc), new_nelems(nproc), best_rank(ne,ne,6))
+   allocate(ring(8,6*ne*ne))
+   call make_elem_ring(ne, edge_nbrs, corner_nbrs, ring)
+   best_nelems(:) = nelems(:)
+   best_rank(:,:,:) = cube_rank(:,:,:)
+   best_excess = excess
+   prev_excess = excess
+   step = decay
+   do iter=1,max_iter
+     if (best_excess .le. tol) exit
+     call cut_nelems(step, new_nelems)
+     if (all(new_nelems(:) .eq. nelems(:))) exit
+!
+     call band_partition_ws(ne, nproc, nbands, 0.D0, unfolding, objective,    &
+         new_nelems, work, cube_rank)
+     if (cube_rank(1,1,1) .ne. -1)                                            &
+       call connect_ranks(ne, nproc, ring, new_nelems, cube_rank)
+     if (cube_rank(1,1,1) .eq. -1) then
+       ! ranks too large for the bands or not connected,
+       ! cut again from the same nelems
+       step = 0.5D0*step
+       cycle
+     end if
+     nelems(:) = new_nelems(:)
+     excess = weight_excess(cube_rank)
+     if (debug) print *, 'iter, step, excess', iter, step, excess
+     if (excess .lt. best_excess) then
+       best_nelems(:) = nelems(:)
+       best_rank(:,:,:) = cube_rank(:,:,:)
+       best_excess = excess
+     end if
+     if (excess .ge. prev_excess) step = decay*step
+     prev_excess = excess
+   end do
+   nelems(:) = best_nelems(:)
+   cube_rank(:,:,:) = best_rank(:,:,:)
+!
+   if (budget .gt. 0.D0) then
+     call band_partition_ws(ne, nproc, nbands, budget, unfolding, objective,  &
+         nelems, work, best_rank)
+     if (best_rank(1,1,1) .ne. -1)                                            &
+       call connect_ranks(ne, nproc, ring, nelems, best_rank)
+     if (best_rank(1,1,1) .ne. -1) then
+       if (weight_excess(best_rank) .le. max(tol, best_excess))               &
+         cube_rank(:,:,:) = best_rank(:,:,:)
+     end if
+   end if
+   excess = weight_excess(cube_rank)
+   if (excess .gt. tol) call refine_rank_weights(ne, nproc, ring, capacity,   &
+       weights, nelems, rank_weights, cube_rank)
+   call make_cube_lid(ne, nproc, cube_rank, cube_lid)
+   deallocate(best_nelems, new_nelems, best_rank, ring)
+!
+   contains
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function weight_excess(rank) result(ratio)
+!-------------------------------------------------------------------------------
+! the rank_weights of the rank and the excess of the maximum time over the mean
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: rank(ne,ne,6)
+   real(8) :: ratio
+!
+   integer :: ei, ej, p
+!-------------------------------------------------------------------------------
+!
+   rank_weights(:) = 0.D0
+   do p=1,6
+     do ej=1,ne
+       do ei=1,ne
+         rank_weights(rank(ei,ej,p)+1) = rank_weights(rank(ei,ej,p)+1) +     &
+             weights(ei,ej,p)
+       end do
+     end do
+   end do
+   ratio = maxval(rank_weights/capacity)*sum(capacity)/sum(rank_weights) - 1
+!
+   end function weight_excess
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine cut_nelems(step, cut)
+!-------------------------------------------------------------------------------
+! the nelems moved by the step toward the shares of the rank_weights
+! in proportion to the capacity along the ranks, at least one element
+! in every rank
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   real(8), intent(in   ) :: step
+   integer, intent(  out) :: cut(nproc)
+!
+   integer :: k, r, b, prev_b
+   integer :: elem0   ! elements before the rank r
+   real(8) :: weight0 ! weights before the rank r
+   real(8) :: share, target
+!-------------------------------------------------------------------------------
+!
+   r = 1
+   elem0 = 0
+   weight0 = 0.D0
+   prev_b = 0
+   do k=1,nproc-1
+     share = sum(rank_weights)*sum(capacity(1:k))/sum(capacity)
+     do while (r.lt.nproc .and. weight0+rank_weights(r).lt.share)
+       weight0 = weight0 + rank_weights(r)
+       elem0 = elem0 + nelems(r)
+       r = r + 1
+     end do
+     target = elem0 + (share - weight0)/rank_weights(r)*nelems(r)
+     b = sum(nelems(1:k))
+     b = nint(b + step*(target - b))
+     b = min(max(b, prev_b+1), 6*ne*ne-(nproc-k))
+     cut(k) = b - prev_b
+     prev_b = b
+   end do
+   cut(nproc) = 6*ne*ne - prev_b
+!
+   end subroutine cut_nelems
+!-------------------------------------------------------------------------------
+!
+   end subroutine make_cube_rank_weighted
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine make_elem_ring(ne, edge_nbrs, corner_nbrs, ring)
+!-------------------------------------------------------------------------------
+! the eight elements around every element from the neighbor tables
+! edge_nbrs(4,6*ne*ne)  : (W,E,S,N) neighbor element indices, start from zero
+! corner_nbrs(4,6*ne*ne): (SW,SE,NW,NE), -1 at the cube corners
+! ring(8,6*ne*ne)       : (W,NW,N,NE,E,SE,S,SW) element indices, start from
+!                         one, 0 at the cube corners, the sides are odd
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ne
+   integer, intent(in   ) :: edge_nbrs(4,6*ne*ne)
+   integer, intent(in   ) :: corner_nbrs(4,6*ne*ne)
+   integer, intent(  out) :: ring(8,6*ne*ne)
+!
+   integer :: e
+!-------------------------------------------------------------------------------
+!
+   do e=1,6*ne*ne
+     ring(:,e) = (/edge_nbrs(1,e), corner_nbrs(3,e), edge_nbrs(4,e),           &
+                   corner_nbrs(4,e), edge_nbrs(2,e), corner_nbrs(2,e),         &
+                   edge_nbrs(3,e), corner_nbrs(1,e)/) + 1
+   end do
+!
+   end subroutine make_elem_ring
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function ring_pieces(ring_e, cube_rank, rank) result(pieces)
+!-------------------------------------------------------------------------------
+! pieces of the sides of the rank around an element (ring_e: its ring),
+! two sides in a row are in a piece if the corner between them is the rank
+! The rank stays connected without the element if the pieces are <= 1.
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ring_e(8)
+   integer, intent(in   ) :: cube_rank(:)
+   integer, intent(in   ) :: rank
+   integer :: pieces
+!
+   integer :: d
+   logical :: in_rank(8)
+!-------------------------------------------------------------------------------
+!
+   do d=1,8
+     in_rank(d) = .false.
+     if (ring_e(d) .gt. 0) in_rank(d) = cube_rank(ring_e(d)) .eq. rank
+   end do
+   pieces = count(in_rank(1:7:2))
+   do d=1,7,2
+     if (in_rank(d) .and. in_rank(d+1) .and. in_rank(mod(d+1,8)+1))           &
+       pieces = pieces - 1
+   end do
+!
+   end function ring_pieces
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine push_elem(e, rank, head, next, prev)
+!-------------------------------------------------------------------------------
+! put the element e at the head of the element list of the rank
+! head(0:nproc-1), next(n), prev(n): the lists of the ranks, 0 at the ends
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: e, rank
+   integer, intent(inout) :: head(0:), next(:), prev(:)
+!-------------------------------------------------------------------------------
+!
+   prev(e) = 0
+   next(e) = head(rank)
+   if (head(rank) .ne. 0) prev(head(rank)) = e
+   head(rank) = e
+!
+   end subroutine push_elem
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine pop_elem(e, rank, head, next, prev)
+!-------------------------------------------------------------------------------
+! take the element e out of the element list of the rank
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: e, rank
+   integer, intent(inout) :: head(0:), next(:), prev(:)
+!-------------------------------------------------------------------------------
+!
+   if (prev(e) .ne. 0) then
+     next(prev(e)) = next(e)
+   else
+     head(rank) = next(e)
+   end if
+   if (next(e) .ne. 0) prev(next(e)) = prev(e)
+!
+   end subroutine pop_elem
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine connect_ranks(ne, nproc, ring, nelems, cube_rank)
+!-------------------------------------------------------------------------------
+! connect every rank through the element sides with the nelems kept
+!
+! The elements out of the largest piece of their rank go to the neighbor
+! rank of the most sides on its largest piece, then the ranks over their
+! nelems pass an element to the next rank along the shortest chain of the
+! neighbor ranks up to a rank under its nelems, from the start of the
+! chain so that every rank takes an element before it passes one.
+! A rank passes an element only if it stays connected without it (see
+! stays_connected()), so the ranks stay connected.
+! If a pass is no longer possible, the next chain starts from that rank.
+! ring: from make_elem_ring()
+! The cube_rank is -1 if the ranks can not be connected.
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ne, nproc
+   integer, intent(in   ) :: ring(8,6*ne*ne)
+   integer, intent(in   ) :: nelems(0:nproc-1)
+   integer, intent(inout) :: cube_rank(6*ne*ne)
+!
+   integer :: n, e, f, d, d2, k, top, npiece, moved, left
+   integer :: a, b, c, s, t, qh, qt, ntouch, iter, max_iter, nchain, stamp
+   integer :: nblock
+   integer :: sides, best, best_sides, gain
+   integer, allocatable :: piece(:), piece_size(:), main_piece(:)
+   integer, allocatable :: stack(:), counts(:)
+   integer, allocatable :: head(:), next(:), prev(:)  ! element lists of ranks
+   integer, allocatable :: parent(:), via(:), via_gain(:), queue(:), touch(:)
+   integer, allocatable :: chain(:), mark(:), block(:,:)
+   logical :: ok
+   logical, allocatable :: in_main(:), visited(:)
+!-------------------------------------------------------------------------------
+!
+   n = 6*ne*ne
+   allocate(piece(n), piece_size(n), main_piece(0:nproc-1), stack(n))
+   allocate(counts(0:nproc-1), in_main(n))
+!
+!
+! pieces of the ranks, the largest one of every rank is the main piece
+!
+   counts(:) = 0
+   piece(:) = 0
+   npiece = 0
+   main_piece(:) = 0
+   do e=1,n
+     counts(cube_rank(e)) = counts(cube_rank(e)) + 1
+     if (piece(e) .ne. 0) cycle
+     npiece = npiece + 1
+     piece(e) = npiece
+     piece_size(npiece) = 0
+     top = 1
+     stack(1) = e
+     do while (top .gt. 0)
+       f = stack(top)
+       top = top - 1
+       piece_size(npiece) = piece_size(npiece) + 1
+       do d=1,7,2
+         if (cube_rank(ring(d,f)).eq.cube_rank(e) .and.                        &
+             piece(ring(d,f)).eq.0) then
+           piece(ring(d,f)) = npiece
+           top = top + 1
+           stack(top) = ring(d,f)
+         end if
+       end do
+     end do
+     a = cube_rank(e)
+     if (main_piece(a) .eq. 0) then
+       main_piece(a) = npiece
+     else if (piece_size(npiece) .gt. piece_size(main_piece(a))) then
+       main_piece(a) = npiece
+     end if
+   end do
+   if (npiece .eq. count(counts .gt. 0)) then
+     deallocate(piece, piece_size, main_piece, stack, counts, in_main)
+     return
+   end if
+   do e=1,n
+     in_main(e) = piece(e) .eq. main_piece(cube_rank(e))
+   end do
+!
+!
+! the other pieces to the main pieces of the neighbor ranks
+!
+   do
+     moved = 0
+     left = 0
+     do e=1,n
+       if (in_main(e)) cycle
+       best = -1
+       best_sides = 0
+       do d=1,7,2
+         f = ring(d,e)
+         if (.not. in_main(f)) cycle
+         b = cube_rank(f)
+         if (b .eq. cube_rank(e)) cycle
+         sides = 0
+         do d2=1,7,2
+           if (in_main(ring(d2,e))) then
+             if (cube_rank(ring(d2,e)) .eq. b) sides = sides + 1
+           end if
          end do
-         start_rank = prev_start_rank
-         start_i = prev_start_i
+         if (sides .gt. best_sides) then
+           best = b
+           best_sides = sides
+         end if
+       end do
+       if (best .ge. 0) then
+         counts(cube_rank(e)) = counts(cube_rank(e)) - 1
+         counts(best) = counts(best) + 1
+         cube_rank(e) = best
+         in_main(e) = .true.
+         moved = moved + 1
        else
-         do j=1,2*ne
-           do i=1,ne
-             box4(i,j) = box2(2*ne-j+1,i)
-           end do
+         left = left + 1
+       end if
+     end do
+     if (left.eq.0 .or. moved.eq.0) exit
+   end do
+   deallocate(piece, piece_size, main_piece, stack, in_main)
+   if (left .gt. 0) then
+     cube_rank(:) = -1
+     deallocate(counts)
+     return
+   end if
+!
+!
+! the nelems along the chains of the neighbor ranks
+!
+   allocate(head(0:nproc-1), next(n), prev(n))
+   allocate(parent(0:nproc-1), via(0:nproc-1), via_gain(0:nproc-1))
+   allocate(queue(nproc), touch(nproc), chain(nproc), visited(0:nproc-1))
+   allocate(mark(n), stack(n), block(2,n))
+   mark(:) = 0
+   stamp = 0
+   head(:) = 0
+   do e=n,1,-1
+     call push_elem(e, cube_rank(e), head, next, prev)
+   end do
+!
+   max_iter = n
+   s = 0
+   nblock = 0
+   do iter=1,max_iter
+     do while (s .lt. nproc)
+       if (counts(s) .gt. nelems(s)) exit
+       s = s + 1
+     end do
+     if (s .eq. nproc) exit
+!
+     ! the shortest chain from the rank s to a rank under its nelems,
+     ! via(b): the element passed to the rank b from its parent rank
+     visited(:) = .false.
+     via(:) = 0
+     visited(s) = .true.
+     queue(1) = s
+     qh = 1
+     qt = 1
+     t = -1
+     do while (qh.le.qt .and. t.lt.0)
+       a = queue(qh)
+       qh = qh + 1
+       ntouch = 0
+       e = head(a)
+       do while (e .ne. 0)
+         ok = .false.
+         do d=1,7,2
+           b = cube_rank(ring(d,e))
+           if (b.ne.a .and. .not.visited(b)) ok = .true.
          end do
+         if (ok) ok = stays_connected(e, a)
+         if (ok) then
+           do d=1,7,2
+             b = cube_rank(ring(d,e))
+             if (b.eq.a .or. visited(b)) cycle
+             if (blocked(a, b)) cycle
+             gain = 0
+             do d2=1,7,2
+               if (cube_rank(ring(d2,e)) .eq. b) gain = gain + 1
+               if (cube_rank(ring(d2,e)) .eq. a) gain = gain - 1
+             end do
+             if (via(b) .eq. 0) then
+               ntouch = ntouch + 1
+               touch(ntouch) = b
+             else if (gain .le. via_gain(b)) then
+               cycle
+             end if
+             via(b) = e
+             via_gain(b) = gain
+           end do
+         end if
+         e = next(e)
+       end do
+       do k=1,ntouch
+         b = touch(k)
+         visited(b) = .true.
+         parent(b) = a
+         qt = qt + 1
+         queue(qt) = b
+         if (t.lt.0 .and. counts(b).lt.nelems(b)) t = b
+       end do
+     end do
+     if (t .lt. 0) then
+       s = s + 1  ! no chain from the rank s
+       cycle
+     end if
+!
+     nchain = 1
+     chain(1) = t
+     do while (chain(nchain) .ne. s)
+       chain(nchain+1) = parent(chain(nchain))
+       nchain = nchain + 1
+     end do
+     ! the same chain again while it goes through up to the rank t
+     do
+       do k=nchain,2,-1
+         a = chain(k)
+         b = chain(k-1)
+         c = -1
+         if (k .gt. 2) c = chain(k-2)
+         e = pass_elem(a, b, c, via(b))
+         if (e .eq. 0) then
+           nblock = nblock + 1
+           block(:,nblock) = (/a, b/)
+           exit
+         end if
+         call pop_elem(e, a, head, next, prev)
+         call push_elem(e, b, head, next, prev)
+         cube_rank(e) = b
+         counts(a) = counts(a) - 1
+         counts(b) = counts(b) + 1
+       end do
+       if (k .ne. 1) exit
+       nblock = 0
+       if (counts(s).le.nelems(s) .or. counts(t).ge.nelems(t)) exit
+     end do
+     s = 0
+   end do
+   if (any(counts(:) .ne. nelems(:))) cube_rank(:) = -1
+   deallocate(counts, head, next, prev, parent, via, via_gain, queue, touch,  &
+       chain, visited, mark, stack, block)
+!
+   contains
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function pass_elem(ra, rb, rc, e0) result(e)
+!-------------------------------------------------------------------------------
+! the element the rank ra can pass to the rank rb such that the rank rb
+! can pass one on to the rank rc (rc < 0: rb is the end of the chain),
+! e0 if it still can, else the one of the most sides on rb over the
+! sides on ra (0: none)
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ra, rb, rc, e0
+   integer :: e
+!
+   integer :: f, d, gain, best_gain
+!-------------------------------------------------------------------------------
+!
+   e = 0
+   if (counts(ra) .le. 1) return
+   if (e0 .ne. 0) then
+     if (can_pass(e0, ra, rb)) then
+       if (passes_on(e0, ra, rb, rc)) then
+         e = e0
+         return
+       end if
+     end if
+   end if
+   best_gain = -huge(0)
+   f = head(ra)
+   do while (f .ne. 0)
+     if (can_pass(f, ra, rb)) then
+       gain = 0
+       do d=1,7,2
+         if (cube_rank(ring(d,f)) .eq. rb) gain = gain + 1
+         if (cube_rank(ring(d,f)) .eq. ra) gain = gain - 1
+       end do
+       if (gain .gt. best_gain) then
+         if (passes_on(f, ra, rb, rc)) then
+           e = f
+           best_gain = gain
+         end if
        end if
-       exit
-     else
-       tmp_box2(:,:) = box2(:,:)
      end if
+     f = next(f)
    end do
-   if (debug) print *, '========== end panel 3 =========='
 !
+   end function pass_elem
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function passes_on(f, ra, rb, rc) result(ok)
+!-------------------------------------------------------------------------------
+! the rank rb can pass an element to the rank rc after it takes the
+! element f from the rank ra
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: f, ra, rb, rc
+   logical :: ok
+!
+   integer :: g
+!-------------------------------------------------------------------------------
+!
+   ok = rc .lt. 0
+   if (ok) return
+   cube_rank(f) = rb
+   counts(ra) = counts(ra) - 1
+   counts(rb) = counts(rb) + 1
+   ok = can_pass(f, rb, rc)
+   g = head(rb)
+   do while (g.ne.0 .and. .not.ok)
+     ok = can_pass(g, rb, rc)
+     g = next(g)
+   end do
+   cube_rank(f) = ra
+   counts(ra) = counts(ra) + 1
+   counts(rb) = counts(rb) - 1
+!
+   end function passes_on
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function can_pass(f, ra, rb) result(ok)
+!-------------------------------------------------------------------------------
+! the element f of the rank ra has a side on the rank rb and the rank ra
+! stays connected without it
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: f, ra, rb
+   logical :: ok
+!
+   integer :: d
+!-------------------------------------------------------------------------------
+!
+   ok = .false.
+   if (cube_rank(f) .ne. ra) return
+   do d=1,7,2
+     if (cube_rank(ring(d,f)) .eq. rb) ok = .true.
+   end do
+   if (ok) ok = stays_connected(f, ra)
+!
+   end function can_pass
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function blocked(ra, rb) result(ok)
+!-------------------------------------------------------------------------------
+! the rank ra could not pass an element to the rank rb since the last
+! chain that went through
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ra, rb
+   logical :: ok
+!
+   integer :: i
+!-------------------------------------------------------------------------------
+!
+   ok = .false.
+   do i=1,nblock
+     if (block(1,i).eq.ra .and. block(2,i).eq.rb) ok = .true.
+   end do
+!
+   end function blocked
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function stays_connected(f, r) result(ok)
+!-------------------------------------------------------------------------------
+! the rank r stays connected without its element f, first by its sides
+! around f (see ring_pieces()), else by a fill of the rank r
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: f, r
+   logical :: ok
+!
+   integer :: g, h, d, top, nfill
+!-------------------------------------------------------------------------------
+!
+   ok = ring_pieces(ring(:,f), cube_rank, r) .le. 1
+   if (ok .or. counts(r).le.1) return
+!
+   stamp = stamp + 1
+   mark(f) = stamp
+   nfill = 0
+   top = 0
+   do d=1,7,2
+     if (cube_rank(ring(d,f)) .eq. r) top = d
+   end do
+   mark(ring(top,f)) = stamp
+   stack(1) = ring(top,f)
+   top = 1
+   do while (top .gt. 0)
+     g = stack(top)
+     top = top - 1
+     nfill = nfill + 1
+     do d=1,7,2
+       h = ring(d,g)
+       if (cube_rank(h).eq.r .and. mark(h).ne.stamp) then
+         mark(h) = stamp
+         top = top + 1
+         stack(top) = h
+       end if
+     end do
+   end do
+   ok = nfill .eq. counts(r) - 1
+!
+   end function stays_connected
+!-------------------------------------------------------------------------------
+!
+   end subroutine connect_ranks
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine refine_rank_weights(ne, nproc, ring, capacity, weights, nelems,  &
+       rank_weights, cube_rank)
+!-------------------------------------------------------------------------------
+! move the boundary elements of the ranks over their share of the weights
+! (in proportion to the capacity) to the neighbor ranks of less time
+! (rank_weights/capacity)
+!
+! An element is moved if the weight of its rank gets closer to the share
+! and the neighbor rank stays faster than its rank was, so the maximum
+! time never goes up, and if the sides of its rank around it stay
+! connected through the corners (no new pieces of the rank). The element
+! with the most sides on the neighbor rank over the sides on its rank is
+! moved first (the least perimeter).
+! The passes over the ranks go on while elements are moved, up to max_pass,
+! so the weight spreads over the ranks in between.
+! ring: from make_elem_ring()
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ne, nproc
+   integer, intent(in   ) :: ring(8,6*ne*ne)
+   real(8), intent(in   ) :: capacity(0:nproc-1)
+   real(8), intent(in   ) :: weights(6*ne*ne)
+   integer, intent(inout) :: nelems(0:nproc-1)
+   real(8), intent(inout) :: rank_weights(0:nproc-1)
+   integer, intent(inout) :: cube_rank(6*ne*ne)
+!
+   integer, parameter :: max_pass=100
+   integer :: n, e, d, d2, pass, moves
+   integer :: src, dst, nbr_rank, best, best_dst, gain, best_gain
+   real(8) :: weight_rate  ! weights per capacity
+   real(8) :: share
+   integer, allocatable :: head(:), next(:), prev(:)  ! element lists of ranks
+!-------------------------------------------------------------------------------
+!
+   n = 6*ne*ne
+   allocate(head(0:nproc-1), next(n), prev(n))
+   head(:) = 0
+   do e=n,1,-1
+     call push_elem(e, cube_rank(e), head, next, prev)
+   end do
+!
+   weight_rate = sum(rank_weights)/sum(capacity)
+   do pass=1,max_pass
+     moves = 0
+     do src=0,nproc-1
+       share = weight_rate*capacity(src)
+       do while (rank_weights(src).gt.share .and. nelems(src).gt.1)
+         best = 0
+         best_dst = -1
+         best_gain = -huge(0)
+         e = head(src)
+         do while (e .ne. 0)
+           if (weights(e).lt.2*(rank_weights(src) - share) .and.              &
+               ring_pieces(ring(:,e), cube_rank, src).le.1) then
+             do d=1,7,2
+               nbr_rank = cube_rank(ring(d,e))
+               if (nbr_rank .eq. src) cycle
+               if ((rank_weights(nbr_rank) + weights(e))/capacity(nbr_rank)    &
+                   .ge. rank_weights(src)/capacity(src)) cycle
+               gain = 0
+               do d2=1,7,2
+                 if (cube_rank(ring(d2,e)) .eq. nbr_rank) gain = gain + 1
+                 if (cube_rank(ring(d2,e)) .eq. src) gain = gain - 1
+               end do
+               if (gain .eq. best_gain) then
+                 if (rank_weights(nbr_rank)/capacity(nbr_rank) .ge.            &
+                     rank_weights(best_dst)/capacity(best_dst)) cycle
+               else if (gain .lt. best_gain) then
+                 cycle
+               end if
+               best = e
+               best_dst = nbr_rank
+               best_gain = gain
+             end do
+           end if
+           e = next(e)
+         end do
+         if (best .eq. 0) exit
+!
+         dst = best_dst
+         call pop_elem(best, src, head, next, prev)
+         call push_elem(best, dst, head, next, prev)
+         cube_rank(best) = dst
+         nelems(src) = nelems(src) - 1
+         nelems(dst) = nelems(dst) + 1
+         rank_weights(src) = rank_weights(src) - weights(best)
+         rank_weights(dst) = rank_weights(dst) + weights(best)
+         moves = moves + 1
+       end do
+     end do
+     if (moves .eq. 0) exit
+   end do
+   deallocate(head, next, prev)
+!
+   end subroutine refine_rank_weights
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine refine_rank_times(ne, np, nproc, costs, capacity, edge_nbrs,     &
+       corner_nbrs, cube_rank, nelems, cube_lid, times)
+!-------------------------------------------------------------------------------
+! move the boundary elements of the ranks over the mean time to the
+! neighbor ranks, with the predicted time of a rank
+!   elem_cost*nelems/capacity + point_cost*comm_pts + msg_cost*num_msgs
+! comm_pts: as global_communication_ratio(), num_msgs: as
+! global_neighbor_count(), both kept up to date over the moves
+!
+! An element is moved if the times of its rank, the neighbor rank and the
+! ranks around the element (their messages) all end below the time its
+! rank had, so the maximum time never goes up, and if the sides of its
+! rank around it stay connected through the corners. The move of the
+! lowest time at the end is taken first.
+! The passes over the ranks go on while elements are moved, up to max_pass.
+! The moves can lower the mean time more than the maximum, so the
+! partition of the lowest max/mean ratio after a pass is returned, the
+! given one if no pass lowers its ratio.
+!
+! costs      : (elem_cost, point_cost, msg_cost)
+! capacity   : relative speeds of the ranks
+! edge_nbrs, corner_nbrs: the neighbor tables, see make_elem_ring()
+! times      : predicted time of every rank after the moves
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: ne, np, nproc
+   real(8), intent(in   ) :: costs(3)
+   real(8), intent(in   ) :: capacity(0:nproc-1)
+   integer, intent(in   ) :: edge_nbrs(4,6*ne*ne)
+   integer, intent(in   ) :: corner_nbrs(4,6*ne*ne)
+   integer, intent(inout) :: cube_rank(6*ne*ne)
+   integer, intent(  out) :: nelems(0:nproc-1)
+   integer, intent(  out) :: cube_lid(6*ne*ne)
+   real(8), intent(  out) :: times(0:nproc-1)
+!
+   integer, parameter :: max_pass=100
+   integer :: n, e, d, d2, pass, moves
+   integer :: src, nbr_rank, best, best_dst
+   integer :: wts(8)  ! communication points of the ring directions
+   real(8) :: mean_time, end_time, best_time
+   real(8) :: ratio, best_ratio  ! max/mean time ratios
+   integer, allocatable :: ring(:,:)  ! (8,n) see make_elem_ring()
+   integer, allocatable :: best_rank(:)
+   integer, allocatable :: head(:), next(:), prev(:)  ! element lists of ranks
+   integer, allocatable :: comm_pts(:), num_msgs(:)
+   integer, allocatable :: slot_rank(:,:)  ! (max_slot,nproc) neighbor ranks
+   integer, allocatable :: slot_cnt(:,:)   ! ring pairs with the neighbor ranks
+!-------------------------------------------------------------------------------
+!
+   n = 6*ne*ne
+   wts(1:7:2) = np
+   wts(2:8:2) = 1
+   allocate(ring(8,n), head(0:nproc-1), next(n), prev(n))
+   allocate(comm_pts(0:nproc-1), num_msgs(0:nproc-1))
+   allocate(slot_rank(16,0:nproc-1), slot_cnt(16,0:nproc-1), best_rank(n))
+   call make_elem_ring(ne, edge_nbrs, corner_nbrs, ring)
+   call count_times()
+   best_rank(:) = cube_rank(:)
+   best_ratio = maxval(times)*nproc/sum(times)
+!
+   do pass=1,max_pass
+     moves = 0
+     mean_time = sum(times)/nproc
+     do src=0,nproc-1
+       do while (times(src).gt.mean_time .and. nelems(src).gt.1)
+         best = 0
+         best_dst = -1
+         best_time = times(src)
+         e = head(src)
+         do while (e .ne. 0)
+           if (ring_pieces(ring(:,e), cube_rank, src) .le. 1) then
+             do d=1,7,2
+               nbr_rank = cube_rank(ring(d,e))
+               if (nbr_rank .eq. src) cycle
+               do d2=1,d-2,2
+                 if (cube_rank(ring(d2,e)) .eq. nbr_rank) exit
+               end do
+               if (d2 .lt. d) cycle  ! the neighbor rank is tried
+!
+               end_time = move_elem(e, src, nbr_rank)
+               if (end_time .lt. best_time) then
+                 best = e
+                 best_dst = nbr_rank
+                 best_time = end_time
+               end if
+               end_time = move_elem(e, nbr_rank, src)
+             end do
+           end if
+           e = next(e)
+         end do
+         if (best .eq. 0) exit
+!
+         end_time = move_elem(best, src, best_dst)
+         call pop_elem(best, src, head, next, prev)
+         call push_elem(best, best_dst, head, next, prev)
+         moves = moves + 1
+       end do
+     end do
+     if (moves .eq. 0) exit
+     ratio = maxval(times)*nproc/sum(times)
+     if (ratio .lt. best_ratio) then
+       best_rank(:) = cube_rank(:)
+       best_ratio = ratio
+     end if
+   end do
+   if (any(cube_rank(:) .ne. best_rank(:))) then
+     cube_rank(:) = best_rank(:)
+     call count_times()
+   end if
+!
+   call make_cube_lid(ne, nproc, cube_rank, cube_lid)
+   deallocate(ring, head, next, prev, comm_pts, num_msgs, slot_rank, slot_cnt, &
+       best_rank)
+!
+   contains
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine count_times()
+!-------------------------------------------------------------------------------
+! the element lists, nelems, communication points, messages and times of
+! the ranks of the cube_rank
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer :: e, d, src, nbr_rank
+!-------------------------------------------------------------------------------
+!
+   head(:) = 0
+   nelems(:) = 0
+   comm_pts(:) = 0
+   num_msgs(:) = 0
+   slot_rank(:,:) = -1
+   slot_cnt(:,:) = 0
+   do e=n,1,-1
+     src = cube_rank(e)
+     call push_elem(e, src, head, next, prev)
+     nelems(src) = nelems(src) + 1
+     do d=1,8
+       if (ring(d,e) .eq. 0) cycle
+       nbr_rank = cube_rank(ring(d,e))
+       if (nbr_rank .eq. src) cycle
+       comm_pts(src) = comm_pts(src) + wts(d)
+       call add_pair(src, nbr_rank, 1)
+     end do
+   end do
+   do src=0,nproc-1
+     times(src) = rank_time(src)
+   end do
+!
+   end subroutine count_times
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function rank_time(rank) result(time)
+!-------------------------------------------------------------------------------
+! predicted time of the rank
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: rank
+   real(8) :: time
+!-------------------------------------------------------------------------------
+!
+   time = costs(1)*nelems(rank)/capacity(rank) + costs(2)*comm_pts(rank)      &
+        + costs(3)*num_msgs(rank)
+!
+   end function rank_time
+!-------------------------------------------------------------------------------
 !
-! panel 4,5
 !
-   box4(ne+1:2*ne,1:ne) = -1  ! candidate mask
-   start_i = 1
-   do
-     prev_start_rank = start_rank
-     call find_optimal_band(2*ne, 2*ne, nproc, start_rank, start_i, nelems,    &
-         box4, ret)
-     start_rank = ret(1)
-     start_i = ret(2)
+!-------------------------------------------------------------------------------
+   function move_elem(e, from, to) result(end_time)
+!-------------------------------------------------------------------------------
+! move the element e from the rank from to the rank to (not in the lists),
+! the maximum time of the ranks changed by the move
+!-------------------------------------------------------------------------------
+   implicit none
 !
-     if (count(box4.eq.-1) .eq. 0) then
-       do j=1,ne
-       do i=start_i,2*ne
-         if (box4(i,j).eq.-1) box4(i,j) = 0
-       end do
-       end do
-       do j=1,ne
-         do i=1,ne
-           cube_rank(i,j,3) = box4(ne-j+1,2*ne-i+1)
-           cube_rank(i,j,4) = box4(ne-j+1,ne-i+1)
-           cube_rank(i,j,5) = box4(ne+i,ne-j+1)
-         end do
-       end do
-       exit
+   integer, intent(in   ) :: e, from, to
+   real(8) :: end_time
+!
+   integer :: d, rank
+!-------------------------------------------------------------------------------
+!
+   do d=1,8
+     if (ring(d,e) .eq. 0) cycle
+     rank = cube_rank(ring(d,e))
+     if (rank .ne. from) then
+       comm_pts(from) = comm_pts(from) - wts(d)
+       call add_pair(from, rank, -1)
+       call add_pair(rank, from, -1)
+     else
+       comm_pts(from) = comm_pts(from) + wts(d)
+     end if
+     if (rank .ne. to) then
+       comm_pts(to) = comm_pts(to) + wts(d)
+       call add_pair(to, rank, 1)
+       call add_pair(rank, to, 1)
+     else
+       comm_pts(to) = comm_pts(to) - wts(d)
      end if
    end do
-   if (debug) print *, '========== end panel 4,5 =========='
-   if (any(cube_rank.eq.-1)) stop 'cube_rank has -1 rank number'
+   cube_rank(e) = to
+   nelems(from) = nelems(from) - 1
+   nelems(to) = nelems(to) + 1
+!
+   times(from) = rank_time(from)
+   times(to) = rank_time(to)
+   end_time = max(times(from), times(to))
+   do d=1,8
+     if (ring(d,e) .eq. 0) cycle
+     rank = cube_rank(ring(d,e))
+     times(rank) = rank_time(rank)
+     end_time = max(end_time, times(rank))
+   end do
 !
+   end function move_elem
+!-------------------------------------------------------------------------------
 !
-! rearrange last two bands
 !
-   band1_start_rank = box4(2*ne,1)
-   do i=2*ne-1,ne+1,-1
-     band2_start_rank = box4(i,1)
-     if (band2_start_rank .ne. band1_start_rank) exit
-   end do
-   num_block = nproc - band2_start_rank
-   if (debug) print *, 'num_block', num_block
+!-------------------------------------------------------------------------------
+   subroutine add_pair(rank, nbr, cnt)
+!-------------------------------------------------------------------------------
+! add cnt to the ring pairs of the rank with the nbr rank
+! and count the messages of the rank, the slots grow when full
+!-------------------------------------------------------------------------------
+   implicit none
 !
-   box(:,:) = box4(ne+1:2*ne,1:ne)
-   start_i = 1
-   do i=ne,1,-1
-     do j=ne,1,-1
-       if (box(i,j) .ge. band2_start_rank) then
-         box(i,j) = -1
-         start_i = i
-       end if
-     end do
-   end do
-   if (debug) print *, 'start_i', start_i
+   integer, intent(in   ) :: rank, nbr, cnt
 !
-   if (count(box(:,:).eq.-1) .lt. ne*ne) then
-     allocate(ratios(num_block))
-     allocate(boxes(ne,ne,num_block))
+   integer :: s, slot, max_slot
+   integer, allocatable :: tmp(:,:)
+!-------------------------------------------------------------------------------
 !
-     tmp_box(:,:) = box(:,:)
-     i12(:) = (/start_i, start_i, count(tmp_box(start_i,:).eq.-1), -1/)
-     ratio2 = calc_perimeter_ratio(ne, ne, nproc,                            &
-         band2_start_rank, nproc-1, nelems, i12, tmp_box) 
-     ratios(num_block) = ratio2
-     boxes(:,:,num_block) = tmp_box(:,:)
-!
-     do k=1,num_block-1
-       tmp_box(:,:) = box(:,:)
-       i12(:) = (/start_i, start_i, count(tmp_box(start_i,:).eq.-1), -1/)
-       ratio2 = calc_perimeter_ratio(ne, ne, nproc,                            &
-           band2_start_rank, nproc-k-1, nelems, i12, tmp_box) 
-       nelem2 = sum(nelems(band2_start_rank:nproc-k-1))
-!
-       i12(:) = (/i12(2), i12(2), count(tmp_box(i12(2),:).eq.-1), -1/)
-       ratio1 = calc_perimeter_ratio(ne, ne, nproc,                            &
-           nproc-k, nproc-1, nelems, i12, tmp_box) 
-       nelem1 = sum(nelems(nproc-k:nproc-1))
-!
-       ratios(k) = (ratio2*nelem2 + ratio1*nelem1)/(nelem2 + nelem1)
-       boxes(:,:,k) = tmp_box(:,:)
-     end do
-!
-     k = minloc(ratios, dim=1)
-     do j=1,ne
-       do i=1,ne
-         cube_rank(i,j,5) = boxes(i,ne-j+1,k)
-       end do
-     end do
+   max_slot = size(slot_rank, 1)
+   slot = 0
+   do s=1,max_slot
+     if (slot_rank(s,rank) .eq. nbr) then
+       slot = s
+       exit
+     end if
+     if (slot.eq.0 .and. slot_cnt(s,rank).eq.0) slot = -s  ! first free
+   end do
 !
-     deallocate(boxes)
-     deallocate(ratios)
+   if (slot .eq. 0) then
+     allocate(tmp(2*max_slot,0:nproc-1))
+     tmp(:,:) = -1
+     tmp(1:max_slot,:) = slot_rank(:,:)
+     call move_alloc(tmp, slot_rank)
+     allocate(tmp(2*max_slot,0:nproc-1))
+     tmp(:,:) = 0
+     tmp(1:max_slot,:) = slot_cnt(:,:)
+     call move_alloc(tmp, slot_cnt)
+     slot = max_slot + 1
    end if
-   if (debug) print *, '========== end rearrange last two bands =========='
+   slot = abs(slot)
 !
-   if (any(cube_rank.eq.-1)) stop 'cube_rank has -1 rank number'
+   if (slot_cnt(slot,rank) .eq. 0) num_msgs(rank) = num_msgs(rank) + 1
+   slot_rank(slot,rank) = nbr
+   slot_cnt(slot,rank) = slot_cnt(slot,rank) + cnt
+   if (slot_cnt(slot,rank) .eq. 0) num_msgs(rank) = num_msgs(rank) - 1
 !
-   end subroutine band_partition
+   end subroutine add_pair
+!-------------------------------------------------------------------------------
+!
+   end subroutine refine_rank_times
 !-------------------------------------------------------------------------------
 !
 !
 !-------------------------------------------------------------------------------
-   subroutine make_cube_rank(ne, nproc, nelems, cube_rank, cube_lid)
+   subroutine make_cube_lid(ne, nproc, cube_rank, cube_lid)
 !-------------------------------------------------------------------------------
-! assign the process numbers to elements on the cubed-sphere
-! using the band-partitioning
+! local numbering of the elements in every rank
 !-------------------------------------------------------------------------------
 !
    implicit none
 !
    integer,                     intent(in   ) :: ne, nproc
-   integer, dimension(nproc),   intent(  out) :: nelems
-   integer, dimension(ne,ne,6), intent(  out) :: cube_rank
+   integer, dimension(ne,ne,6), intent(in   ) :: cube_rank
    integer, dimension(ne,ne,6), intent(  out) :: cube_lid
 !
-   integer :: i, ei, ej, p
-   integer :: remain_elem
+   integer :: ei, ej, p
    integer :: proc
-   integer, dimension(0:nproc-1) :: lids
+   integer, allocatable :: lids(:)
 !-------------------------------------------------------------------------------
 !
-! set the nelems
-!
-   remain_elem = mod(ne*ne*6, nproc)
-   do i=1,nproc
-     nelems(i) = ne*ne*6/nproc
-     if (i .gt. nproc-remain_elem) nelems(i) = nelems(i) + 1
-   end do
-!
-!
-! partitioning
-!
-   if (nproc .eq. 1) then
-     cube_rank(:,:,:) = 0
-   else if (nproc .eq. 2) then
-     cube_rank(:,:,6) = 0
-     cube_rank(:,:,1:2) = 0
-     cube_rank(:,:,3:5) = 1
-   else if (nproc .eq. 3) then
-     cube_rank(:,:,6) = 0
-     cube_rank(:,:,1) = 0
-     cube_rank(:,:,2:3) = 1
-     cube_rank(:,:,4:5) = 2
-   else
-     call band_partition(ne, nproc, nelems, cube_rank)
+   if (cube_rank(1,1,1) .eq. -1) then
+     cube_lid(:,:,:) = -1
+     return
    end if
 !
-!
-! local numbering
-!
+   allocate(lids(0:nproc-1))
    lids(:) = 1
    do p=1,6
      do ej=1,ne
@@ -533,8 +3687,9 @@
        end do
      end do
    end do
+   deallocate(lids)
 !
-   end subroutine make_cube_rank
+   end subroutine make_cube_lid
 !-------------------------------------------------------------------------------
 !
 !
@@ -597,6 +3752,9 @@
 !
    num_nbrs(:,:) = 0
 !
+!$omp parallel do collapse(2) private(ei, myrank, w_rank, e_rank, s_rank,     &
+!$omp   n_rank, eij, diff_sides) reduction(+:num_nbrs)                        &
+!$omp   num_threads(get_num_threads()) if(6*ne*ne .ge. min_omp_work)
    do p=1,6
      do ej=1,ne
        do ei=1,ne
@@ -625,6 +3783,7 @@
        end do
      end do
    end do
+!$omp end parallel do
 !
    perimeter_ratio = sum(num_nbrs(2,:)*1.D0/num_nbrs(1,:))/nproc
 !
@@ -656,6 +3815,9 @@
 !
    num_pts(:,:) = 0
 !
+!$omp parallel do collapse(2) private(ei, myrank, nbr_rank, eij, comm_pts)    &
+!$omp   reduction(+:num_pts)                                                  &
+!$omp   num_threads(get_num_threads()) if(6*ne*ne .ge. min_omp_work)
    do p=1,6
      do ej=1,ne
        do ei=1,ne
@@ -714,6 +3876,7 @@
        end do
      end do
    end do
+!$omp end parallel do
 !
    comm_ratio = sum(num_pts(2,:)*1.D0/num_pts(1,:))/nproc
 !
@@ -721,6 +3884,127 @@
 !-------------------------------------------------------------------------------
 !
 !
+!-------------------------------------------------------------------------------
+   function global_neighbor_count(ne, nproc, cube_rank, num_nbrs)              &
+       result(mean_nbrs)
+!-------------------------------------------------------------------------------
+! mean number of the different neighbor ranks in the eight directions,
+! the messages of a rank in the halo exchange
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer, intent(in   ) :: ne
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: cube_rank(ne,ne,6)
+   integer, intent(  out) :: num_nbrs(0:nproc-1)
+   real(8) :: mean_nbrs
+!
+   integer :: n, ei, ej, p
+   integer :: a, b, eij(4)  ! (ei,ej,panel,rot)
+   integer :: myrank, nbr_rank
+   integer, allocatable :: first(:)  ! (0:nproc) elements before a rank
+   integer, allocatable :: elems(:)  ! (6*ne*ne) elements sorted by the rank
+   integer, allocatable :: seen(:)   ! (0:nproc-1) last rank seen the rank
+!-------------------------------------------------------------------------------
+!
+   allocate(first(0:nproc), elems(6*ne*ne), seen(0:nproc-1))
+!
+!
+! elements of every rank
+!
+   first(:) = 0
+   do p=1,6
+     do ej=1,ne
+       do ei=1,ne
+         myrank = cube_rank(ei,ej,p)
+         first(myrank+1) = first(myrank+1) + 1
+       end do
+     end do
+   end do
+   do myrank=1,nproc
+     first(myrank) = first(myrank) + first(myrank-1)
+   end do
+!
+   seen(:) = 0
+   do n=1,6*ne*ne
+     ei = mod(n-1, ne) + 1
+     ej = mod((n-1)/ne, ne) + 1
+     p = (n-1)/(ne*ne) + 1
+     myrank = cube_rank(ei,ej,p)
+     seen(myrank) = seen(myrank) + 1
+     elems(first(myrank) + seen(myrank)) = n
+   end do
+!
+!
+! different neighbor ranks
+!
+   num_nbrs(:) = 0
+   seen(:) = -1
+   do myrank=0,nproc-1
+     do n=first(myrank)+1,first(myrank+1)
+       ei = mod(elems(n)-1, ne) + 1
+       ej = mod((elems(n)-1)/ne, ne) + 1
+       p = (elems(n)-1)/(ne*ne) + 1
+!
+       do b=-1,1
+         do a=-1,1
+           call convert_nbr_eij(ne, ei+a, ej+b, p, eij)
+           if (eij(3) .eq. -1) cycle
+           nbr_rank = cube_rank(eij(1),eij(2),eij(3))
+           if (nbr_rank.ne.myrank .and. seen(nbr_rank).ne.myrank) then
+             seen(nbr_rank) = myrank
+             num_nbrs(myrank) = num_nbrs(myrank) + 1
+           end if
+         end do
+       end do
+     end do
+   end do
+   deallocate(first, elems, seen)
+!
+   mean_nbrs = sum(num_nbrs)*1.D0/nproc
+!
+   end function global_neighbor_count
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function global_objective(ne, nproc, objective, cube_rank) result(ratio)
+!-------------------------------------------------------------------------------
+! objective of the band search over the cube
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer, intent(in   ) :: ne
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: objective(3)  ! (kind, np, max_nbrs)
+   integer, intent(in   ) :: cube_rank(ne,ne,6)
+   real(8) :: ratio
+!
+   integer, allocatable :: num_pts(:,:), num_nbrs(:)
+!-------------------------------------------------------------------------------
+!
+   allocate(num_pts(2,nproc), num_nbrs(nproc))
+   select case (objective(1))
+   case (obj_comm)
+     ratio = global_communication_ratio(ne, objective(2), nproc, cube_rank,    &
+         num_pts)
+   case (obj_max_comm)
+     ratio = global_communication_ratio(ne, objective(2), nproc, cube_rank,    &
+         num_pts)
+     ratio = maxval(num_pts(2,:)*1.D0/num_pts(1,:))
+   case (obj_nbrs)
+     ratio = global_neighbor_count(ne, nproc, cube_rank, num_nbrs)
+   case default
+     ratio = global_perimeter_ratio(ne, nproc, cube_rank, num_pts)
+   end select
+   deallocate(num_pts, num_nbrs)
+!
+   end function global_objective
+!-------------------------------------------------------------------------------
+!
+!
 !-------------------------------------------------------------------------------
    subroutine make_cube_color(ne, nproc, cube_rank, cube_color)
 !-------------------------------------------------------------------------------
@@ -739,11 +4023,11 @@
    integer :: ei, ej, p
    integer :: myrank, nbr_rank
    integer :: a, b, eij(4)  ! (ei,ej,panel,rot)
-   integer :: proc_links(max_nbr,0:nproc-1)
-   integer :: proc_colors(0:nproc-1)  ! color index 1~6
-   integer :: nbr_colors(max_nbr)
+   integer, allocatable :: proc_links(:,:)  ! (max_nbr,0:nproc-1)
+   integer, allocatable :: proc_colors(:)   ! (0:nproc-1) color index 1~6
 !-------------------------------------------------------------------------------
 !
+   allocate(proc_links(max_nbr,0:nproc-1), proc_colors(0:nproc-1))
    proc_links(:,:) = -1
 !
 !
@@ -778,6 +4062,39 @@
 !
 !
 ! color indexing
+!
+   call color_proc_links(nproc, max_nbr, proc_links, proc_colors)
+!
+   do p=1,6
+     do ej=1,ne
+       do ei=1,ne
+         myrank = cube_rank(ei,ej,p)
+         cube_color(ei,ej,p) = proc_colors(myrank)
+       end do
+     end do
+   end do
+   deallocate(proc_links, proc_colors)
+!
+   end subroutine make_cube_color
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine color_proc_links(nproc, max_nbr, proc_links, proc_colors)
+!-------------------------------------------------------------------------------
+! greedy coloring of the ranks with the links to the neighbor ranks
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer, intent(in   ) :: nproc, max_nbr
+   integer, intent(in   ) :: proc_links(max_nbr,0:nproc-1)
+   integer, intent(  out) :: proc_colors(0:nproc-1)  ! color index 1~6
+!
+   integer :: k
+   integer :: myrank
+   integer :: nbr_colors(max_nbr)
+!-------------------------------------------------------------------------------
 !
    proc_colors(:) = -1
    proc_colors(0) = 1
@@ -799,16 +4116,168 @@
      end do
    end do
 !
-   do p=1,6
-     do ej=1,ne
-       do ei=1,ne
-         myrank = cube_rank(ei,ej,p)
-         cube_color(ei,ej,p) = proc_colors(myrank)
-       end do
+   end subroutine color_proc_links
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function global_perimeter_ratio_adj(ne, nproc, edge_nbrs, cube_rank,        &
+       num_nbrs) result(perimeter_ratio)
+!-------------------------------------------------------------------------------
+! global_perimeter_ratio() with the precomputed neighbor table
+! edge_nbrs(4,6*ne*ne): (W,E,S,N) neighbor element indices, start from zero
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer, intent(in   ) :: ne
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: edge_nbrs(4,6*ne*ne)
+   integer, intent(in   ) :: cube_rank(6*ne*ne)
+   integer, intent(  out) :: num_nbrs(2,0:nproc-1)  !(num elem, diff nbrs)
+   real(8) :: perimeter_ratio
+!
+   integer :: e, k
+   integer :: myrank
+   integer :: diff_sides
+!-------------------------------------------------------------------------------
+!
+   num_nbrs(:,:) = 0
+!
+!$omp parallel do private(k, myrank, diff_sides) reduction(+:num_nbrs)         &
+!$omp   num_threads(get_num_threads()) if(6*ne*ne .ge. min_omp_work)
+   do e=1,6*ne*ne
+     myrank = cube_rank(e)
+!
+     diff_sides = 0  ! contact with an element having the different rank
+     do k=1,4
+       if (cube_rank(edge_nbrs(k,e)+1) .ne. myrank) diff_sides = diff_sides + 1
      end do
+!
+     num_nbrs(1,myrank) = num_nbrs(1,myrank) + 1
+     num_nbrs(2,myrank) = num_nbrs(2,myrank) + diff_sides
    end do
+!$omp end parallel do
 !
-   end subroutine make_cube_color
+   perimeter_ratio = sum(num_nbrs(2,:)*1.D0/num_nbrs(1,:))/nproc
+!
+   end function global_perimeter_ratio_adj
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function global_communication_ratio_adj(ne, np, nproc,                      &
+       edge_nbrs, corner_nbrs, cube_rank, num_pts) result(comm_ratio)
+!-------------------------------------------------------------------------------
+! global_communication_ratio() with the precomputed neighbor tables
+! edge_nbrs(4,6*ne*ne)  : (W,E,S,N) neighbor element indices, start from zero
+! corner_nbrs(4,6*ne*ne): (SW,SE,NW,NE), -1 at the cube corners
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer, intent(in   ) :: ne, np
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: edge_nbrs(4,6*ne*ne)
+   integer, intent(in   ) :: corner_nbrs(4,6*ne*ne)
+   integer, intent(in   ) :: cube_rank(6*ne*ne)
+   integer, intent(  out) :: num_pts(2,0:nproc-1)  !(comp points, comm points)
+   real(8) :: comm_ratio
+!
+   integer :: e, k
+   integer :: myrank
+   integer :: comm_pts
+!-------------------------------------------------------------------------------
+!
+   num_pts(:,:) = 0
+!
+!$omp parallel do private(k, myrank, comm_pts) reduction(+:num_pts)            &
+!$omp   num_threads(get_num_threads()) if(6*ne*ne .ge. min_omp_work)
+   do e=1,6*ne*ne
+     myrank = cube_rank(e)
+!
+     comm_pts = 0  ! communication points
+     do k=1,4
+       if (cube_rank(edge_nbrs(k,e)+1) .ne. myrank) comm_pts = comm_pts + np
+     end do
+     do k=1,4
+       if (corner_nbrs(k,e) .eq. -1) cycle
+       if (cube_rank(corner_nbrs(k,e)+1) .ne. myrank) comm_pts = comm_pts + 1
+     end do
+!
+     num_pts(1,myrank) = num_pts(1,myrank) + np*np
+     num_pts(2,myrank) = num_pts(2,myrank) + comm_pts
+   end do
+!$omp end parallel do
+!
+   comm_ratio = sum(num_pts(2,:)*1.D0/num_pts(1,:))/nproc
+!
+   end function global_communication_ratio_adj
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine make_cube_color_adj(ne, nproc, edge_nbrs, corner_nbrs,           &
+       cube_rank, cube_color)
+!-------------------------------------------------------------------------------
+! make_cube_color() with the precomputed neighbor tables
+!-------------------------------------------------------------------------------
+!
+   implicit none
+!
+   integer, intent(in   ) :: ne
+   integer, intent(in   ) :: nproc
+   integer, intent(in   ) :: edge_nbrs(4,6*ne*ne)
+   integer, intent(in   ) :: corner_nbrs(4,6*ne*ne)
+   integer, intent(in   ) :: cube_rank(6*ne*ne)
+   integer, intent(  out) :: cube_color(6*ne*ne)
+!
+   integer, parameter :: max_nbr=20  ! empirical
+   integer :: e, k, n
+   integer :: myrank, nbr_rank
+   integer :: nbrs(8)  ! neighbors in the visiting order of make_cube_color()
+   integer, allocatable :: proc_links(:,:)  ! (max_nbr,0:nproc-1)
+   integer, allocatable :: proc_colors(:)   ! (0:nproc-1) color index 1~6
+!-------------------------------------------------------------------------------
+!
+   allocate(proc_links(max_nbr,0:nproc-1), proc_colors(0:nproc-1))
+   proc_links(:,:) = -1
+!
+!
+! find neighbor ranks
+!
+   do e=1,6*ne*ne
+     myrank = cube_rank(e)
+!
+     nbrs(:) = (/corner_nbrs(1,e), edge_nbrs(3,e), corner_nbrs(2,e),          &
+                 edge_nbrs(1,e), edge_nbrs(2,e),                               &
+                 corner_nbrs(3,e), edge_nbrs(4,e), corner_nbrs(4,e)/)
+     do n=1,8
+       if (nbrs(n) .eq. -1) cycle
+       nbr_rank = cube_rank(nbrs(n)+1)
+       if (nbr_rank .ne. myrank) then
+         do k=1,max_nbr
+           if (proc_links(k,myrank) .eq. nbr_rank) exit
+           if (proc_links(k,myrank) .eq. -1) then
+             proc_links(k,myrank) = nbr_rank
+             exit
+           end if
+         end do
+       end if
+     end do
+   end do
+!
+!
+! color indexing
+!
+   call color_proc_links(nproc, max_nbr, proc_links, proc_colors)
+!
+   do e=1,6*ne*ne
+     cube_color(e) = proc_colors(cube_rank(e))
+   end do
+   deallocate(proc_links, proc_colors)
+!
+   end subroutine make_cube_color_adj
 !-------------------------------------------------------------------------------
 !
 !
@@ -0,0 +1,75 @@
+!-------------------------------------------------------------------------------
+   module cube_threads
+!-------------------------------------------------------------------------------
+!
+! abstract : number of the OpenMP threads of the parallel kernels
+!
+! The kernels run serially without the OpenMP compilation (-fopenmp).
+! The parallel loops accumulate only integers, so the results are
+! bit-identical to the serial ones for any number of threads.
+!
+!-------------------------------------------------------------------------------
+!
+!$ use omp_lib
+!
+   implicit none
+!
+   private
+   integer :: nthreads = 0  ! 0: the OpenMP default (OMP_NUM_THREADS)
+   integer, parameter, public :: min_omp_work = 4096  ! elements per region
+!
+   public :: openmp_enabled
+   public :: set_num_threads
+   public :: get_num_threads
+!
+   contains
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function openmp_enabled() result(enabled)
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer :: enabled
+!-------------------------------------------------------------------------------
+!
+   enabled = 0
+!$ enabled = 1
+!
+   end function openmp_enabled
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   subroutine set_num_threads(n)
+!-------------------------------------------------------------------------------
+! n <= 0 restores the OpenMP default
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer, intent(in   ) :: n
+!-------------------------------------------------------------------------------
+!
+   nthreads = max(n, 0)
+!
+   end subroutine set_num_threads
+!-------------------------------------------------------------------------------
+!
+!
+!-------------------------------------------------------------------------------
+   function get_num_threads() result(n)
+!-------------------------------------------------------------------------------
+   implicit none
+!
+   integer :: n
+!-------------------------------------------------------------------------------
+!
+   n = 1
+!$ n = omp_get_max_threads()
+!$ if (nthreads .gt. 0) n = nthreads
+!
+   end function get_num_threads
+!-------------------------------------------------------------------------------
+!
+   end module cube_threads
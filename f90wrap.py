@@ -10,6 +10,7 @@ history :
 from __future__ import print_function, division
 from ctypes import POINTER, c_int, c_bool, c_double, c_float
 from ctypes import CDLL, RTLD_GLOBAL
+import threading
 import logging
 import numpy as np
 import numpy.ctypeslib as npct
@@ -17,13 +18,82 @@ import numpy.ctypeslib as npct
 
 
 
-def fmod2py(so_dpath, libname, modname, func_args, fdtype='f8'):
+# process-wide session: loaded libraries, bound functions, initialized modules
+_f90_libs = dict()
+_func_dicts = dict()
+_initialized = set()
+_lock = threading.RLock()
+
+
+
+
+def load_f90_lib(so_dpath, libname):
+    '''
+    load a f90 library once per process
+    '''
+    with _lock:
+        key = (so_dpath, libname)
+        if key not in _f90_libs:
+            _f90_libs[key] = npct.load_library(libname, so_dpath)
+            #_f90_libs[key] = ctypes.CDLL(so_dpath+'/'+libname+'.so', mod=RTLD_GLOBAL)
+
+        return _f90_libs[key]
+
+
+
+
+def fmod2py(so_dpath, libname, modname, func_args, fdtype='f8', init_funcs=[]):
     '''
     wrapper of a f90 module to call subroutines and functions
+
+    The library and the bound functions are cached per process,
+    the init_funcs (no arguments) are called once per process.
+    '''
+
+    with _lock:
+        key = (so_dpath, libname, modname, fdtype)
+        if key not in _func_dicts:
+            _func_dicts[key] = dict()
+        func_dict = _func_dicts[key]
+
+        new_args = dict((funcname, args) for funcname, args in func_args.items()
+                        if funcname not in func_dict)
+        if len(new_args) > 0:
+            f90_lib = load_f90_lib(so_dpath, libname)
+            func_dict.update(bind_f90_funcs(f90_lib, modname, new_args, fdtype))
+
+        for funcname in init_funcs:
+            if (key, funcname) not in _initialized:
+                func_dict[funcname]()
+                _initialized.add((key, funcname))
+
+    return func_dict
+
+
+
+
+def out_array(out, shape, dtype='i4'):
+    '''
+    return the caller-provided output buffer after checking it
+    or a new zero array of the shape (Fortran order)
     '''
+    if out is None:
+        return np.zeros(shape, dtype, order='F')
 
-    f90_lib = npct.load_library(libname, so_dpath)
-    #f90_lib = ctypes.CDLL(so_dpath+'/'+libname+'.so', mod=RTLD_GLOBAL)
+    shape = tuple(np.atleast_1d(shape))
+    if out.shape != shape or out.dtype != np.dtype(dtype) or \
+            not out.flags['F_CONTIGUOUS']:
+        raise ValueError('The out buffer must be a {} {} array in Fortran order: {} {}'.format(shape, np.dtype(dtype), out.shape, out.dtype))
+
+    return out
+
+
+
+
+def bind_f90_funcs(f90_lib, modname, func_args, fdtype='f8'):
+    '''
+    set the argument and result types of the f90 module functions
+    '''
 
     ptrs = {'i': POINTER(c_int),
             'bool': POINTER(c_bool),
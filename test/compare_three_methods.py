@@ -8,6 +8,7 @@ Metrics:
   - Mean perimeter ratio (boundary elements / total elements per partition)
   - Communication ratio for Spectral Element Method (Np=4)
   - Total communication traffic
+  - Pairwise exchange rounds vs maximum number of neighbor ranks
   - Partitioning wall-clock time
 '''
 
@@ -23,60 +24,26 @@ sys.path.append(lib_dir)
 
 from cube_partition_sfc import CubePartitionSFC
 from cube_partition_stripe import CubePartitionStripe
-from cube_neighbor import CubeNeighbor
+from cube_adjacency import get_cube_adjacency
+from cube_halo import CubeHaloPlan
 
 
-def build_cubed_sphere_adjacency(ne):
-    '''
-    Build the adjacency list for the cubed-sphere grid.
-    Each element (ei, ej, panel) is a node.
-    Edges connect 4-neighbors (N, S, E, W) across panel boundaries.
-    Returns adjacency list suitable for pymetis.
-    '''
-    cn = CubeNeighbor()
-    n_total = 6 * ne * ne
-
-    def eid(ei, ej, p):
-        return (p - 1) * ne * ne + (ej - 1) * ne + (ei - 1)
-
-    adjacency = [[] for _ in range(n_total)]
-
-    for p in range(1, 7):
-        for ej in range(1, ne + 1):
-            for ei in range(1, ne + 1):
-                me = eid(ei, ej, p)
-                for (di, dj) in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                    nei, nej, np_ei, np_ej = ei + di, ej + dj, 0, 0
-                    ret = cn.convert_nbr_eij(ne, nei, nej, p)
-                    nbr_ei, nbr_ej, nbr_p = int(ret[0]), int(ret[1]), int(ret[2])
-                    if nbr_p >= 1:
-                        nbr = eid(nbr_ei, nbr_ej, nbr_p)
-                        if nbr not in adjacency[me]:
-                            adjacency[me].append(nbr)
-
-    return adjacency
-
-
-def metis_partition(ne, nproc, adjacency):
+def metis_partition(ne, nproc, dual_graph):
     '''
     Partition the cubed-sphere using METIS.
+    dual_graph: (xadj, adjncy, eweights, vweights) from CubeAdjacency.dual_graph()
     Returns cube_rank array (ne, ne, 6) in Fortran order.
     '''
     n_total = 6 * ne * ne
+    xadj, adjncy, eweights, vweights = dual_graph
 
     if nproc == 1:
-        membership = [0] * n_total
+        membership = np.zeros(n_total, 'i4')
     else:
-        _, membership = pymetis.part_graph(nproc, adjacency=adjacency)
+        _, membership = pymetis.part_graph(nproc, xadj=xadj, adjncy=adjncy,
+                                           eweights=eweights, vweights=vweights)
 
-    cube_rank = np.zeros((ne, ne, 6), 'i4', order='F')
-    for p in range(6):
-        for ej in range(ne):
-            for ei in range(ne):
-                idx = p * ne * ne + ej * ne + ei
-                cube_rank[ei, ej, p] = membership[idx]
-
-    return cube_rank
+    return np.asarray(membership, 'i4').reshape((ne, ne, 6), order='F')
 
 
 def compute_metrics(ne, nproc, cube_rank, band_obj, ngq=4):
@@ -94,12 +61,16 @@ def compute_metrics(ne, nproc, cube_rank, band_obj, ngq=4):
 
     total_comm = num_pts[1, :].sum()
 
+    rounds, max_degree = CubeHaloPlan(ne, ngq, cube_rank, nproc).exchange_schedule()
+
     return {
         'perimeter_ratio_mean': pr,
         'perimeter_ratio_std': pr_std,
         'comm_ratio_mean': cr,
         'comm_ratio_std': cr_std,
         'total_comm': total_comm,
+        'exchange_rounds': len(rounds),
+        'max_degree': max_degree,
     }
 
 
@@ -112,11 +83,11 @@ def run_comparison(ne, nproc_list, ngq=4):
     print(f'  Total elements: {6*ne*ne}')
     print(f'{"="*70}')
 
-    print('\nBuilding adjacency list for METIS...')
+    print('\nBuilding dual graph for METIS...')
     t0 = time.time()
-    adjacency = build_cubed_sphere_adjacency(ne)
+    dual_graph = get_cube_adjacency(ne).dual_graph()
     t_adj = time.time() - t0
-    print(f'  Adjacency built in {t_adj:.2f}s')
+    print(f'  Dual graph built in {t_adj:.2f}s')
 
     header = (f'{"Nproc":>6} | {"Method":>8} | {"P_mean":>8} | {"P_std":>8} | '
               f'{"CR_mean":>8} | {"CR_std":>8} | {"TotalComm":>10} | {"Time(ms)":>8}')
@@ -164,7 +135,7 @@ def run_comparison(ne, nproc_list, ngq=4):
 
         # --- METIS ---
         t0 = time.time()
-        cr_metis = metis_partition(ne, nproc, adjacency)
+        cr_metis = metis_partition(ne, nproc, dual_graph)
         t_metis = (time.time() - t0) * 1000
 
         m_metis = compute_metrics(ne, nproc, cr_metis, band_obj, ngq)
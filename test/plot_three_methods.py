@@ -15,8 +15,8 @@ sys.path.append(lib_dir)
 
 from cube_partition_sfc import CubePartitionSFC
 from cube_partition_stripe import CubePartitionStripe
-from cube_neighbor import CubeNeighbor
-from compare_three_methods import build_cubed_sphere_adjacency, metis_partition, compute_metrics
+from cube_adjacency import get_cube_adjacency
+from compare_three_methods import metis_partition, compute_metrics
 
 import matplotlib
 matplotlib.use('Agg')
@@ -25,7 +25,7 @@ import matplotlib.pyplot as plt
 
 def collect_data(ne, nproc_list, ngq=4):
     '''Collect comparison data for all nproc values.'''
-    adjacency = build_cubed_sphere_adjacency(ne)
+    dual_graph = get_cube_adjacency(ne).dual_graph()
 
     sfc_pr, band_pr, metis_pr = [], [], []
     sfc_cr, band_cr, metis_cr = [], [], []
@@ -50,7 +50,7 @@ def collect_data(ne, nproc_list, ngq=4):
         band_cr.append(m['comm_ratio_mean'])
         band_tc.append(m['total_comm'])
 
-        cr_metis = metis_partition(ne, nproc, adjacency)
+        cr_metis = metis_partition(ne, nproc, dual_graph)
         m = compute_metrics(ne, nproc, cr_metis, band_obj, ngq)
         metis_pr.append(m['perimeter_ratio_mean'])
         metis_pr_std.append(m['perimeter_ratio_std'])
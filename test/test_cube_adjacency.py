@@ -0,0 +1,158 @@
+'''
+
+abstract : unittest of cube_adjacency.py
+
+'''
+
+from __future__ import print_function, division
+from os.path import dirname, abspath, join
+import sys
+
+from numpy.testing import assert_equal as equal
+from numpy.testing import assert_array_equal as a_equal
+import numpy as np
+
+
+current_dir = dirname(abspath(__file__))
+lib_dir = dirname(current_dir)
+sys.path.append(lib_dir)
+from cube_adjacency import CubeAdjacency, get_cube_adjacency
+from cube_partition_sfc import CubePartitionSFC
+from cube_partition_stripe import CubePartitionStripe
+
+
+
+def test_nbr_tables_ne3():
+    '''
+    cube_adjacency: edge_nbrs, corner_nbrs: ne=3
+    '''
+    ne = 3
+    adj = CubeAdjacency(ne)
+    gid = lambda ei, ej, p: (p-1)*ne*ne + (ej-1)*ne + (ei-1)
+
+    equal(adj.edge_nbrs.shape, (6*ne*ne,4))
+    equal(adj.corner_nbrs.shape, (6*ne*ne,4))
+    equal(adj.edge_nbrs.dtype, np.int32)
+    assert adj.edge_nbrs.flags['C_CONTIGUOUS']
+    assert adj.corner_nbrs.flags['C_CONTIGUOUS']
+
+    # center of panel 1
+    a_equal(adj.edge_nbrs[gid(2,2,1)],
+            [gid(1,2,1), gid(3,2,1), gid(2,1,1), gid(2,3,1)])
+    a_equal(adj.corner_nbrs[gid(2,2,1)],
+            [gid(1,1,1), gid(3,1,1), gid(1,3,1), gid(3,3,1)])
+
+    # across the panel boundaries (see test_cube_neighbor.py)
+    a_equal(adj.edge_nbrs[gid(1,1,1)],
+            [gid(3,1,4), gid(2,1,1), gid(1,3,5), gid(1,2,1)])
+    a_equal(adj.corner_nbrs[gid(1,1,1)],
+            [-1, gid(2,3,5), gid(3,2,4), gid(2,2,1)])
+
+    # 8 cube corners x 3 elements lose their diagonal neighbor
+    equal(np.count_nonzero(adj.edge_nbrs == -1), 0)
+    equal(np.count_nonzero(adj.corner_nbrs == -1), 24)
+
+
+
+def test_nbr_tables_symmetric():
+    '''
+    cube_adjacency: edge and corner neighbors are symmetric: ne=4
+    '''
+    adj = CubeAdjacency(4)
+
+    for nbrs in [adj.edge_nbrs, adj.corner_nbrs]:
+        me = np.repeat(np.arange(adj.nelem), 4)
+        nbr = nbrs.ravel()
+        valid = nbr >= 0
+        pairs = set(zip(me[valid], nbr[valid]))
+        assert all((b, a) in pairs for (a, b) in pairs)
+
+
+
+def test_csr():
+    '''
+    cube_adjacency: xadj, adjncy: ne=5
+    '''
+    ne = 5
+    adj = CubeAdjacency(ne)
+
+    equal(adj.xadj[0], 0)
+    equal(adj.xadj[-1], adj.adjncy.size)
+    equal(adj.adjncy.size, 6*ne*ne*8 - 24)
+
+    for e in [0, 7, 24, 60, 149]:
+        nbrs = np.hstack([adj.edge_nbrs[e], adj.corner_nbrs[e]])
+        a_equal(adj.adjncy[adj.xadj[e]:adj.xadj[e+1]], nbrs[nbrs >= 0])
+
+
+
+def test_get_cube_adjacency():
+    '''
+    cube_adjacency: get_cube_adjacency() is memoized
+    '''
+    assert get_cube_adjacency(6) is get_cube_adjacency(6)
+    assert get_cube_adjacency(6) is not get_cube_adjacency(7)
+
+
+
+def test_metrics_with_adjacency():
+    '''
+    cube_adjacency: metric and coloring routines give the same results
+    '''
+    ne = 10
+    adj = get_cube_adjacency(ne)
+
+    for nproc in [4, 7, 24, 60]:
+        stripe = CubePartitionStripe(ne, nproc)
+        sfc = CubePartitionSFC(ne, nproc)
+
+        for cube_rank in [stripe.make_cube_rank()[1], sfc.make_cube_rank()[1]]:
+            pr1, num_nbrs1 = stripe.global_perimeter_ratio(cube_rank)
+            pr2, num_nbrs2 = stripe.global_perimeter_ratio(cube_rank, adj)
+            equal(pr1, pr2)
+            a_equal(num_nbrs1, num_nbrs2)
+
+            cr1, num_pts1 = stripe.global_communication_ratio(4, cube_rank)
+            cr2, num_pts2 = stripe.global_communication_ratio(4, cube_rank, adj)
+            equal(cr1, cr2)
+            a_equal(num_pts1, num_pts2)
+
+            a_equal(stripe.make_cube_color(cube_rank),
+                    stripe.make_cube_color(cube_rank, adj))
+
+
+
+def test_dual_graph():
+    '''
+    cube_adjacency: dual_graph(): edge neighbors and weights, ne=4
+    '''
+    ne = 4
+    adj = get_cube_adjacency(ne)
+
+    xadj, adjncy, eweights, vweights = adj.dual_graph()
+    a_equal(xadj, np.arange(0, 4*6*ne*ne+1, 4))
+    a_equal(adjncy, adj.edge_nbrs.ravel())
+    assert np.shares_memory(adjncy, adj.edge_nbrs)  # no copy
+    assert eweights is None and vweights is None
+
+    # the same graph as the element-by-element neighbor search
+    from cube_neighbor import CubeNeighbor
+    cn = CubeNeighbor()
+    for p in range(1,7):
+        for ej in range(1,ne+1):
+            for ei in range(1,ne+1):
+                me = (p-1)*ne*ne + (ej-1)*ne + (ei-1)
+                ref = []
+                for a, b in [(-1,0), (1,0), (0,-1), (0,1)]:
+                    e2, f2, p2, rot = cn.convert_nbr_eij(ne, ei+a, ej+b, p)
+                    ref.append((p2-1)*ne*ne + (f2-1)*ne + (e2-1))
+                a_equal(adjncy[xadj[me]:xadj[me+1]], ref)
+
+    xadj, adjncy, eweights, vweights = adj.dual_graph(corners=True, ngq=4,
+            vweights=np.arange(6*ne*ne).reshape((ne,ne,6), order='F'))
+    assert xadj is adj.xadj
+    equal(eweights.size, adjncy.size)
+    equal(np.count_nonzero(eweights == 4), 4*6*ne*ne)
+    equal(np.count_nonzero(eweights == 1), 4*6*ne*ne - 24)
+    a_equal(eweights[xadj[5]:xadj[6]], [4,4,4,4,1,1,1,1])
+    a_equal(vweights, np.arange(6*ne*ne))
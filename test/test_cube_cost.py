@@ -0,0 +1,102 @@
+'''
+
+abstract : unittest of cube_cost.py
+
+'''
+
+from __future__ import print_function, division
+from os.path import dirname, abspath, join
+import sys
+
+from numpy.testing import assert_equal as equal
+from numpy.testing import assert_array_equal as a_equal
+import numpy as np
+
+
+current_dir = dirname(abspath(__file__))
+lib_dir = dirname(current_dir)
+sys.path.append(lib_dir)
+from cube_cost import rank_times, time_ratio, balance_rank_times
+from cube_partition_sfc import CubePartitionSFC
+from cube_partition_stripe import CubePartitionStripe
+
+
+
+def test_rank_times():
+    '''
+    cube_cost: rank_times(): computation, points and messages of the ranks
+    '''
+    ne = 4
+    nproc = 2
+    cube_rank = CubePartitionStripe(ne, nproc).make_cube_rank()[1]
+
+    # three panels around two opposite corners of the cube, six edges between them
+    a_equal(rank_times(ne, nproc, cube_rank, (1, 0, 0)), [48, 48])
+    pts4 = rank_times(ne, nproc, cube_rank, (0, 1, 0), ngq=4)
+    pts3 = rank_times(ne, nproc, cube_rank, (0, 1, 0), ngq=3)
+    a_equal(pts4 - pts3, [6*ne, 6*ne])
+    a_equal(rank_times(ne, nproc, cube_rank, (0, 0, 1)), [1, 1])
+    a_equal(rank_times(ne, nproc, cube_rank, (1, 0, 0), capacity=[1, 2]), [48, 24])
+    equal(time_ratio(np.array([1., 2, 3])), 1.5)
+
+
+
+def test_refine_rank_times():
+    '''
+    cube_partition_stripe: refine_rank_times(): the times and the moved elements
+    '''
+    rng = np.random.RandomState(0)
+    costs = (1, 0.2, 3)
+    for ne, nproc in [(6, 7), (16, 100), (30, 200)]:
+        obj = CubePartitionStripe(ne, nproc)
+        capacity = rng.choice([1, 1.8], nproc)
+        for cube_rank in [obj.make_cube_rank()[1], CubePartitionSFC(ne, nproc).make_cube_rank()[1]]:
+            old_rank = cube_rank.copy()
+            for cap in [None, capacity]:
+                times0 = rank_times(ne, nproc, cube_rank, costs, capacity=cap)
+                nelems, cube_rank2, cube_lid, times = obj.refine_rank_times(cube_rank, costs, capacity=cap)
+                a_equal(cube_rank, old_rank)
+                np.testing.assert_allclose(times, rank_times(ne, nproc, cube_rank2, costs, capacity=cap))
+                a_equal(np.bincount(cube_rank2.ravel(), minlength=nproc), nelems)
+                for rank in range(nproc):
+                    a_equal(np.sort(cube_lid[cube_rank2 == rank]), np.arange(1, nelems[rank]+1))
+                assert times.max() <= times0.max()
+                if cap is None and nproc >= 100: assert time_ratio(times) < time_ratio(times0)
+
+    for costs in [(0, 1, 1), (1, -1, 1), (1, 1, np.nan), (1, 1)]:
+        try:
+            obj.refine_rank_times(cube_rank, costs)
+            assert False
+        except ValueError:
+            pass
+
+
+
+def test_balance_rank_times():
+    '''
+    cube_cost: balance_rank_times(): the max/mean ratio of the times before and after
+    '''
+    ne, nproc = 30, 200
+    costs = (1, 0.2, 3)
+    for method in ['sfc', 'stripe']:
+        (nelems, cube_rank, cube_lid), (ratio0, ratio) = balance_rank_times(method, ne, nproc, costs)
+        assert ratio0 > 1.09
+        assert ratio < 1.05
+        np.testing.assert_allclose(ratio, time_ratio(rank_times(ne, nproc, cube_rank, costs)))
+        equal(nelems.sum(), 6*ne*ne)
+
+    # the nelems in proportion to the capacity first
+    capacity = np.where(np.arange(nproc) % 2, 1.8, 1)
+    ret, (ratio0, ratio) = balance_rank_times('stripe', ne, nproc, costs, capacity=capacity, budget=0.1)
+    times = rank_times(ne, nproc, ret[1], costs, capacity=capacity)
+    np.testing.assert_allclose(ratio, time_ratio(times))
+    assert ratio < ratio0
+
+    # the moves can lower the mean more than the max, the ratio never goes up
+    ne, nproc = 6, 150
+    costs = (1, 0.05, 2)
+    for method in ['sfc', 'stripe']:
+        ret, (ratio0, ratio) = balance_rank_times(method, ne, nproc, costs)
+        np.testing.assert_allclose(ratio, time_ratio(rank_times(ne, nproc, ret[1], costs)))
+        assert ratio <= ratio0
+        a_equal(np.bincount(ret[1].ravel(), minlength=nproc), ret[0])
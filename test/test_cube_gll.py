@@ -0,0 +1,183 @@
+'''
+
+abstract : unittest of cube_gll.py
+
+'''
+
+from __future__ import print_function, division
+from os.path import dirname, abspath, join
+import sys
+
+from numpy.testing import assert_equal as equal
+from numpy.testing import assert_array_equal as a_equal
+import numpy as np
+
+
+current_dir = dirname(abspath(__file__))
+lib_dir = dirname(current_dir)
+sys.path.append(lib_dir)
+from cube_neighbor import CubeNeighbor
+from cube_gll import CubeGLL, get_cube_gll
+from cube_partition_sfc import CubePartitionSFC
+from cube_partition_stripe import CubePartitionStripe
+
+
+
+def brute_force_gids(ne, ngq):
+    '''
+    merge the duplicated points with the scalar convert_nbr_gij()
+    '''
+    cn = CubeNeighbor()
+    lp = lambda gi, gj, ei, ej, p: \
+            (gi-1) + ngq*(gj-1) + ngq*ngq*((p-1)*ne*ne + (ej-1)*ne + (ei-1))
+
+    parent = list(range(ngq*ngq*6*ne*ne))
+    def find(x):
+        while parent[x] != x: x = parent[x]
+        return x
+
+    for p in range(1,7):
+        for ej in range(1,ne+1):
+            for ei in range(1,ne+1):
+                for gj in range(1,ngq+1):
+                    for gi in range(1,ngq+1):
+                        for a, b in [(-1,0), (1,0), (0,-1), (0,1)]:
+                            if not (1 <= gi+a <= ngq and 1 <= gj+b <= ngq):
+                                ret = cn.convert_nbr_gij(ne, ngq, gi+a, gj+b, ei, ej, p)
+                                x, y = find(lp(gi,gj,ei,ej,p)), find(lp(*ret))
+                                parent[max(x,y)] = min(x,y)
+
+    return [find(x) for x in range(len(parent))]
+
+
+
+def test_gids_ne3_np4():
+    '''
+    cube_gll: gids: ne=3, np=4
+    '''
+    ne, ngq = 3, 4
+    gll = CubeGLL(ne, ngq)
+
+    equal(gll.size, 6*ne*ne*(ngq-1)**2 + 2)
+    equal(gll.gids.shape, (ngq*ngq*6*ne*ne,))
+
+    # same partition of the points as the scalar neighbor search
+    roots = brute_force_gids(ne, ngq)
+    _, ref = np.unique(roots, return_inverse=True)
+    a_equal(gll.gids, ref)
+
+    # multiplicity: interior 1, edge 2, vertex 4, cube corner 3
+    mult = np.bincount(np.bincount(gll.gids))
+    equal(mult[1], 6*ne*ne*(ngq-2)**2)
+    equal(mult[2], 12*ne*(ngq-2) + 6*2*ne*(ne-1)*(ngq-2))
+    equal(mult[3], 8)
+    equal(mult[4], 6*(ne-1)**2 + 12*(ne-1))
+
+
+
+def test_gids_elem_ne2_np3():
+    '''
+    cube_gll: elem_gids(): ne=2, np=3, shared points of the neighbor elements
+    '''
+    ne, ngq = 2, 3
+    gll = get_cube_gll(ne, ngq)
+    eg = gll.elem_gids().reshape(-1, ngq, ngq)  # (elem, gj, gi)
+
+    # (1,1,1) and (2,1,1) share the edge gi=ngq / gi=1
+    a_equal(eg[0,:,ngq-1], eg[1,:,0])
+    # (1,1,1) and (1,2,1) share the edge gj=ngq / gj=1
+    a_equal(eg[0,ngq-1,:], eg[2,0,:])
+
+    assert get_cube_gll(ne, ngq) is gll
+
+
+
+def brute_force_shared(gll, cube_rank, nproc):
+    ranks = np.repeat(cube_rank.ravel(order='F'), gll.ngq*gll.ngq)
+    owners = [set() for i in range(gll.size)]
+    for gid, rank in zip(gll.gids, ranks):
+        owners[gid].add(rank)
+
+    num_shared = np.zeros(nproc, 'i4')
+    pairs = dict()
+    for s in owners:
+        if len(s) > 1:
+            for r in s: num_shared[r] += 1
+            for a in s:
+                for b in s:
+                    if a < b: pairs[(a,b)] = pairs.get((a,b), 0) + 1
+
+    return num_shared, pairs
+
+
+
+def test_communication_volume():
+    '''
+    cube_gll: communication_volume(): exact shared points, ne=6, np=4
+    '''
+    ne, ngq = 6, 4
+    gll = get_cube_gll(ne, ngq)
+
+    for nproc in [1, 4, 9, 24]:
+        stripe = CubePartitionStripe(ne, nproc)
+        sfc = CubePartitionSFC(ne, nproc)
+        for cube_rank in [stripe.make_cube_rank()[1], sfc.make_cube_rank()[1]]:
+            comm_ratio, num_pts, pair_pts = gll.communication_volume(cube_rank)
+            num_shared, pairs = brute_force_shared(gll, cube_rank, nproc)
+
+            a_equal(num_pts[0,:], np.bincount(cube_rank.ravel())*ngq*ngq)
+            a_equal(num_pts[1,:], num_shared)
+            equal(pair_pts.shape[1], len(pairs))
+            for a, b, count in pair_pts.T:
+                equal(pairs[(a,b)], count)
+
+            # the approximation of the halo traffic is an overestimate
+            _, approx_pts = stripe.global_communication_ratio(ngq, cube_rank)
+            assert np.all(num_pts[1,:] <= approx_pts[1,:])
+
+
+
+def test_dss_weights():
+    '''
+    cube_gll: elem_multiplicity(), dss_weights(): ne=4, np=4
+    '''
+    gll = get_cube_gll(4, 4)
+
+    mult = gll.elem_multiplicity()
+    equal(mult.sum(), gll.gids.size)
+
+    # the weights of the duplicated points sum to 1 per global point
+    sums = np.bincount(gll.gids, weights=gll.dss_weights())
+    np.testing.assert_allclose(sums, 1)
+
+
+
+def test_shared_points():
+    '''
+    cube_gll: shared_points(): owners and multiplicities, ne=6, np=4
+    '''
+    ne, ngq = 6, 4
+    gll = get_cube_gll(ne, ngq)
+    mult = gll.elem_multiplicity()
+
+    for nproc in [1, 7, 24]:
+        cube_rank = CubePartitionStripe(ne, nproc).make_cube_rank()[1]
+        ptr, gids, owners, elem_mult, rank_mult = gll.shared_points(cube_rank)
+
+        ranks = np.repeat(cube_rank.ravel(order='F'), ngq*ngq)
+        touch = [set() for i in range(gll.size)]
+        for gid, rank in zip(gll.gids, ranks):
+            touch[gid].add(rank)
+
+        equal(ptr.size, nproc+1)
+        for rank in range(nproc):
+            sl = slice(ptr[rank], ptr[rank+1])
+            ref = sorted(g for g, s in enumerate(touch) if len(s) > 1 and rank in s)
+            a_equal(gids[sl], ref)
+            a_equal(owners[sl], [min(touch[g]) for g in ref])
+            a_equal(rank_mult[sl], [len(touch[g]) for g in ref])
+            a_equal(elem_mult[sl], mult[ref])
+
+        # every shared point has exactly one owner
+        equal(np.count_nonzero(owners == np.repeat(np.arange(nproc), np.diff(ptr))),
+              np.count_nonzero(np.array([len(s) for s in touch]) > 1))
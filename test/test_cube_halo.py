@@ -0,0 +1,130 @@
+'''
+
+abstract : unittest of cube_halo.py
+
+'''
+
+from __future__ import print_function, division
+from os.path import dirname, abspath, join
+import sys
+
+from numpy.testing import assert_equal as equal
+from numpy.testing import assert_array_equal as a_equal
+import numpy as np
+
+
+current_dir = dirname(abspath(__file__))
+lib_dir = dirname(current_dir)
+sys.path.append(lib_dir)
+from cube_gll import get_cube_gll
+from cube_halo import CubeHaloPlan, load_halo_plan
+from cube_partition_sfc import CubePartitionSFC
+from cube_partition_stripe import CubePartitionStripe
+
+
+
+def test_halo_plan():
+    '''
+    cube_halo: CubeHaloPlan: symmetric send/recv lists, ne=6, np=4
+    '''
+    ne, ngq = 6, 4
+    gll = get_cube_gll(ne, ngq)
+
+    for nproc in [1, 5, 24]:
+        cube_rank = CubePartitionSFC(ne, nproc).make_cube_rank()[1]
+        flat_rank = cube_rank.ravel(order='F')
+        plan = CubeHaloPlan(ne, ngq, cube_rank)
+        _, num_pts, pair_pts = gll.communication_volume(cube_rank)
+
+        equal(plan.nbr_ptr.size, nproc+1)
+        equal(plan.nbr_ranks.size, 2*pair_pts.shape[1])
+
+        for a, b, count in pair_pts.T:
+            gids1, lps1, elems1 = plan.send(a, b)
+            gids2, lps2, elems2 = plan.recv(a, b)
+            equal(gids1.size, count)
+            a_equal(gids1, gids2)
+            a_equal(gids1, np.sort(gids1))
+
+            # the local points are in the sender, with the same global point
+            a_equal(gll.gids[lps1], gids1)
+            a_equal(flat_rank[lps1//(ngq*ngq)], a)
+            a_equal(flat_rank[lps2//(ngq*ngq)], b)
+
+            # the elements touch the shared points
+            a_equal(flat_rank[elems1], a)
+            a_equal(flat_rank[elems2], b)
+            touched = np.unique(gll.elem_gids()[elems1])
+            assert np.all(np.isin(gids1, touched))
+
+        for rank in range(nproc):
+            nbrs, counts, displs = plan.neighbors(rank)
+            a_equal(nbrs, np.sort(nbrs))
+            a_equal(displs, np.cumsum(counts) - counts)
+            equal(plan.reverse[plan.reverse[plan.nbr_ptr[rank]:plan.nbr_ptr[rank+1]]],
+                  np.arange(plan.nbr_ptr[rank], plan.nbr_ptr[rank+1]))
+
+
+
+def test_halo_plan_save_load(tmp_path):
+    '''
+    cube_halo: CubeHaloPlan.save(), load_halo_plan()
+    '''
+    ne, ngq, nproc = 6, 4, 9
+    cube_rank = CubePartitionStripe(ne, nproc).make_cube_rank()[1]
+    plan = CubeHaloPlan(ne, ngq, cube_rank)
+
+    fpath = str(tmp_path/'halo_plan.npz')
+    plan.save(fpath)
+    plan2 = load_halo_plan(fpath)
+
+    equal((plan2.ne, plan2.ngq, plan2.nproc), (ne, ngq, nproc))
+    for key in CubeHaloPlan.array_names:
+        a_equal(getattr(plan2, key), getattr(plan, key))
+    a_equal(plan2.send(3, plan.neighbors(3)[0][0])[0],
+            plan.send(3, plan.neighbors(3)[0][0])[0])
+
+
+
+def test_make_exchange_schedule():
+    '''
+    cube_halo: make_exchange_schedule(): a triangle and a star
+    '''
+    from cube_halo import make_exchange_schedule
+
+    # triangle: 3 rounds, the heaviest first
+    rounds, max_degree = make_exchange_schedule([[0,0,1], [1,2,2]], [5,9,7])
+    equal(max_degree, 2)
+    equal(len(rounds), 3)
+    a_equal(rounds[0], [[0],[2]])
+    a_equal(rounds[1], [[1],[2]])
+    a_equal(rounds[2], [[0],[1]])
+
+    # star: one round per leaf
+    rounds, max_degree = make_exchange_schedule([[0,0,0,0], [1,2,3,4]], [1,1,1,1])
+    equal((len(rounds), max_degree), (4, 4))
+
+    rounds, max_degree = make_exchange_schedule(np.zeros((2,0), 'i4'), [])
+    equal((len(rounds), max_degree), (0, 0))
+
+
+
+def test_exchange_schedule():
+    '''
+    cube_halo: CubeHaloPlan.exchange_schedule(): contention-free rounds
+    '''
+    ne, ngq = 10, 4
+
+    for nproc in [7, 40]:
+        for cube_rank in [CubePartitionSFC(ne, nproc).make_cube_rank()[1],
+                          CubePartitionStripe(ne, nproc).make_cube_rank()[1]]:
+            plan = CubeHaloPlan(ne, ngq, cube_rank)
+            rounds, max_degree = plan.exchange_schedule()
+
+            equal(max_degree, np.diff(plan.nbr_ptr).max())
+            assert max_degree <= len(rounds) <= 2*max_degree - 1
+            equal(sum(r.shape[1] for r in rounds), plan.nbr_ranks.size//2)
+
+            for r in rounds:
+                ranks = r.ravel()
+                equal(np.unique(ranks).size, ranks.size)  # one peer per round
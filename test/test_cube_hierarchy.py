@@ -0,0 +1,164 @@
+'''
+
+abstract : unittest of cube_hierarchy.py
+
+'''
+
+from __future__ import print_function, division
+from os.path import dirname, abspath, join
+import sys
+
+from numpy.testing import assert_equal as equal
+from numpy.testing import assert_array_equal as a_equal
+import numpy as np
+
+
+current_dir = dirname(abspath(__file__))
+lib_dir = dirname(current_dir)
+sys.path.append(lib_dir)
+from cube_adjacency import get_cube_adjacency
+from cube_hierarchy import elem_centers, bisect_elems, count_pieces, \
+        make_cube_rank_hierarchical, node_communication, thread_nelems, \
+        make_cube_thread, lid_cube_thread, thread_cut_sides
+from cube_partition_pool import make_cube_rank
+
+
+
+def test_elem_centers():
+    '''
+    cube_hierarchy: elem_centers(): the side neighbors are the nearest elements
+    '''
+    for ne in [2, 5, 16]:
+        coords = elem_centers(ne)
+        np.testing.assert_allclose(np.linalg.norm(coords, axis=1), 1)
+
+        edge_nbrs = get_cube_adjacency(ne).edge_nbrs
+        dists = np.linalg.norm(coords[:,None,:] - coords[edge_nbrs], axis=2)
+        assert dists.max() < np.pi/(2*ne)
+
+
+
+def test_bisect_elems():
+    '''
+    cube_hierarchy: bisect_elems(): a panel into the squares
+    '''
+    ne = 8
+    coords = elem_centers(ne)
+    edge_nbrs = get_cube_adjacency(ne).edge_nbrs
+    for panel in range(6):
+        elems = np.arange(panel*ne*ne, (panel+1)*ne*ne)
+        parts = bisect_elems(coords, edge_nbrs, elems, [16]*4).reshape(ne, ne, order='F')
+        for part in range(4):
+            ei, ej = np.nonzero(parts == part)
+            equal(ei.size, 16)
+            equal(np.ptp(ei), 3)
+            equal(np.ptp(ej), 3)
+
+    equal(count_pieces(edge_nbrs, np.arange(ne*ne)), 1)
+    equal(count_pieces(edge_nbrs, [0, 2, 4]), 3)
+
+
+
+def test_make_cube_rank_hierarchical():
+    '''
+    cube_hierarchy: make_cube_rank_hierarchical(): the ranks in the node domains
+    '''
+    for method in ['sfc', 'stripe']:
+        for ne, nnodes, ranks_per_node in [(6, 2, 5), (10, 7, 4), (30, 24, 16)]:
+            nproc = nnodes*ranks_per_node
+            nelems, cube_rank, cube_lid = make_cube_rank_hierarchical(method, ne, nnodes, ranks_per_node)
+            node_rank = make_cube_rank(method, ne, nnodes)[1]
+
+            a_equal(cube_rank//ranks_per_node, node_rank)
+            equal(nelems.sum(), 6*ne*ne)
+            assert nelems.max() - nelems.min() <= 1
+            a_equal(np.bincount(cube_rank.ravel(), minlength=nproc), nelems)
+            flat_rank = cube_rank.ravel(order='F')
+            edge_nbrs = get_cube_adjacency(ne).edge_nbrs
+            for rank in range(nproc):
+                a_equal(np.sort(cube_lid[cube_rank == rank]), np.arange(1, nelems[rank]+1))
+                equal(count_pieces(edge_nbrs, np.nonzero(flat_rank == rank)[0]), 1)
+
+    # the ranks of a node in proportion to the capacity
+    capacity = np.tile([1, 1, 2, 2], 7)
+    nelems, cube_rank, cube_lid = make_cube_rank_hierarchical('stripe', 10, 7, 4, capacity=capacity)
+    a_equal(nelems.reshape(7,4).sum(axis=1), [85]*2 + [86]*5)
+    assert np.all(np.abs(nelems - 600*capacity/capacity.sum()) < 1)
+
+    for args in [(10, 0, 4), (10, 7, 0), (2, 5, 5)]:
+        try:
+            make_cube_rank_hierarchical('sfc', *args)
+            assert False
+        except ValueError:
+            pass
+
+
+
+def test_node_communication():
+    '''
+    cube_hierarchy: node_communication(): the points between and in the nodes
+    '''
+    ne, ngq, nnodes, ranks_per_node = 30, 4, 24, 16
+    nproc = nnodes*ranks_per_node
+    cube_rank = make_cube_rank_hierarchical('stripe', ne, nnodes, ranks_per_node)[1]
+    inter_pts, intra_pts, node_pts = node_communication(ne, ngq, cube_rank, ranks_per_node)
+    equal(node_pts.size, nnodes)
+    equal(node_pts.sum(), inter_pts)
+
+    equal(node_communication(ne, ngq, cube_rank, 1), (inter_pts + intra_pts, 0, node_communication(ne, ngq, cube_rank, 1)[2]))
+    equal(node_communication(ne, ngq, cube_rank, nproc)[:2], (0, inter_pts + intra_pts))
+
+    # the flat partition crosses the nodes more
+    flat_rank = make_cube_rank('stripe', ne, nproc)[1]
+    flat_inter, flat_intra, flat_node_pts = node_communication(ne, ngq, flat_rank, ranks_per_node)
+    assert inter_pts < 0.8*flat_inter
+
+
+
+def test_make_cube_thread():
+    '''
+    cube_hierarchy: make_cube_thread(): balanced compact threads in every rank
+    '''
+    a_equal(thread_nelems(10, 4), [3, 3, 2, 2])
+    a_equal(thread_nelems(2, 4), [1, 1, 0, 0])
+
+    for method, ne, nproc, nthreads in [('sfc', 16, 24, 8), ('stripe', 16, 30, 4), ('stripe', 4, 48, 4),
+                                        ('sfc', 30, 150, 16)]:
+        nelems, cube_rank, cube_lid = make_cube_rank(method, ne, nproc)[:3]
+        cube_thread = make_cube_thread(ne, cube_rank, nthreads, cube_lid=cube_lid)
+        naive = lid_cube_thread(cube_rank, cube_lid, nthreads)
+        for rank in range(nproc):
+            a_equal(np.bincount(cube_thread[cube_rank == rank], minlength=nthreads), thread_nelems(nelems[rank], nthreads))
+            a_equal(np.bincount(naive[cube_rank == rank], minlength=nthreads), thread_nelems(nelems[rank], nthreads))
+            # the naive threads are the chunks of the cube_lid
+            lids = cube_lid[cube_rank == rank]
+            a_equal(naive[cube_rank == rank][np.argsort(lids)], np.sort(naive[cube_rank == rank]))
+
+        # no rank is cut more than by the naive threads, also with 9-10 elements in 16 threads
+        cut = thread_cut_sides(ne, cube_rank, cube_thread)
+        cut0 = thread_cut_sides(ne, cube_rank, naive)
+        equal(cut.shape, (nproc,))
+        assert (cut <= cut0).all()
+        if ne == 16:
+            assert cut.sum() < 0.85*cut0.sum()
+        edge_nbrs = get_cube_adjacency(ne).edge_nbrs
+        flat_rank = cube_rank.ravel(order='F')
+        flat_thread = cube_thread.ravel(order='F')
+        for rank in range(nproc):
+            for thread in range(nthreads):
+                elems = np.nonzero((flat_rank == rank) & (flat_thread == thread))[0]
+                if elems.size > 0:
+                    equal(count_pieces(edge_nbrs, elems), 1)
+
+    # a column of panel 1 in a thread, two sides to panel 1, two to panel 2,
+    # one to panel 5 and one to panel 6
+    cube_rank = np.zeros((2,2,6), 'i4')
+    cube_thread = np.zeros((2,2,6), 'i4')
+    cube_thread[1,:,0] = 1
+    a_equal(thread_cut_sides(2, cube_rank, cube_thread), [6])
+
+    try:
+        make_cube_thread(ne, cube_rank, 0)
+        assert False
+    except ValueError:
+        pass
@@ -0,0 +1,104 @@
+'''
+
+abstract : unittest of cube_mapping.py
+
+'''
+
+from __future__ import print_function, division
+from os.path import dirname, abspath, join
+import sys
+
+from numpy.testing import assert_equal as equal
+from numpy.testing import assert_array_equal as a_equal
+import numpy as np
+
+
+current_dir = dirname(abspath(__file__))
+lib_dir = dirname(current_dir)
+sys.path.append(lib_dir)
+from cube_mapping import make_switch_distance, make_torus_distance, \
+        make_dragonfly_distance, hop_bytes, place_groups, map_ranks
+from cube_gll import get_cube_gll
+from cube_hierarchy import make_cube_rank_hierarchical
+from cube_partition_sfc import CubePartitionSFC
+from cube_partition_stripe import CubePartitionStripe
+
+
+
+def test_distance():
+    '''
+    cube_mapping: make_*_distance(): hops between the nodes
+    '''
+    nodes = np.arange(8)
+
+    distance = make_switch_distance(4)
+    a_equal(distance(nodes, 1), [2, 0, 2, 2, 4, 4, 4, 4])
+
+    distance = make_torus_distance((2, 4))
+    a_equal(distance(nodes, 0), [0, 1, 2, 1, 1, 2, 3, 2])
+    a_equal(distance(nodes[:,None], nodes[None,:]), distance(nodes[None,:], nodes[:,None]))
+
+    distance = make_dragonfly_distance(2, 2)
+    a_equal(distance(nodes, 0), [0, 2, 3, 3, 5, 5, 5, 5])
+
+    # 0 -- 1 -- 2 with 3 points each, the ranks on the nodes 0, 0, 4
+    pair_pts = np.array([[0, 1], [1, 2], [3, 3]])
+    equal(hop_bytes(pair_pts, np.array([0, 0, 4]), make_switch_distance(4)), 2*8*3*4)
+
+
+
+def test_place_groups():
+    '''
+    cube_mapping: place_groups(): a chain of groups on a line of nodes
+    '''
+    n = 6
+    weights = np.zeros((n,n))
+    chain = [3, 0, 5, 1, 4, 2]
+    for a, b in zip(chain[:-1], chain[1:]):
+        weights[a,b] = weights[b,a] = 1
+    dists = np.abs(np.arange(n)[:,None] - np.arange(n)[None,:])
+
+    place = place_groups(weights, dists)
+    a_equal(np.sort(place), np.arange(n))
+    cost = (weights*dists[place][:,place]).sum()/2
+    equal(cost, n - 1)
+
+    # the fixed groups stay
+    place = place_groups(weights, dists, nfree=4)
+    a_equal(place[4:], [4, 5])
+
+
+
+def test_map_ranks():
+    '''
+    cube_mapping: map_ranks(): a permutation of the labels of less hop-bytes
+    '''
+    ne, ngq = 16, 4
+    rng = np.random.RandomState(0)
+    distances = [make_switch_distance(4), make_torus_distance((4, 6)),
+                 make_dragonfly_distance(2, 4)]
+    partitions = [
+        CubePartitionSFC(ne, 384).make_cube_rank()[1],
+        CubePartitionStripe(ne, 384).make_cube_rank()[1],
+        make_cube_rank_hierarchical('sfc', ne, 24, 16)[1],
+        CubePartitionStripe(ne, 380).make_cube_rank()[1]]
+
+    for cube_rank in partitions:
+        nproc = cube_rank.max() + 1
+        # a random labeling as a graph partitioner
+        shuffled = rng.permutation(nproc).astype('i4')[cube_rank]
+        for distance in distances:
+            for labels in [cube_rank, shuffled]:
+                perm, (hop_bytes0, hop_bytes1) = map_ranks(ne, ngq, labels, 16, distance)
+                a_equal(np.sort(perm), np.arange(nproc))
+                assert hop_bytes1 <= hop_bytes0
+
+                pair_pts = get_cube_gll(ne, ngq).communication_volume(perm[labels], nproc)[2]
+                np.testing.assert_allclose(hop_bytes1, hop_bytes(pair_pts, np.arange(nproc)//16, distance))
+                if labels is shuffled: assert hop_bytes1 < 0.4*hop_bytes0
+
+    try:
+        map_ranks(ne, ngq, cube_rank, 0, distances[0])
+        assert False
+    except ValueError:
+        pass
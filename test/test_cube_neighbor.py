@@ -524,3 +524,48 @@ def test_convert_nbr_gij_6_6():
     a_equal(obj.convert_nbr_gij(ne, ngq, 25, 0, 1, 1, 6), (-1, -1, -1, -1, -1))
     a_equal(obj.convert_nbr_gij(ne, ngq,  0,25, 1, 1, 6), (-1, -1, -1, -1, -1))
     a_equal(obj.convert_nbr_gij(ne, ngq, 25,25, 1, 1, 6), (-1, -1, -1, -1, -1))
+
+
+
+def test_convert_nbr_eij_array_6_1():
+    '''
+    cube_neighbor: convert_nbr_eij_array(): ne=6, panel=1
+    '''
+    ne = 6
+
+    ei = np.array([1, 7, 0, 1, 1, 0, 7], 'i4')
+    ej = np.array([3, 3, 3, 7, 0, 0, 7], 'i4')
+    a_equal(obj.convert_nbr_eij_array(ne, ei, ej, 1),
+            [( 1, 3, 1, 0),
+             ( 1, 3, 2, 0),
+             ( 6, 3, 4, 0),
+             ( 1, 1, 6, 0),
+             ( 1, 6, 5, 0),
+             (-1,-1,-1,-1),
+             (-1,-1,-1,-1)])
+
+    # element-wise equivalence with the scalar calls
+    ret = obj.convert_nbr_eij_array(ne, -5, 3, np.arange(1,7))
+    equal(ret.shape, (6,4))
+    for k, panel in enumerate(range(1,7)):
+        a_equal(ret[k], obj.convert_nbr_eij(ne, -5, 3, panel))
+
+
+
+def test_convert_nbr_gij_array_6_1():
+    '''
+    cube_neighbor: convert_nbr_gij_array(): ne=6, np=4, panel=1
+    '''
+    ne = 6
+    ngq = 4
+
+    gi = np.array([ 8, 0, 1, 1,  0], 'i4')
+    gj = np.array([ 1, 1, 8, 0, 25], 'i4')
+    ei = np.array([ 6, 1, 1, 1,  1], 'i4')
+    ej = np.array([ 3, 3, 6, 1,  1], 'i4')
+    a_equal(obj.convert_nbr_gij_array(ne, ngq, gi, gj, ei, ej, 1),
+            [( 4, 1, 1, 3, 2),
+             ( 4, 1, 6, 3, 4),
+             ( 1, 4, 1, 1, 6),
+             ( 1, 4, 1, 6, 5),
+             (-1,-1,-1,-1,-1)])
@@ -0,0 +1,121 @@
+'''
+
+abstract : unittest of cube_partition_pool.py
+
+'''
+
+from __future__ import print_function, division
+from os.path import dirname, abspath, join
+from concurrent.futures import ThreadPoolExecutor
+import sys
+
+from numpy.testing import assert_equal as equal
+from numpy.testing import assert_array_equal as a_equal
+import numpy as np
+
+
+current_dir = dirname(abspath(__file__))
+lib_dir = dirname(current_dir)
+sys.path.append(lib_dir)
+from cube_partition_pool import submit, make_cube_rank, sweep, search_unfoldings
+from cube_partition_sfc import CubePartitionSFC
+from cube_partition_stripe import CubePartitionStripe
+
+
+
+def test_submit():
+    '''
+    cube_partition_pool: submit(): the same partitions as the serial calls
+    '''
+    cases = [(method, ne, nproc)
+             for method in ['sfc', 'stripe']
+             for ne in [6, 10, 12]
+             for nproc in [4, 7, 16, 30]]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [submit(method, ne, nproc, executor)
+                   for _ in range(3) for (method, ne, nproc) in cases]
+        results = [f.result() for f in futures]
+
+    classes = {'sfc': CubePartitionSFC, 'stripe': CubePartitionStripe}
+    for k, ret in enumerate(results):
+        method, ne, nproc = cases[k%len(cases)]
+        for a, b in zip(ret, classes[method](ne, nproc).make_cube_rank()):
+            a_equal(a, b)
+
+
+
+def test_invalid_method():
+    '''
+    cube_partition_pool: submit(): invalid method
+    '''
+    try:
+        submit('metis', 6, 4)
+        assert False
+    except ValueError:
+        pass
+
+
+
+def test_sweep():
+    '''
+    cube_partition_pool: sweep(): the same partitions and metrics as the serial calls
+    '''
+    ne, ngq = 10, 4
+    nprocs = [13, 1, 2, 3, 4, 30, 5, 100]
+
+    results = list(sweep('stripe', ne, nprocs, ngq, max_pending=3))
+    equal([ret[0] for ret in results], nprocs)
+
+    for nproc, (nelems, cube_rank, cube_lid), metrics in results:
+        obj = CubePartitionStripe(ne, nproc)
+        for a, b in zip((nelems, cube_rank, cube_lid), obj.make_cube_rank()):
+            a_equal(a, b)
+
+        ratio, num_nbrs = obj.global_perimeter_ratio(cube_rank)
+        equal(metrics['perimeter_ratio'], ratio)
+        a_equal(metrics['num_nbrs'], num_nbrs)
+
+        ratio, num_pts = obj.global_communication_ratio(ngq, cube_rank)
+        equal(metrics['comm_ratio'], ratio)
+        a_equal(metrics['num_pts'], num_pts)
+
+
+
+def test_search_unfoldings():
+    '''
+    cube_partition_pool: search_unfoldings(): the best of the unfoldings with their metrics
+    '''
+    ne, ngq, nproc = 12, 4, 76
+    obj = CubePartitionStripe(ne, nproc)
+
+    (nelems, cube_rank, cube_lid), candidates = search_unfoldings(ne, nproc, ngq)
+    equal([unfolding for unfolding, metrics in candidates], [0, 1, 2, 3])
+
+    ratios = list()
+    for unfolding, metrics in candidates:
+        ret = obj.make_cube_rank(unfolding=unfolding)
+        equal(metrics['perimeter_ratio'], obj.global_perimeter_ratio(ret[1])[0])
+        equal(metrics['comm_ratio'], obj.global_communication_ratio(ngq, ret[1])[0])
+        ratios.append(metrics['perimeter_ratio'])
+
+    best = obj.make_cube_rank(unfolding=int(np.argmin(ratios)))
+    for a, b in zip((nelems, cube_rank, cube_lid), best):
+        a_equal(a, b)
+    assert min(ratios) < ratios[0]
+
+
+
+def test_sweep_max_ratio():
+    '''
+    cube_partition_pool: sweep(): skip the nproc whose bound is not below max_ratio
+    '''
+    ne = 10
+    nprocs = [13, 100, 400, 600, 50]
+    max_ratio = 2.0
+
+    results = list(sweep('stripe', ne, nprocs, max_ratio=max_ratio))
+    expect = [nproc for nproc in nprocs
+              if CubePartitionStripe(ne, nproc).perimeter_ratio_bound() < max_ratio]
+    equal([ret[0] for ret in results], expect)
+    assert 600 not in expect and 13 in expect
@@ -26,6 +26,8 @@ lib_dir = dirname(current_dir)
 sys.path.append(lib_dir)
 from cube_partition_sfc import CubePartitionSFC
 from cube_partition_stripe import CubePartitionStripe
+from cube_adjacency import get_cube_adjacency
+from cube_hierarchy import count_pieces
 
 
 
@@ -72,6 +74,22 @@ def test_make_sfcs():
 
 
 
+def test_shared_library_session():
+    '''
+    cube_partition_sfc: the library is loaded once per process
+    '''
+    obj1 = CubePartitionSFC(ne=6, nproc=4)
+    obj2 = CubePartitionSFC(ne=30, nproc=10)
+    stripe = CubePartitionStripe(ne=6, nproc=4)
+    assert obj1.f90_funcs is obj2.f90_funcs
+    assert obj1.f90_funcs['make_cube_rank'] is not stripe.f90_funcs['make_cube_rank']
+
+    # the make_sfcs() with other arrays does not change the module tables
+    obj1.make_sfcs()
+    a_equal(obj1.make_panel_sfc(), CubePartitionSFC(ne=6, nproc=4).make_panel_sfc())
+
+
+
 def test_find_factors():
     '''
     cube_partition_sfc: find_factors()
@@ -563,6 +581,43 @@ def test_make_cube_rank_30_24():
 
 
 
+def test_make_cube_rank_capacity():
+    '''
+    cube_partition_sfc: make_cube_rank(): nelems in proportion to the capacity
+    '''
+    obj = CubePartitionSFC(ne=6, nproc=10)
+    a_equal(obj.capacity_nelems([1]*10), [22]*6 + [21]*4)
+    a_equal(obj.capacity_nelems([1.8,1,1,1,1,1,1,1,1,0.001], nelem=20), [3,2,2,2,2,2,2,2,2,1])
+    a_equal(CubePartitionSFC(ne=6, nproc=4).capacity_nelems([1.8,1,1,1], nelem=20), [8,4,4,4])
+
+    nelems, cube_rank, cube_lid = obj.make_cube_rank()
+    ret = obj.make_cube_rank(capacity=np.ones(10))
+    a_equal(ret[0], nelems)
+    a_equal(ret[1], cube_rank)
+    a_equal(ret[2], cube_lid)
+
+    rng = np.random.RandomState(0)
+    for ne, nproc in [(6, 10), (10, 37), (30, 200)]:
+        obj = CubePartitionSFC(ne, nproc)
+        capacity = rng.choice([1, 1.8], nproc)
+        nelems, cube_rank, cube_lid = obj.make_cube_rank(capacity=capacity)
+        equal(nelems.sum(), 6*ne*ne)
+        assert np.all(np.abs(nelems - 6*ne*ne*capacity/capacity.sum()) < 1)
+        a_equal(np.bincount(cube_rank.ravel(), minlength=nproc), nelems)
+        flat_rank = cube_rank.ravel(order='F')
+        edge_nbrs = get_cube_adjacency(ne).edge_nbrs
+        for rank in range(nproc):
+            a_equal(np.sort(cube_lid[cube_rank == rank]), np.arange(1, nelems[rank]+1))
+            equal(count_pieces(edge_nbrs, np.nonzero(flat_rank == rank)[0]), 1)
+
+    for capacity in [np.ones(nproc-1), -np.ones(nproc), np.ones(nproc)*np.nan]:
+        try:
+            obj.make_cube_rank(capacity=capacity)
+            assert False
+        except ValueError:
+            pass
+
+
 def test_make_elem_coord_6_10():
     '''
     cube_partition_sfc: make_elem_coord(): ne=6, nproc=10
@@ -24,7 +24,9 @@ import matplotlib.patches as mp
 current_dir = dirname(abspath(__file__))
 lib_dir = dirname(current_dir)
 sys.path.append(lib_dir)
-from cube_partition_stripe import CubePartitionStripe
+from cube_partition_stripe import CubePartitionStripe, unfoldings, objectives
+from cube_adjacency import get_cube_adjacency
+from cube_hierarchy import count_pieces
 
 
 
@@ -41,6 +43,25 @@ def common_find_optimal_band(ne, nproc):
 
 
 
+def box_in_pieces(box, ranks):
+    '''
+    a rank of the ranks is in pieces through the sides of the box
+    '''
+    for rank in ranks:
+        cells = set(zip(*np.nonzero(box == rank)))
+        stack = [cells.pop()]
+        while stack:
+            i, j = stack.pop()
+            for nbr in [(i-1,j), (i+1,j), (i,j-1), (i,j+1)]:
+                if nbr in cells:
+                    cells.remove(nbr)
+                    stack.append(nbr)
+        if cells: return True
+
+    return False
+
+
+
 def test_find_optimal_band_ne10():
     '''
     cube_partition_stripe: find_optimal_band(): ne=10, square or rectangle domain
@@ -409,3 +430,409 @@ def test_make_cube_rank():
     a_equal(cube_rank[:,:,2], 3)
     a_equal(cube_rank[:,:,3], 4)
     a_equal(cube_rank[:,:,4], 5)
+
+
+
+def test_make_cube_rank_out():
+    '''
+    cube_partition_stripe: make_cube_rank(): reuse the out buffers and the workspace
+    '''
+    ne = 12
+    ref = dict((nproc, CubePartitionStripe(ne, nproc).make_cube_rank())
+               for nproc in [3, 5, 16, 37])
+
+    obj = CubePartitionStripe(ne, 5)
+    workspace = obj.make_workspace()
+    cube_rank = np.full((ne,ne,6), 99, 'i4', order='F')
+    cube_lid = np.full((ne,ne,6), 99, 'i4', order='F')
+    cube_color = np.zeros((ne,ne,6), 'i4', order='F')
+    for nproc in [3, 5, 16, 37]:
+        obj = CubePartitionStripe(ne, nproc)
+        nelems = np.zeros(nproc, 'i4')
+        out = obj.make_cube_rank(out=(nelems, cube_rank, cube_lid),
+                                 workspace=workspace)
+        assert out[1] is cube_rank and out[2] is cube_lid
+        for a, b in zip(out, ref[nproc]):
+            a_equal(a, b)
+
+        a_equal(obj.band_partition(nelems, workspace=workspace) if nproc > 3
+                else cube_rank, cube_rank)
+        assert obj.make_cube_color(cube_rank, out=cube_color) is cube_color
+        a_equal(cube_color, obj.make_cube_color(cube_rank))
+
+    try:
+        obj.make_cube_rank(out=(nelems, cube_rank.copy(order='C'), cube_lid))
+        assert False
+    except ValueError:
+        pass
+
+    try:
+        obj.make_cube_rank(workspace=workspace[:10])
+        assert False
+    except ValueError:
+        pass
+
+
+
+def test_make_cube_rank_nbands():
+    '''
+    cube_partition_stripe: make_cube_rank(): rearrange the last nbands bands
+    '''
+    ne = 12
+    for nproc in [4, 17, 76, 130, 150]:
+        obj = CubePartitionStripe(ne, nproc)
+        nelems, cube_rank, cube_lid = obj.make_cube_rank()
+        ratio, num_nbrs = obj.global_perimeter_ratio(cube_rank)
+
+        for nbands in [3, 4]:
+            nelems2, cube_rank2, cube_lid2 = obj.make_cube_rank(nbands=nbands)
+            a_equal(nelems2, nelems)
+            a_equal(np.bincount(cube_rank2.ravel(), minlength=nproc), nelems)
+            ratio2, num_nbrs2 = obj.global_perimeter_ratio(cube_rank2)
+            assert ratio2 <= ratio
+            if nproc == 130 and nbands == 4: assert ratio2 < ratio
+
+    try:
+        obj.make_cube_rank(nbands=1)
+        assert False
+    except ValueError:
+        pass
+
+
+
+def test_make_cube_rank_budget():
+    '''
+    cube_partition_stripe: make_cube_rank(): optimal band splits in a time budget
+    '''
+    ne = 30
+    for nproc in [16, 96, 300]:
+        obj = CubePartitionStripe(ne, nproc)
+        nelems, cube_rank, cube_lid = obj.make_cube_rank()
+        ratio, num_nbrs = obj.global_perimeter_ratio(cube_rank)
+
+        for budget in [1e-9, 10]:
+            nelems2, cube_rank2, cube_lid2 = obj.make_cube_rank(budget=budget)
+            a_equal(nelems2, nelems)
+            a_equal(np.bincount(cube_rank2.ravel(), minlength=nproc), nelems)
+            ratio2, num_nbrs2 = obj.global_perimeter_ratio(cube_rank2)
+            assert ratio2 <= ratio
+            if nproc == 96 and budget == 10: assert ratio2 < ratio
+
+
+
+def test_make_cube_rank_unfolding():
+    '''
+    cube_partition_stripe: make_cube_rank(): the routes of the bands in the canonical coordinates
+    '''
+    ne = 12
+    for nproc in [4, 17, 76, 130, 510]:
+        obj = CubePartitionStripe(ne, nproc)
+        nelems, cube_rank, cube_lid = obj.make_cube_rank()
+
+        ratios = list()
+        for unfolding in unfoldings:
+            nelems2, cube_rank2, cube_lid2 = obj.make_cube_rank(unfolding=unfolding)
+            a_equal(nelems2, nelems)
+            a_equal(np.bincount(cube_rank2.ravel(), minlength=nproc), nelems)
+            ratios.append(obj.global_perimeter_ratio(cube_rank2)[0])
+            if unfolding == 0: a_equal(cube_rank2, cube_rank)
+
+        if nproc == 76: assert min(ratios) < ratios[0]
+
+    try:
+        obj.make_cube_rank(unfolding=4)
+        assert False
+    except ValueError:
+        pass
+
+
+
+def test_perimeter_ratio_bound():
+    '''
+    cube_partition_stripe: perimeter_ratio_bound(): below the ratios of the partitions
+    '''
+    ne = 10
+    for nproc in [1, 2, 7, 30, 100, 333, 600]:
+        obj = CubePartitionStripe(ne, nproc)
+        bound = obj.perimeter_ratio_bound()
+        for unfolding in unfoldings:
+            nelems, cube_rank, cube_lid = obj.make_cube_rank(unfolding=unfolding)
+            assert obj.global_perimeter_ratio(cube_rank)[0] >= bound
+
+        if nproc < 15: equal(bound, 0)  # a rank can hold a whole belt
+        if nproc == 600: equal(bound, 4)  # one element in every rank
+
+
+
+def test_band_ratio_bound():
+    '''
+    cube_partition_stripe: band_ratio_bound(): below calc_perimeter_ratio()
+    '''
+    nx, ny, nproc = 20, 10, 12
+    obj = CubePartitionStripe(10, nproc)
+    for nelem in [1, 3, 7, 16, 40]:
+        nelems = np.ones(nproc, 'i4')*nelem
+        nelems[::3] += 1
+        for end_rank in range(nproc):
+            box = np.ones((nx,ny), 'i4', order='F')*(-1)
+            i12 = np.array([1, 1, ny, 0], 'i4')  # (i1, i2, band_elem, remain_elem)
+            ratio = obj.calc_perimeter_ratio(0, end_rank, nelems, i12, box)
+            if ratio < 0: break
+
+            width = i12[1] - i12[0] + 1
+            bound = obj.band_ratio_bound(ny, width, nelems[:end_rank+1])
+            assert 0 < bound <= ratio + 1e-12
+
+    # the ranks in a single column are the rectangles of the bound
+    nelems = np.ones(2, 'i4')*5
+    box = np.ones((1,ny), 'i4', order='F')*(-1)
+    i12 = np.array([1, 1, ny, 0], 'i4')
+    equal(obj.band_ratio_bound(ny, 1, nelems),
+          obj.calc_perimeter_ratio(0, 1, nelems, i12, box))
+
+    try:
+        obj.band_ratio_bound(ny, 0, nelems)
+        assert False
+    except ValueError:
+        pass
+
+
+
+def test_find_optimal_band_objective():
+    '''
+    cube_partition_stripe: find_optimal_band(): the objectives as the search over calc_band_objective()
+    '''
+    ne = 10
+    for nproc, nelem in [(7, 13), (20, 5), (33, 3)]:
+        obj = CubePartitionStripe(ne, nproc)
+        nelems = np.ones(nproc, 'i4')*nelem
+        nelems[::2] += 1
+        for objective in objectives:
+            box = np.ones((2*ne,ne), 'i4', order='F')*(-1)
+            box[0,:4] = nproc  # the first column used by the band before
+            rank, i2 = obj.find_optimal_band(0, 1, nelems, box, objective)
+
+            # fill the band again for every end_rank as band_search_copy(),
+            # the bands of the other objectives with a rank in pieces only
+            # over a shorter band with them
+            box2 = np.ones((2*ne,ne), 'i4', order='F')*(-1)
+            box2[0,:4] = nproc
+            i12 = np.array([1, 1, ne-4, -1], 'i4')
+            max_ratio = 4 if objective == 'perimeter' else np.finfo(float).max
+            prev_ratio, prev_filled, prev_split = max_ratio, False, False
+            prev_i12, prev_box = i12.copy(), box2
+            end_rank = 0
+            while end_rank < nproc:
+                tmp_box = box2.copy(order='F')
+                ratio = obj.calc_band_objective(0, end_rank, nelems, i12, tmp_box, objective)
+                filled = 0 <= ratio < max_ratio
+                split = objective != 'perimeter' and filled \
+                        and box_in_pieces(tmp_box, range(end_rank+1))
+                if split and prev_filled and not prev_split: ratio = -1
+                if ratio < 0: break
+                if ratio > prev_ratio and not (filled and prev_split and not split): break
+                prev_ratio, prev_i12, prev_box = ratio, i12.copy(), tmp_box
+                prev_filled, prev_split = filled, split
+                end_rank += 1
+
+            equal(rank, end_rank)
+            equal(i2, prev_i12[1] + (prev_i12[3] == 0))
+            a_equal(box, prev_box)
+
+
+
+def test_make_cube_rank_objective():
+    '''
+    cube_partition_stripe: make_cube_rank(): the objectives of the band search
+    '''
+    ne = 12
+    for nproc in [17, 76, 130]:
+        obj = CubePartitionStripe(ne, nproc)
+        nelems, cube_rank, cube_lid = obj.make_cube_rank()
+
+        metrics = dict()
+        for objective in objectives:
+            for kw in [dict(), dict(nbands=3), dict(budget=10, unfolding=1)]:
+                nelems2, cube_rank2, cube_lid2 = obj.make_cube_rank(objective=objective, **kw)
+                a_equal(np.bincount(cube_rank2.ravel(), minlength=nproc), nelems)
+
+            cube_rank2 = obj.make_cube_rank(workspace=obj.make_workspace(), objective=objective)[1]
+            if objective == 'perimeter': a_equal(cube_rank2, cube_rank)
+            comm_ratio, num_pts = obj.global_communication_ratio(4, cube_rank2)
+            metrics[objective] = (comm_ratio, (num_pts[1]/num_pts[0]).max(),
+                                  obj.global_neighbor_count(cube_rank2)[0])
+
+        cube_rank2 = obj.make_cube_rank(objective='nbrs', max_nbrs=6)[1]
+        a_equal(np.bincount(cube_rank2.ravel(), minlength=nproc), nelems)
+
+        # every objective lowers its own metric from the perimeter ratio
+        if nproc == 76:
+            assert metrics['comm'][0] < metrics['perimeter'][0]
+            assert metrics['max_comm'][1] < metrics['perimeter'][1]
+            assert metrics['nbrs'][2] < metrics['perimeter'][2]
+
+    for kw in [dict(objective='traffic'), dict(objective='comm', ngq=1), dict(objective='nbrs', max_nbrs=0)]:
+        try:
+            obj.make_cube_rank(**kw)
+            assert False
+        except ValueError:
+            pass
+
+
+
+def test_make_cube_rank_objective_connected():
+    '''
+    cube_partition_stripe: make_cube_rank(): every rank of the objectives in one piece
+    '''
+    for ne, nprocs in [(6, [30, 79, 107]), (8, [100, 150, 191])]:
+        edge_nbrs = get_cube_adjacency(ne).edge_nbrs
+        for nproc in nprocs:
+            obj = CubePartitionStripe(ne, nproc)
+            nelems = obj.make_cube_rank()[0]
+            for kw in [dict(objective='nbrs'), dict(objective='nbrs', max_nbrs=8),
+                       dict(objective='comm'), dict(objective='max_comm')]:
+                nelems2, cube_rank, cube_lid = obj.make_cube_rank(**kw)
+                a_equal(nelems2, nelems)
+                a_equal(np.bincount(cube_rank.ravel(), minlength=nproc), nelems)
+                flat_rank = cube_rank.ravel(order='F')
+                for rank in range(nproc):
+                    a_equal(np.sort(cube_lid[cube_rank == rank]), np.arange(1, nelems[rank]+1))
+                    equal(count_pieces(edge_nbrs, np.nonzero(flat_rank == rank)[0]), 1)
+
+
+
+def test_make_cube_rank_weights():
+    '''
+    cube_partition_stripe: make_cube_rank(): balance the element weights
+    '''
+    ne = 16
+    x = np.linspace(-1, 1, ne)
+    weights = np.ones((ne,ne,6))
+    weights[:,:,:4] += x[:,None,None]**2
+    weights[:,:,4] = 3
+
+    for nproc in [1, 3, 7, 30, 64]:
+        obj = CubePartitionStripe(ne, nproc)
+        nelems, cube_rank, cube_lid = obj.make_cube_rank()
+
+        # the same weights within the tol keep the partition
+        ret = obj.make_cube_rank(weights=np.ones((ne,ne,6)), tol=1)
+        a_equal(ret[0], nelems)
+        a_equal(ret[1], cube_rank)
+        a_equal(ret[2], cube_lid)
+        a_equal(ret[3], nelems)
+
+        out = (np.zeros(nproc, 'i4', order='F'), np.zeros((ne,ne,6), 'i4', order='F'),
+               np.zeros((ne,ne,6), 'i4', order='F'), np.zeros(nproc, 'f8', order='F'))
+        nelems2, cube_rank2, cube_lid2, rank_weights = obj.make_cube_rank(weights=weights, out=out)
+        assert rank_weights is out[3]
+        a_equal(np.bincount(cube_rank2.ravel(), minlength=nproc), nelems2)
+        np.testing.assert_allclose(np.bincount(cube_rank2.ravel(), weights=weights.ravel(), minlength=nproc), rank_weights)
+        for rank in range(nproc):
+            a_equal(np.sort(cube_lid2[cube_rank2 == rank]), np.arange(1, nelems2[rank]+1))
+
+        weights0 = np.bincount(cube_rank.ravel(), weights=weights.ravel(), minlength=nproc)
+        excess0 = weights0.max()/weights0.mean() - 1
+        excess = rank_weights.max()/rank_weights.mean() - 1
+        if nproc <= 3:
+            a_equal(cube_rank2, cube_rank)
+        else:
+            assert excess < excess0/3
+        if nproc in [7, 30]: assert excess < 0.05
+
+    for kw in [dict(weights=np.ones((ne,ne,5))), dict(weights=-weights), dict(weights=weights*np.nan),
+               dict(weights=weights, tol=-1)]:
+        try:
+            obj.make_cube_rank(**kw)
+            assert False
+        except ValueError:
+            pass
+
+    # ranks much larger than a panel stop the bands
+    try:
+        CubePartitionStripe(4, 4).band_partition(np.array([28, 28, 23, 17], 'i4'))
+        assert False
+    except ValueError:
+        pass
+
+    # every rank in one piece with the random weights
+    for ne, nproc in [(6, 79), (8, 100), (10, 247)]:
+        edge_nbrs = get_cube_adjacency(ne).edge_nbrs
+        weights = np.random.RandomState(nproc).uniform(0.5, 2, (ne,ne,6))
+        nelems, cube_rank, cube_lid, rank_weights = CubePartitionStripe(ne, nproc).make_cube_rank(weights=weights)
+        a_equal(np.bincount(cube_rank.ravel(), minlength=nproc), nelems)
+        flat_rank = cube_rank.ravel(order='F')
+        for rank in range(nproc):
+            equal(count_pieces(edge_nbrs, np.nonzero(flat_rank == rank)[0]), 1)
+
+
+
+def test_make_cube_rank_capacity():
+    '''
+    cube_partition_stripe: make_cube_rank(): nelems in proportion to the capacity
+    '''
+    ne = 10
+    rng = np.random.RandomState(0)
+    edge_nbrs = get_cube_adjacency(ne).edge_nbrs
+    for nproc in [2, 3, 7, 37, 100, 247]:
+        obj = CubePartitionStripe(ne, nproc)
+        nelems, cube_rank, cube_lid = obj.make_cube_rank()
+        ret = obj.make_cube_rank(capacity=np.ones(nproc))
+        a_equal(ret[0], nelems)
+        a_equal(ret[1], cube_rank)
+        a_equal(ret[2], cube_lid)
+
+        capacity = rng.choice([1, 1.8], nproc)
+        nelems, cube_rank, cube_lid = obj.make_cube_rank(capacity=capacity)
+        equal(nelems.sum(), 6*ne*ne)
+        a_equal(np.bincount(cube_rank.ravel(), minlength=nproc), nelems)
+        flat_rank = cube_rank.ravel(order='F')
+        for rank in range(nproc):
+            a_equal(np.sort(cube_lid[cube_rank == rank]), np.arange(1, nelems[rank]+1))
+            equal(count_pieces(edge_nbrs, np.nonzero(flat_rank == rank)[0]), 1)
+        if nproc <= 3:
+            a_equal(nelems % (ne*ne), 0)
+        else:
+            assert np.all(np.abs(nelems - 6*ne*ne*capacity/capacity.sum()) < 1)
+
+    # the whole panels in proportion
+    obj = CubePartitionStripe(ne, 2)
+    nelems, cube_rank, cube_lid = obj.make_cube_rank(capacity=[1, 2])
+    a_equal(nelems, [2*ne*ne, 4*ne*ne])
+    a_equal(cube_rank[:,:,[5,0]], 0)
+    a_equal(cube_rank[:,:,1:5], 1)
+
+    # the times of the weights balanced with the capacity
+    obj = CubePartitionStripe(ne, 37)
+    capacity = rng.choice([1, 1.8], 37)
+    weights = rng.uniform(0.5, 1.5, (ne,ne,6))
+    nelems, cube_rank, cube_lid, rank_weights = obj.make_cube_rank(weights=weights, capacity=capacity)
+    times = rank_weights/capacity
+    assert times.max()/(rank_weights.sum()/capacity.sum()) - 1 < 0.1
+
+    for capacity in [np.ones(36), -np.ones(37), np.ones(37)*np.nan]:
+        try:
+            obj.make_cube_rank(capacity=capacity)
+            assert False
+        except ValueError:
+            pass
+
+
+def test_global_neighbor_count():
+    '''
+    cube_partition_stripe: global_neighbor_count(): the ranks of two panels and of one element
+    '''
+    ne = 4
+    obj = CubePartitionStripe(ne, 2)
+    nelems, cube_rank, cube_lid = obj.make_cube_rank()
+    mean_nbrs, num_nbrs = obj.global_neighbor_count(cube_rank)
+    equal(mean_nbrs, 1)
+    a_equal(num_nbrs, [1, 1])
+
+    # eight neighbors but seven at the three elements of every cube corner
+    nproc = 6*ne*ne
+    obj = CubePartitionStripe(ne, nproc)
+    nelems, cube_rank, cube_lid = obj.make_cube_rank()
+    mean_nbrs, num_nbrs = obj.global_neighbor_count(cube_rank)
+    equal(np.bincount(num_nbrs), [0]*7 + [24, nproc-24])
+    equal(mean_nbrs, 8 - 24/nproc)
@@ -0,0 +1,67 @@
+'''
+
+abstract : unittest of cube_threads.py
+
+'''
+
+from __future__ import print_function, division
+from os.path import dirname, abspath, join
+import sys
+
+from numpy.testing import assert_equal as equal
+from numpy.testing import assert_array_equal as a_equal
+import numpy as np
+
+
+current_dir = dirname(abspath(__file__))
+lib_dir = dirname(current_dir)
+sys.path.append(lib_dir)
+from cube_threads import openmp_enabled, set_num_threads, get_num_threads, num_threads
+from cube_adjacency import get_cube_adjacency
+from cube_partition_sfc import CubePartitionSFC
+from cube_partition_stripe import CubePartitionStripe
+
+
+
+def test_num_threads():
+    '''
+    cube_threads: set_num_threads(), num_threads()
+    '''
+    default = get_num_threads()
+
+    set_num_threads(3)
+    equal(get_num_threads(), 3 if openmp_enabled() else 1)
+    with num_threads(2):
+        equal(get_num_threads(), 2 if openmp_enabled() else 1)
+    equal(get_num_threads(), 3 if openmp_enabled() else 1)
+
+    set_num_threads(None)
+    equal(get_num_threads(), default)
+
+
+
+def test_bit_identical():
+    '''
+    cube_threads: the same results for any number of threads: ne=30
+    '''
+    ne = 30   # 6*ne*ne > min_omp_work
+    adj = get_cube_adjacency(ne)
+
+    for nproc in [7, 96, 1000]:
+        stripe = CubePartitionStripe(ne, nproc)
+        sfc = CubePartitionSFC(ne, nproc)
+
+        rets = []
+        for n in [1, 4]:
+            with num_threads(n):
+                ret = list(sfc.make_cube_rank())
+                cube_rank = ret[1]
+                ret.extend(stripe.global_perimeter_ratio(cube_rank))
+                ret.extend(stripe.global_perimeter_ratio(cube_rank, adj))
+                ret.extend(stripe.global_communication_ratio(4, cube_rank))
+                ret.extend(stripe.global_communication_ratio(4, cube_rank, adj))
+                ret.extend(stripe.make_cube_rank())
+            rets.append(ret)
+
+        for a, b in zip(*rets):
+            a_equal(a, b)